@@ -5,7 +5,7 @@ import torch
 import cv2
 import numpy as np
 from models.yolov5.yolo import load_yolov5_ckpt
-from utils.yolov5_utils import fuse_conv_and_bn
+from utils.yolov5_utils import fuse_conv_and_bn, fuse_deconv_and_bn
 import glob
 import torch.nn as nn
 from utils.weight_init import init_weights
@@ -18,6 +18,8 @@ TEXTDET_MASK = 0
 TEXTDET_DET = 1
 TEXTDET_INFERENCE = 2
 
+TEXTDET_HEADS = ('blk', 'seg', 'det')     # yolo blocks, unet text mask, db text lines
+
 class double_conv_up_c3(nn.Module):
     def __init__(self, in_ch, mid_ch, out_ch, act=True):
         super(double_conv_up_c3, self).__init__()
@@ -215,45 +217,102 @@ def get_base_det_models(model_path, device='cpu', half=False, act='leaky'):
     text_seg.load_state_dict(textdetector_dict['text_seg'])
     text_det = DBHead(64, act=act)
     text_det.load_state_dict(textdetector_dict['text_det'])
+    models = blk_det.eval().to(device), text_seg.eval().to(device), text_det.eval().to(device)
     if half:
-        return blk_det.eval().half(), text_seg.eval().half(), text_det.eval().half()
-    return blk_det.eval().to(device), text_seg.eval().to(device), text_det.eval().to(device)
+        return tuple(m.half() for m in models)
+    return models
 
 class TextDetBase(nn.Module):
-    def __init__(self, model_path, device='cpu', half=False, fuse=False, act='leaky'):
+    def __init__(self, model_path, device='cpu', half=False, fuse=False, act='leaky', heads=TEXTDET_HEADS):
+        '''
+        heads: outputs to compute, the others are returned as None. 
+            without 'seg' the unet decoder stops at the features the db head needs
+        '''
         super(TextDetBase, self).__init__()
         self.blk_det, self.text_seg, self.text_det = get_base_det_models(model_path, device, half, act=act)
+        self.heads = tuple(heads)
         if fuse:
             self.fuse()
 
     def fuse(self):
         def _fuse(model):
-            for m in model.modules():
+            for m in list(model.modules()):
                 if isinstance(m, (Conv)) and hasattr(m, 'bn'):
                     m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
                     delattr(m, 'bn')  # remove batchnorm
                     m.forward = m.forward_fuse  # update forward
+                elif isinstance(m, nn.Sequential):
+                    # conv/deconv + bn pairs of the upconvs and db head
+                    for ii in range(1, len(m)):
+                        if not isinstance(m[ii], nn.BatchNorm2d):
+                            continue
+                        if type(m[ii-1]) is nn.Conv2d:
+                            m[ii-1] = fuse_conv_and_bn(m[ii-1], m[ii])
+                            m[ii] = nn.Identity()
+                        elif type(m[ii-1]) is nn.ConvTranspose2d:
+                            m[ii-1] = fuse_deconv_and_bn(m[ii-1], m[ii])
+                            m[ii] = nn.Identity()
             return model
+        self.blk_det = _fuse(self.blk_det)  # load_yolov5_ckpt fuses it already
         self.text_seg = _fuse(self.text_seg)
         self.text_det = _fuse(self.text_det)
+        return self
 
     def forward(self, features):
         blks, features = self.blk_det(features, detect=True)
-        mask, features = self.text_seg(*features, forward_mode=TEXTDET_INFERENCE)
-        lines = self.text_det(*features, step_eval=False)
-        return blks[0], mask, lines
-
-class TextDetBaseDNN:
-    def __init__(self, input_size, model_path):
-        self.input_size = input_size
-        self.model = cv2.dnn.readNetFromONNX(model_path)
-        self.uoln = self.model.getUnconnectedOutLayersNames()
-    
-    def __call__(self, im_in):
-        blob = cv2.dnn.blobFromImage(im_in, scalefactor=1 / 255.0, size=(self.input_size, self.input_size))
-        self.model.setInput(blob)
-        blks, mask, lines_map  = self.model.forward(self.uoln)
-        return blks, mask, lines_map
+        blks = blks[0] if 'blk' in self.heads else None
+        mask = lines = None
+        if 'seg' in self.heads:
+            mask, features = self.text_seg(*features, forward_mode=TEXTDET_INFERENCE)
+        elif 'det' in self.heads:
+            features = self.text_seg(*features, forward_mode=TEXTDET_DET)
+        if 'det' in self.heads:
+            lines = self.text_det(*features, step_eval=False)
+        return blks, mask, lines
+
+class TextDetHeads(nn.Module):
+    '''
+    TextDetBase without the None outputs, for exporting a graph with only some of the heads
+    '''
+    def __init__(self, model: TextDetBase):
+        super(TextDetHeads, self).__init__()
+        self.model = model
+
+    def forward(self, features):
+        return tuple(out for out in self.model(features) if out is not None)
+
+class TextDetInference(nn.Module):
+    '''
+    inference-only TextDetBase: bn folded into the convs of all heads, optionally channels-last memory format 
+    and jit='trace' (torchscript, fixed to input_size) or jit='compile' (torch.compile)
+    '''
+    def __init__(self, model: TextDetBase, channels_last=False, jit=None, input_size=(1024, 1024)):
+        super(TextDetInference, self).__init__()
+        self.heads = model.heads
+        self.channels_last = channels_last
+        self.model = model.eval().fuse()
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        heads_model = TextDetHeads(self.model).eval()
+        if jit == 'trace':
+            param = next(self.model.parameters())
+            im = torch.zeros((1, 3, *input_size), device=param.device, dtype=param.dtype)
+            if channels_last:
+                im = im.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                heads_model(im)     # Detect builds its grids on the first call, trace with them in place
+                heads_model = torch.jit.freeze(torch.jit.trace(heads_model, im))
+        elif jit == 'compile':
+            heads_model = torch.compile(heads_model)
+        elif jit is not None:
+            raise ValueError(f'unknown jit mode {jit}')
+        self.heads_model = heads_model
+
+    def forward(self, features):
+        if self.channels_last:
+            features = features.contiguous(memory_format=torch.channels_last)
+        outs = iter(self.heads_model(features))
+        return tuple(next(outs) if name in self.heads else None for name in TEXTDET_HEADS)
 
 if __name__ == '__main__':
     device = 'cuda'
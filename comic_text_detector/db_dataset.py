@@ -1,5 +1,6 @@
 import numpy as np
 import yaml
+import json
 import torch
 import glob
 import os
@@ -17,9 +18,9 @@ from torchvision import transforms
 from torch.utils.data import DataLoader, Dataset, dataloader
 from utils.general import LOGGER, Loggers, CUDA, DEVICE
 from utils.db_utils import MakeBorderMap, MakeShrinkMap
-from seg_dataset import augment_hsv
-from utils.imgproc_utils import rotate_polygons, letterbox, resize_keepasp
-from PIL import Image
+from seg_dataset import augment_hsv, ShardBatchSampler, AspectRatioBatchSampler, read_aspect_ratios, is_rect
+from utils.imgproc_utils import rotation_matrix, affine_points, letterbox, resize_keepasp
+from utils.io_utils import MmapImageCache, ShardReader, ShardWriter
 
 WORLD_SIZE = int(os.getenv('WORLD_SIZE', 1))  # DPP
 NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of multiprocessing threads
@@ -41,7 +42,7 @@ def db_val_collate_fn(batchs):
     return ret_batchs
 
 class LoadImageAndAnnotations(Dataset):
-    def __init__(self, img_dir, ann_dir=None, img_size=640, augment=False, aug_param=None, cache=False, stride=128, cache_ann_only=True, with_ann=False):
+    def __init__(self, img_dir, ann_dir=None, img_size=640, augment=False, aug_param=None, cache=False, stride=128, cache_ann_only=True, with_ann=False, map_cache_dir=None, cache_gb=7, cache_dir=None, shard_dir=None, border_distance_transform=False):
         if isinstance(img_dir, str):
             self.img_dir = [img_dir]
         elif isinstance(img_dir, list):
@@ -57,7 +58,7 @@ class LoadImageAndAnnotations(Dataset):
             elif isinstance(ann_dir, list):
                 self.ann_dir = ann_dir
         self.with_ann = with_ann
-        self.make_border_map = MakeBorderMap(shrink_ratio=0.4)
+        self.make_border_map = MakeBorderMap(shrink_ratio=0.4, distance_transform=border_distance_transform)
         self.make_shrink_map = MakeShrinkMap(shrink_ratio=0.4)
         self.img_ann_list = []
         self.img_size = (img_size, img_size)
@@ -79,36 +80,60 @@ class LoadImageAndAnnotations(Dataset):
             else:
                 self.valid_size = None
                 self.multi_size = False
-        for img_dir in self.img_dir:
-            for filep in glob.glob(osp.join(img_dir, "*")):
-                filename = osp.basename(filep)
-                file_suffix = Path(filename).suffix
-                if file_suffix not in IMG_EXT:
-                    continue
-                annname = 'line-' + filename.replace(file_suffix, '.txt')
-                for ann_dir in self.ann_dir:
-                    annp = osp.join(ann_dir, annname)
-                    if osp.exists(annp):
-                        self.img_ann_list.append((filep, annp))
+        self.shards = None
+        if shard_dir:
+            # samples packed by pack_db_shards, no directory listing or small-file reads
+            self.shards = ShardReader(shard_dir)
+            self.img_ann_list = [self.shards.keys(i) for i in range(len(self.shards))]
+        else:
+            for img_dir in self.img_dir:
+                for filep in glob.glob(osp.join(img_dir, "*")):
+                    filename = osp.basename(filep)
+                    file_suffix = Path(filename).suffix
+                    if file_suffix not in IMG_EXT:
+                        continue
+                    annname = 'line-' + filename.replace(file_suffix, '.txt')
+                    for ann_dir in self.ann_dir:
+                        annp = osp.join(ann_dir, annname)
+                        if osp.exists(annp):
+                            self.img_ann_list.append((filep, annp))
         self._img_transform = transforms.Compose([transforms.ToTensor()])
 
         n = len(self.img_ann_list)
         self.imgs, self.anns = [None] * n, [None] * n
-        gb = 0
         if cache:
-            results = ThreadPool(NUM_THREADS).imap(lambda x: load_image_annotations(*x, max_size=img_size), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                im, self.anns[i] = x  # im, hw_orig, hw_resized = load_image_ann(self, i)
-                if not cache_ann_only:
-                    self.imgs[i] = im
-                    gb += self.imgs[i].nbytes
-                gb += self.anns[i].nbytes
-                if gb / 1E9 > 7:
-                    break
-                pbar.desc = f'Caching images ({gb / 1E9:.1f}GB )'
-            pbar.close()
+            results = ThreadPool(NUM_THREADS).imap(lambda x: load_image_annotations(*x, max_size=img_size)[1], zip(repeat(self), range(n)))
+            for i, ann in enumerate(tqdm(results, total=n, desc='Caching annotations')):
+                self.anns[i] = ann
+            if not cache_ann_only:
+                # pre-resized images in one memory-mapped file, shared by all dataloader workers
+                cache_path = osp.join(cache_dir or self.img_dir[0], f'.db_cache_{img_size}_img')
+                self.imgs = MmapImageCache.open_or_build(cache_path, [imp for imp, _ in self.img_ann_list],
+                                                         lambda i: resize_keepasp(self.read_img(i), img_size),
+                                                         cache_gb, NUM_THREADS)
+
+        # precomputed shrink/threshold maps, only valid without augmentation, (re)built here if missing or stale
+        self.map_cache = None
+        if map_cache_dir and not self._augment:
+            map_cache_root = db_map_cache_root(map_cache_dir, self.img_size, self.img_ann_list, border_distance_transform)
+            if osp.exists(osp.join(map_cache_root, 'index.json')):
+                self.map_cache = DBMapCache(map_cache_root)
+                if not self.map_cache.matches(self.img_ann_list):
+                    LOGGER.info(f'precomputed maps in {map_cache_root} are stale, rebuilding them')
+                    self.map_cache = None
+            if self.map_cache is None:
+                self.map_cache = build_db_map_cache(self, map_cache_root)
         
+    def read_img(self, i):
+        if self.shards is not None:
+            return self.shards.read_img(i)
+        return cv2.imread(self.img_ann_list[i][0])
+
+    def read_ann(self, i):
+        if self.shards is not None:
+            return self.shards.read_array(i, 'ann').astype(np.float64, copy=False)
+        return np.loadtxt(self.img_ann_list[i][1])
+
     def initialize(self):
         if self.augment:
             if self.multi_size:
@@ -144,9 +169,10 @@ class LoadImageAndAnnotations(Dataset):
         else:
             return img, ann
 
-    def augment(self, img, ann):
+    def augment(self, img, ann, rotate=True, img_size=None):
         im_h, im_w = img.shape[0], img.shape[1]
-        if im_h > im_w and random.random() < self._mini_mosaic:
+        # mosaic widens tall pages, which only pays off for square inputs
+        if im_h > im_w and not is_rect(img_size) and random.random() < self._mini_mosaic:
             # imp2, annp2 = random.choice(self.img_ann_list)
             img, ann = self.mini_mosaic(img, ann)
 
@@ -157,21 +183,27 @@ class LoadImageAndAnnotations(Dataset):
             ann[:, :, 0] = 1 - ann[:, :, 0]
         if random.random() < self._neg:
             img = 255 - img
+        if rotate:
+            degrees = self.random_rotation()
+            if degrees != 0:
+                img, ann = self.rotate(img, ann, degrees)
+                ann[:, :, 0] /= img.shape[1]
+                ann[:, :, 1] /= img.shape[0]
+        return img, ann
+
+    def random_rotation(self):
         if random.random() < self._rotate:
             degrees = random.uniform(self.rotate_range[0], self.rotate_range[1])
             if abs(degrees) > 15:
-                img = Image.fromarray(img)
-                center = (img.width/2, img.height/2)
-                ann[:, :, 0] *= img.width
-                ann[:, :, 1] *= img.height
-                ann = ann.reshape(len(ann), -1)
-                img = img.rotate(degrees, resample=Image.BILINEAR, expand=1)
-                new_center = (img.width/2, img.height/2)
-                ann = rotate_polygons(center, ann, degrees, new_center, to_int=False)
-                ann = ann.reshape(len(ann), -1, 2)
-                ann[:, :, 0] /= img.width
-                ann[:, :, 1] /= img.height
-                img = np.asarray(img)
+                return degrees
+        return 0
+
+    def rotate(self, img, ann, degrees, new_shape=None):
+        # one warpAffine for pixels and polygons (relative coords in, pixel coords out), letterboxed into new_shape if given
+        im_h, im_w = img.shape[:2]
+        M, dsize, (dw, dh) = rotation_matrix((im_h, im_w), degrees, new_shape)
+        img = cv2.warpAffine(img, M, dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        ann = affine_points(ann * np.array([im_w, im_h]), M)
         return img, ann
 
     def inverse_transform(self, img: torch.Tensor, scale=255, to_uint8=True):
@@ -185,24 +217,58 @@ class LoadImageAndAnnotations(Dataset):
     def __len__(self):
         return len(self.img_ann_list)
 
-    def __getitem__(self, idx):
-        img, ann = load_image_annotations(self, idx, self.img_size)
+    def aspect_ratios(self):
+        return read_aspect_ratios([imp for imp, _ in self.img_ann_list], self.shards)
+
+    def load_letterboxed(self, idx, img_size=None):
+        if img_size is None:
+            img_size = self.img_size
+        img, ann = load_image_annotations(self, idx, img_size)
         in_h, in_w = img.shape[:2]
 
+        degrees = 0
         if self._augment:
-            img, ann = self.augment(img, ann)
-        ignore_tags = [False] * ann.shape[0]
+            img, ann = self.augment(img, ann, rotate=False, img_size=img_size)
+            degrees = self.random_rotation()
 
-        img, ratio, (dw, dh) = letterbox(img, new_shape=self.img_size, auto=False)
+        if degrees != 0:
+            # rotation fused with letterbox into a single warp
+            img, ann = self.rotate(img, ann, degrees, img_size)
+            return img, ann.astype(np.int64)
+        img, ratio, (dw, dh) = letterbox(img, new_shape=img_size, auto=False)
         im_h, im_w = img.shape[:2]
         if ann is not None:
             ann[:, :, 0] *= (im_w - dw)
             ann[:, :, 1] *= (im_h - dh)
             ann = ann.astype(np.int64)
+        return img, ann
+
+    def load_letterboxed_img(self, idx):
+        # load_letterboxed without augmentation or annotations, for samples whose maps are precomputed
+        img = self.imgs[idx]
+        if img is None:
+            img = self.read_img(idx)
+        img = resize_keepasp(img, max(self.img_size))
+        return letterbox(img, new_shape=self.img_size, auto=False)[0]
+
+    def make_maps(self, idx, img_size=None):
+        img, ann = self.load_letterboxed(idx, img_size)
+        ignore_tags = [False] * ann.shape[0]
         data_dict = {'imgs': img, 'text_polys': ann, 'ignore_tags': ignore_tags}
+        data_dict = self.make_shrink_map(data_dict)
+        data_dict = self.make_border_map(data_dict)
+        return data_dict
 
-        shrink_map = self.make_shrink_map(data_dict)
-        thresh_map = self.make_border_map(data_dict)
+    def __getitem__(self, idx):
+        img_size = None
+        if isinstance(idx, tuple):
+            idx, img_size = idx  # (h, w) from AspectRatioBatchSampler
+        imp = self.img_ann_list[idx][0]
+        if self.map_cache is not None and img_size is None and imp in self.map_cache:
+            thresh_map = self.map_cache[imp]
+            thresh_map['imgs'] = self.load_letterboxed_img(idx)
+        else:
+            thresh_map = self.make_maps(idx, img_size)
         tp = thresh_map.pop('text_polys')
         it = thresh_map.pop('ignore_tags')
         if self.with_ann:
@@ -213,15 +279,101 @@ class LoadImageAndAnnotations(Dataset):
         return thresh_map
 
 
+def db_map_cache_root(cache_dir, img_size, img_ann_list, border_distance_transform=False):
+    # one directory per input size, image/annotation list and border distance method, 
+    # so train/val sharing cache_dir don't overwrite each other
+    import hashlib
+    keys = '\n'.join(f'{imp}\t{annp}' for imp, annp in sorted(img_ann_list))
+    suffix = '_dt' if border_distance_transform else ''
+    return osp.join(cache_dir, f'{img_size[0]}x{img_size[1]}_' + hashlib.md5(keys.encode('utf8')).hexdigest()[:8] + suffix)
+
+class DBMapCache:
+    '''
+    shrink/threshold maps precomputed by build_db_map_cache at one input size, 
+    binary maps are stored as uint8 and the threshold map as float16, memory-mapped read-only 
+    so dataloader workers share the pages. the threshold map lies in [thresh_min, thresh_max] = [0.3, 0.7],
+    where float16 is off by at most 2.5e-4, well below what the L1 threshold loss can tell apart, for half the size
+    '''
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, 'index.json'), 'r', encoding='utf8') as f:
+            index = json.load(f)
+        self.index = {imp: i for i, imp in enumerate(index['imgs'])}
+        self.img_ann_list = list(zip(index['imgs'], index.get('anns', [None] * len(index['imgs']))))
+        self.text_polys = index['text_polys']
+        self.ignore_tags = index['ignore_tags']
+        self.binary_maps = np.load(osp.join(root, 'binary_maps.npy'), mmap_mode='r')
+        self.threshold_map = np.load(osp.join(root, 'threshold_map.npy'), mmap_mode='r')
+
+    def matches(self, img_ann_list):
+        # same images and annotations, none of them modified since the maps were built
+        if sorted(self.img_ann_list) != sorted(tuple(pair) for pair in img_ann_list):
+            return False
+        built = osp.getmtime(osp.join(self.root, 'index.json'))
+        return all(osp.getmtime(p) <= built for pair in img_ann_list for p in pair if p and osp.exists(p))
+
+    def __contains__(self, imp):
+        return imp in self.index
+
+    def __getitem__(self, imp):
+        i = self.index[imp]
+        binary_maps = self.binary_maps[i]
+        text_polys = np.array(self.text_polys[i], dtype=np.int64)
+        if text_polys.size == 0:
+            text_polys = text_polys.reshape(0, 4, 2)
+        return {
+            'text_polys': text_polys,
+            'ignore_tags': list(self.ignore_tags[i]),
+            'shrink_map': binary_maps[0].astype(np.float32),
+            'shrink_mask': binary_maps[1].astype(np.float32),
+            'threshold_map': self.threshold_map[i].astype(np.float32),
+            'threshold_mask': binary_maps[2].astype(np.float32)
+        }
+
+def build_db_map_cache(dataset, root):
+    '''
+    compute the shrink/threshold maps of a non-augmented dataset once into root, see DBMapCache
+    '''
+    os.makedirs(root, exist_ok=True)
+    n, (h, w) = len(dataset), dataset.img_size
+    binary_maps = np.lib.format.open_memmap(osp.join(root, 'binary_maps.npy'), mode='w+', dtype=np.uint8, shape=(n, 3, h, w))
+    threshold_map = np.lib.format.open_memmap(osp.join(root, 'threshold_map.npy'), mode='w+', dtype=np.float16, shape=(n, h, w))
+    text_polys, ignore_tags = [None] * n, [None] * n
+    with ThreadPool(NUM_THREADS) as pool:
+        results = pool.imap(dataset.make_maps, range(n))
+        for i, data_dict in enumerate(tqdm(results, total=n, desc='Precomputing DB maps')):
+            binary_maps[i, 0] = data_dict['shrink_map']
+            binary_maps[i, 1] = data_dict['shrink_mask']
+            binary_maps[i, 2] = data_dict['threshold_mask']
+            threshold_map[i] = data_dict['threshold_map']
+            text_polys[i] = np.asarray(data_dict['text_polys']).tolist()
+            ignore_tags[i] = [bool(tag) for tag in data_dict['ignore_tags']]
+    binary_maps.flush()
+    threshold_map.flush()
+    del binary_maps, threshold_map
+    # written last, a build that was interrupted has no index and is redone
+    with open(osp.join(root, 'index.json'), 'w', encoding='utf8') as f:
+        json.dump({'imgs': [imp for imp, _ in dataset.img_ann_list], 'anns': [annp for _, annp in dataset.img_ann_list], 
+                   'text_polys': text_polys, 'ignore_tags': ignore_tags}, f)
+    LOGGER.info(f'Precomputed DB maps of {n} images in {root}')
+    return DBMapCache(root)
+
+def precompute_db_maps(img_dir, ann_dir, img_size, cache_dir, border_distance_transform=False):
+    '''
+    build the map cache LoadImageAndAnnotations(map_cache_dir=cache_dir) would otherwise build on first use
+    '''
+    dataset = LoadImageAndAnnotations(img_dir, ann_dir, img_size, augment=False, border_distance_transform=border_distance_transform)
+    return build_db_map_cache(dataset, db_map_cache_root(cache_dir, dataset.img_size, dataset.img_ann_list, border_distance_transform))
+
 def load_image_annotations(self, i, max_size=None, ann_abs2rel=True):
     # loads 1 image from dataset index 'i', returns im, original hw, resized hw
     img, ann = self.imgs[i], self.anns[i]
     imp, ann_path = self.img_ann_list[i]
     if img is None:
-        img = cv2.imread(imp)
+        img = self.read_img(i)
     im_h, im_w = img.shape[:2]
     if ann is None:
-        ann = np.loadtxt(ann_path)
+        ann = self.read_ann(i)
         if len(ann.shape) == 1:
             ann = np.array([ann])
         if ann_abs2rel:
@@ -232,21 +384,44 @@ def load_image_annotations(self, i, max_size=None, ann_abs2rel=True):
         ann = np.copy(ann)
     if max_size is not None:
         if isinstance(max_size, tuple):
-            max_size = max_size[0]
+            max_size = max(max_size)
         img = resize_keepasp(img, max_size)
     return img, ann
 
-def create_dataloader(img_dir, ann_dir, imgsz, batch_size, augment=False, aug_param=None, cache=False, workers=8, shuffle=False, with_ann=False):
-    dataset = LoadImageAndAnnotations(img_dir, ann_dir, imgsz, augment, aug_param, cache, with_ann=with_ann)
+def create_dataloader(img_dir, ann_dir, imgsz, batch_size, augment=False, aug_param=None, cache=False, workers=8, shuffle=False, with_ann=False, map_cache_dir=None, cache_ann_only=True, cache_gb=7, cache_dir=None, shard_dir=None, rect=False, border_distance_transform=False):
+    dataset = LoadImageAndAnnotations(img_dir, ann_dir, imgsz, augment, aug_param, cache, cache_ann_only=cache_ann_only, with_ann=with_ann, map_cache_dir=map_cache_dir, cache_gb=cache_gb, cache_dir=cache_dir, shard_dir=shard_dir, border_distance_transform=border_distance_transform)
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // WORLD_SIZE, batch_size if batch_size > 1 else 0, workers])  # number of workers
     if with_ann:
         collate_fn = db_val_collate_fn
     else:
         collate_fn = None
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=nw, collate_fn=collate_fn)
+    if rect:
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size, shuffle)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, pin_memory=True, num_workers=nw, collate_fn=collate_fn)
+    elif dataset.shards is not None and shuffle:
+        batch_sampler = ShardBatchSampler(dataset.shards.shard_ids, batch_size, nw)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, pin_memory=True, num_workers=nw, collate_fn=collate_fn)
+    else:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=nw, collate_fn=collate_fn)
     return dataset, loader
 
+def pack_db_shards(img_dir, ann_dir, out_dir, shard_mb=1024):
+    '''
+    pack images and their line annotations into shards for LoadImageAndAnnotations(shard_dir=out_dir),
+    images are copied as-is, annotations are parsed once and stored as .npy
+    '''
+    import io
+    dataset = LoadImageAndAnnotations(img_dir, ann_dir)
+    writer = ShardWriter(out_dir, shard_mb)
+    for imp, annp in tqdm(dataset.img_ann_list, desc='Packing shards'):
+        buf = io.BytesIO()
+        np.save(buf, np.loadtxt(annp))
+        with open(imp, 'rb') as f:
+            writer.add((imp, annp), img=f.read(), ann=buf.getvalue())
+    writer.close()
+    LOGGER.info(f'Packed {len(dataset)} samples into {len(writer.shards)} shards in {out_dir}')
+
 if __name__ == '__main__':
     img_dir = 'data/dataset/db_sub'
     hyp_p = r'data/train_db_hyp.yaml'
@@ -1,22 +1,22 @@
+# torch, the yolov5 model code and tqdm are imported where they are needed,
+# so the onnx (opencv) path starts without them
 import json
-from basemodel import TextDetBase, TextDetBaseDNN
+import math
 import os.path as osp
-from tqdm import tqdm
 import numpy as np
 import cv2
-import torch
 from pathlib import Path
-import torch
-from utils.yolov5_utils import non_max_suppression
 from utils.db_utils import SegDetectorRepresenter
 from utils.io_utils import imread, imwrite, find_all_imgs, NumpyEncoder
-from utils.imgproc_utils import letterbox, xyxy2yolo, get_yololabel_strings
+from utils.imgproc_utils import letterbox, letterbox_blob, xyxy2yolo, get_yololabel_strings, non_max_suppression_np
 from utils.textblock import TextBlock, group_output, visualize_textblocks
 from utils.textmask import refine_mask, refine_undetected_mask, REFINEMASK_INPAINT, REFINEMASK_ANNOTATION
 from pathlib import Path
 from typing import Union
 
 def model2annotations(model_path, img_dir_list, save_dir, save_json=False):
+    import torch
+    from tqdm import tqdm
     if isinstance(img_dir_list, str):
         img_dir_list = [img_dir_list]
     cuda = torch.cuda.is_available()
@@ -69,28 +69,29 @@ def model2annotations(model_path, img_dir_list, save_dir, save_json=False):
         imwrite(osp.join(save_dir, imgname), img)
         imwrite(osp.join(save_dir, maskname), mask_refined)
 
-def preprocess_img(img, input_size=(1024, 1024), device='cpu', bgr2rgb=True, half=False, to_tensor=True):
-    if bgr2rgb:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img_in, ratio, (dw, dh) = letterbox(img, new_shape=input_size, auto=False, stride=64)
+def preprocess_img(img, input_size=(1024, 1024), device='cpu', bgr2rgb=True, half=False, to_tensor=True, out=None):
     if to_tensor:
-        img_in = img_in.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img_in = np.array([np.ascontiguousarray(img_in)]).astype(np.float32) / 255
-        if to_tensor:
-            img_in = torch.from_numpy(img_in).to(device)
-            if half:
-                img_in = img_in.half()
+        # the network takes channels in img order when bgr2rgb, the old BGR2RGB + CHW flip cancelled out
+        img_in, ratio, (dw, dh) = letterbox_blob(img, new_shape=input_size, swap_rb=not bgr2rgb, out=out)
+        import torch
+        img_in = torch.from_numpy(img_in).to(device)
+        if half:
+            img_in = img_in.half()
+    else:
+        if bgr2rgb:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img_in, ratio, (dw, dh) = letterbox(img, new_shape=input_size, auto=False, stride=64)
     return img_in, ratio, int(dw), int(dh)
 
-def postprocess_mask(img: Union[torch.Tensor, np.ndarray], thresh=None):
+def postprocess_mask(img: Union['torch.Tensor', np.ndarray], thresh=None):
     # img = img.permute(1, 2, 0)
-    if isinstance(img, torch.Tensor):
+    if isinstance(img, np.ndarray):
+        img = img.squeeze()
+    else:
         img = img.squeeze_()
         if img.device != 'cpu':
             img = img.detach_().cpu()
         img = img.numpy()
-    else:
-        img = img.squeeze()
     if thresh is not None:
         img = img > thresh
     img = img * 255
@@ -99,10 +100,14 @@ def postprocess_mask(img: Union[torch.Tensor, np.ndarray], thresh=None):
     return img.astype(np.uint8)
 
 def postprocess_yolo(det, conf_thresh, nms_thresh, resize_ratio, sort_func=None):
-    det = non_max_suppression(det, conf_thresh, nms_thresh)[0]
-    # bbox = det[..., 0:4]
-    if det.device != 'cpu':
-        det = det.detach_().cpu().numpy()
+    if isinstance(det, np.ndarray):
+        det = non_max_suppression_np(det, conf_thresh, nms_thresh)[0]
+    else:
+        from utils.yolov5_utils import non_max_suppression
+        det = non_max_suppression(det, conf_thresh, nms_thresh)[0]
+        # bbox = det[..., 0:4]
+        if det.device != 'cpu':
+            det = det.detach_().cpu().numpy()
     det[..., [0, 2]] = det[..., [0, 2]] * resize_ratio[0]
     det[..., [1, 3]] = det[..., [1, 3]] * resize_ratio[1]
     if sort_func is not None:
@@ -113,56 +118,193 @@ def postprocess_yolo(det, conf_thresh, nms_thresh, resize_ratio, sort_func=None)
     cls = det[..., 5].astype(np.int32)
     return blines, cls, confs
 
+def sort_head_outputs(outs):
+    '''
+    map the outputs of an exported graph to (blks, mask, lines_map) by shape, 
+    heads left out of the graph are None. some versions of opencv don't keep the output order
+    '''
+    blks = mask = lines_map = None
+    for out in outs:
+        if out.ndim == 3:
+            blks = out
+        elif out.shape[1] == 1:
+            mask = out
+        else:
+            lines_map = out
+    return blks, mask, lines_map
+
+class TextDetBaseDNN:
+    def __init__(self, input_size, model_path, max_cached_nets=8):
+        self.input_size = input_size
+        self.model_path = model_path
+        # read once, nets for other input shapes are built from these bytes
+        self.model_bytes = np.fromfile(model_path, dtype=np.uint8)
+        self.model = cv2.dnn.readNetFromONNX(self.model_bytes)
+        self.uoln = self.model.getUnconnectedOutLayersNames()
+        # opencv re-plans the whole graph whenever the input shape changes,
+        # so models exported with dynamic=True get one net per input shape
+        self.input_hw = tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+        self.max_cached_nets = max_cached_nets
+        self.shape_nets = {}
+
+    def get_net(self, input_hw):
+        if input_hw == self.input_hw:
+            return self.model
+        net = self.shape_nets.pop(input_hw, None)
+        if net is None:
+            net = cv2.dnn.readNetFromONNX(self.model_bytes)
+            if len(self.shape_nets) >= self.max_cached_nets:
+                self.shape_nets.pop(next(iter(self.shape_nets)))    # least recently used
+        self.shape_nets[input_hw] = net
+        return net
+
+    def __call__(self, im_in):
+        if im_in.ndim == 4:     # already a blob
+            blob = im_in
+        else:
+            blob = cv2.dnn.blobFromImage(im_in, scalefactor=1 / 255.0, size=self.input_hw[::-1])
+        model = self.get_net(blob.shape[2:])
+        model.setInput(blob)
+        return sort_head_outputs(model.forward(self.uoln))
+
+class TextDetBaseORT:
+    '''
+    onnxruntime backend, used for the fp16/int8 models from utils/export.py 
+    which opencv dnn doesn't run reliably
+    '''
+    def __init__(self, model_path, num_threads=0):
+        import onnxruntime as ort
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = num_threads
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model = ort.InferenceSession(model_path, sess_options, providers=['CPUExecutionProvider'])
+        self.input_name = self.model.get_inputs()[0].name
+
+    def __call__(self, blob):
+        return sort_head_outputs(self.model.run(None, {self.input_name: blob}))
+
+PRECISION_LIST = ['fp32', 'fp16', 'int8']
+
+def quantized_model_path(model_path, precision):
+    '''
+    comic.onnx -> comic-int8.onnx, where utils/export.py saves the quantized models
+    '''
+    if precision == 'fp32':
+        return model_path
+    model_path = Path(model_path)
+    return str(model_path.with_name(model_path.stem + '-' + precision + model_path.suffix))
+
 class TextDetector:
     lang_list = ['eng', 'ja', 'unknown']
     langcls2idx = {'eng': 0, 'ja': 1, 'unknown': 2}
 
-    def __init__(self, model_path, input_size=1024, device='cpu', half=False, nms_thresh=0.35, conf_thresh=0.4, mask_thresh=0.3, act='leaky'):
+    def __init__(self, model_path, input_size=1024, device='cpu', half=False, nms_thresh=0.35, conf_thresh=0.4, mask_thresh=0.3, act='leaky', dynamic_input=False, precision='fp32', heads=('blk', 'seg', 'det'),
+                 fuse=False, channels_last=False, jit=None):
+        '''
+        fuse, channels_last, jit: torch backend only, fold bn into the convs of all heads, 
+            channels-last memory format, jit='trace' (torchscript, needs dynamic_input=False) or 'compile' (torch.compile)
+        heads: outputs to compute, 'blk' (block boxes), 'seg' (text mask) and 'det' (text lines). 
+            the torch backend skips the rest, onnx models only run what they were exported with (utils/export.py::export_heads).
+            without 'seg' the returned masks are None
+        precision: fp32, fp16 or int8, the latter two load the quantized model saved next to an onnx model_path
+            and run it with onnxruntime
+        dynamic_input: run each page at the smallest stride-64 aligned size that fits it at the scale of input_size 
+            instead of letterboxing to input_size, onnx models need to be exported with dynamic=True
+        '''
         super(TextDetector, self).__init__()
         cuda = device == 'cuda'
 
-        if Path(model_path).suffix == '.onnx':
-            self.model = cv2.dnn.readNetFromONNX(model_path)
+        assert precision in PRECISION_LIST, f'unknown precision {precision}'
+        if Path(model_path).suffix == '.onnx' and precision != 'fp32':
+            self.net = TextDetBaseORT(quantized_model_path(model_path, precision))
+            self.backend = 'onnxruntime'
+        elif Path(model_path).suffix == '.onnx':
             self.net = TextDetBaseDNN(input_size, model_path)
             self.backend = 'opencv'
         else:
-            self.net = TextDetBase(model_path, device=device, act=act)
+            from basemodel import TextDetBase, TextDetInference
+            self.net = TextDetBase(model_path, device=device, half=half, act=act, heads=heads)
             self.backend = 'torch'
         
         if isinstance(input_size, int):
             input_size = (input_size, input_size)
+        if self.backend == 'torch' and (fuse or channels_last or jit is not None):
+            assert jit != 'trace' or not dynamic_input, 'traced models only run at input_size'
+            self.net = TextDetInference(self.net, channels_last=channels_last, jit=jit, input_size=input_size)
         self.input_size = input_size
         self.device = device
         self.half = half
         self.conf_thresh = conf_thresh
         self.nms_thresh = nms_thresh
-        self.seg_rep = SegDetectorRepresenter(thresh=0.3)
+        self.seg_rep = SegDetectorRepresenter(thresh=0.3, box_thresh=0.6, min_size=2, filter_boxes=True)
+        self.num_pruned = 0     # text line contours of the last page dropped by score/size before unclip
+        self.dynamic_input = dynamic_input
+        self.heads = tuple(heads)
+        self.input_buffer = None    # preallocated, shared by all input sizes
 
-    @torch.no_grad()
     def __call__(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
-        img_in, ratio, dw, dh = preprocess_img(img, input_size=self.input_size, device=self.device, half=self.half, to_tensor=self.backend=='torch')
+        blk_list, page_mask = self.detect(img, refine_mode, keep_undetected_mask)
+        # refine first, refine_undetected_mask writes into the predicted mask
+        mask_refined = page_mask.mask_refined
+        return page_mask.mask, mask_refined, blk_list
+
+    def detect(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
+        '''
+        detection only, returns blk_list and a LazyTextMask, 
+        masks are not resized or refined unless they are accessed through it
+        '''
+        if self.backend == 'torch':
+            import torch
+            with torch.no_grad():
+                return self.detect_blocks(img, refine_mode, keep_undetected_mask)
+        return self.detect_blocks(img, refine_mode, keep_undetected_mask)
+
+    def get_input_size(self, im_h, im_w):
+        if not self.dynamic_input:
+            return self.input_size
+        r = min(self.input_size[0] / im_h, self.input_size[1] / im_w)
+        h = min(int(math.ceil(im_h * r / 64)) * 64, self.input_size[0])
+        w = min(int(math.ceil(im_w * r / 64)) * 64, self.input_size[1])
+        return (h, w)
+
+    def preprocess(self, img, input_size):
+        blob_size = 3 * input_size[0] * input_size[1]
+        if self.input_buffer is None or self.input_buffer.size < blob_size:
+            self.input_buffer = np.zeros(blob_size, dtype=np.float32)
+        blob = self.input_buffer[:blob_size].reshape(1, 3, input_size[0], input_size[1])
+        if self.backend == 'torch':
+            img_in, _, dw, dh = preprocess_img(img, input_size=input_size, device=self.device, half=self.half, out=blob)
+        else:
+            # same RGB input blobFromImage used to get from the letterboxed BGR2RGB image
+            img_in, _, (dw, dh) = letterbox_blob(img, new_shape=input_size, swap_rb=True, out=blob)
+        return img_in, dw, dh
+
+    def detect_blocks(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
         im_h, im_w = img.shape[:2]
+        input_size = self.get_input_size(im_h, im_w)
+        img_in, dw, dh = self.preprocess(img, input_size)
 
         blks, mask, lines_map = self.net(img_in)
+        # drop heads an onnx graph computes but weren't asked for
+        blks, mask, lines_map = [out if name in self.heads else None for out, name in zip((blks, mask, lines_map), ('blk', 'seg', 'det'))]
 
-        resize_ratio = (im_w / (self.input_size[0] - dw), im_h / (self.input_size[1] - dh))
-        blks = postprocess_yolo(blks, self.conf_thresh, self.nms_thresh, resize_ratio)
+        resize_ratio = (im_w / (input_size[1] - dw), im_h / (input_size[0] - dh))
+        if blks is not None:
+            blks = postprocess_yolo(blks, self.conf_thresh, self.nms_thresh, resize_ratio)
+        else:
+            blks = (np.zeros((0, 4), np.int32), np.zeros(0, np.int32), np.zeros(0))
 
-        if self.backend == 'opencv':
-            if mask.shape[1] == 2:     # some version of opencv spit out reversed result
-                tmp = mask
-                mask = lines_map
-                lines_map = tmp
-        mask = postprocess_mask(mask)
+        if mask is not None:
+            # map output to input img, the mask stays at network resolution until it is asked for
+            mask = postprocess_mask(mask)
+            mask = mask[: mask.shape[0]-dh, : mask.shape[1]-dw]
 
-        lines, scores = self.seg_rep(self.input_size, lines_map)
-        box_thresh = 0.6
-        idx = np.where(scores[0] > box_thresh)
-        lines, scores = lines[0][idx], scores[0][idx]
-        
-        # map output to input img
-        mask = mask[: mask.shape[0]-dh, : mask.shape[1]-dw]
-        mask = cv2.resize(mask, (im_w, im_h), interpolation=cv2.INTER_LINEAR)
+        if lines_map is not None:
+            lines, scores = self.seg_rep(input_size, lines_map)
+            lines, scores = lines[0], scores[0]
+            self.num_pruned = self.seg_rep.num_pruned[0]
+        else:
+            lines = np.zeros((0, 4, 2))
         if lines.size == 0 :
             lines = []
         else :
@@ -170,14 +312,43 @@ class TextDetector:
             lines[..., 0] *= resize_ratio[0]
             lines[..., 1] *= resize_ratio[1]
             lines = lines.astype(np.int32)
-        blk_list = group_output(blks, lines, im_w, im_h, mask)
-        mask_refined = refine_mask(img, mask, blk_list, refine_mode=refine_mode)
-        if keep_undetected_mask:
-            mask_refined = refine_undetected_mask(img, mask, mask_refined, blk_list, refine_mode=refine_mode)
-    
-        return mask, mask_refined, blk_list
+        blk_list = group_output(blks, lines, im_w, im_h, mask, mask_ratio=resize_ratio)
+        return blk_list, LazyTextMask(img, mask, blk_list, refine_mode, keep_undetected_mask)
+
+class LazyTextMask:
+    '''
+    predicted & refined text masks of one page, computed at original resolution on first access,
+    both are None if the detector didn't run the seg head
+    '''
+    def __init__(self, img, mask, blk_list, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
+        self.img = img
+        self.blk_list = blk_list
+        self.refine_mode = refine_mode
+        self.keep_undetected_mask = keep_undetected_mask
+        self._mask_net = mask
+        self._mask = None
+        self._mask_refined = None
+
+    @property
+    def mask(self) -> np.ndarray:
+        if self._mask is None and self._mask_net is not None:
+            im_h, im_w = self.img.shape[:2]
+            self._mask = cv2.resize(self._mask_net, (im_w, im_h), interpolation=cv2.INTER_LINEAR)
+            self._mask_net = None
+        return self._mask
+
+    @property
+    def mask_refined(self) -> np.ndarray:
+        if self._mask_refined is None and self.mask is not None:
+            mask = self.mask
+            mask_refined = refine_mask(self.img, mask, self.blk_list, refine_mode=self.refine_mode)
+            if self.keep_undetected_mask:
+                mask_refined = refine_undetected_mask(self.img, mask, mask_refined, self.blk_list, refine_mode=self.refine_mode)
+            self._mask_refined = mask_refined
+        return self._mask_refined
 
 def traverse_by_dict(img_dir_list, dict_dir):
+    from tqdm import tqdm
     if isinstance(img_dir_list, str):
         img_dir_list = [img_dir_list]
     imglist = []
@@ -227,5 +398,5 @@ def inference(
         act="leaky"
     )
 
-    _, _, blk_list = detector(img)
+    blk_list, _ = detector.detect(img)
     return blk_list
\ No newline at end of file
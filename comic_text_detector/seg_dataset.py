@@ -28,7 +28,7 @@ import random
 from torch.utils.data import DataLoader, Dataset
 from utils.general import LOGGER, Loggers, CUDA, DEVICE
 from utils.imgproc_utils import resize_keepasp, letterbox
-from utils.io_utils import imread, imwrite
+from utils.io_utils import imread, imwrite, MmapImageCache, ShardReader, ShardWriter
 
 WORLD_SIZE = int(os.getenv('WORLD_SIZE', 1))  # DPP
 NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of multiprocessing threads
@@ -54,12 +54,12 @@ def load_image_mask(self, i, max_size=None):
     img, mask = self.imgs[i], self.masks[i]
     imp, maskp = self.img_mask_list[i]
     if img is None:
-        img = cv2.imread(imp)
+        img = self.read_img(i)
     if mask is None:
-        mask = cv2.imread(maskp, cv2.IMREAD_GRAYSCALE)
+        mask = self.read_mask(i)
     if max_size is not None:
         if isinstance(max_size, tuple):
-            max_size = max_size[0]
+            max_size = max(max_size)
         try:
             img = resize_keepasp(img, max_size)
             mask = resize_keepasp(mask, max_size, interpolation=cv2.INTER_AREA)
@@ -88,7 +88,7 @@ def mini_mosaic(self, img, mask):
     return img, mask
 
 class LoadImageAndMask(Dataset):
-    def __init__(self, img_dir, mask_dir=None, img_size=640, augment=False, aug_param=None, cache=False, stride=128, cache_mask_only=True):
+    def __init__(self, img_dir, mask_dir=None, img_size=640, augment=False, aug_param=None, cache=False, stride=128, cache_mask_only=True, cache_gb=7, cache_dir=None, shard_dir=None, batch_augment=False):
         if isinstance(img_dir, str):
             self.img_dir = [img_dir]
         elif isinstance(img_dir, list):
@@ -108,6 +108,7 @@ class LoadImageAndMask(Dataset):
         self.img_size = (img_size, img_size)
         self.stride = stride
         self._augment = augment
+        self.batch_augment = batch_augment  # hsv/flip/neg and float conversion are left to BatchAugment
         if self._augment:
             self._mini_mosaic = aug_param['mini_mosaic']
             self._augment_hsv = aug_param['hsv']
@@ -122,37 +123,49 @@ class LoadImageAndMask(Dataset):
             else:
                 self.valid_size = None
                 self.multi_size = False
-        for img_dir in self.img_dir:
-            for filep in glob.glob(osp.join(img_dir, "*")):
-                filename = osp.basename(filep)
-                file_suffix = Path(filename).suffix
-                if file_suffix.lower() not in IMG_EXT:
-                    continue
-                maskname = 'mask-' + filename.replace(file_suffix, '.png')
-                for mask_dir in self.mask_dir:
-                    maskp = osp.join(mask_dir, maskname)
-                    if osp.exists(maskp):
-                        self.img_mask_list.append((filep, maskp))
+        self.shards = None
+        if shard_dir:
+            # samples packed by pack_seg_shards, no directory listing or small-file reads
+            self.shards = ShardReader(shard_dir)
+            self.img_mask_list = [self.shards.keys(i) for i in range(len(self.shards))]
+        else:
+            for img_dir in self.img_dir:
+                for filep in glob.glob(osp.join(img_dir, "*")):
+                    filename = osp.basename(filep)
+                    file_suffix = Path(filename).suffix
+                    if file_suffix.lower() not in IMG_EXT:
+                        continue
+                    maskname = 'mask-' + filename.replace(file_suffix, '.png')
+                    for mask_dir in self.mask_dir:
+                        maskp = osp.join(mask_dir, maskname)
+                        if osp.exists(maskp):
+                            self.img_mask_list.append((filep, maskp))
         self._img_transform = transforms.Compose([transforms.ToTensor()])
         self._mask_transform = transforms.Compose([transforms.ToTensor()])
 
         n = len(self.img_mask_list)
         self.imgs, self.masks = [None] * n, [None] * n
-        gb = 0
         if cache:
-            results = ThreadPool(NUM_THREADS).imap(lambda x: load_image_mask(*x, max_size=img_size), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                im, self.masks[i] = x  # im, hw_orig, hw_resized = load_image_mask(self, i)
-                if not cache_mask_only:
-                    self.imgs[i] = im
-                    gb += self.imgs[i].nbytes
-                gb += self.masks[i].nbytes
-                if gb / 1E9 > 7:
-                    break
-                pbar.desc = f'Caching images ({gb / 1E9:.1f}GB )'
-            pbar.close()
+            # pre-resized images in one memory-mapped file, shared by all dataloader workers
+            cache_path = osp.join(cache_dir or self.img_dir[0], f'.seg_cache_{img_size}')
+            self.masks = MmapImageCache.open_or_build(cache_path + '_mask', [maskp for _, maskp in self.img_mask_list],
+                                                      lambda i: resize_keepasp(self.read_mask(i), img_size, interpolation=cv2.INTER_AREA),
+                                                      cache_gb, NUM_THREADS)
+            if not cache_mask_only:
+                self.imgs = MmapImageCache.open_or_build(cache_path + '_img', [imp for imp, _ in self.img_mask_list],
+                                                         lambda i: resize_keepasp(self.read_img(i), img_size),
+                                                         cache_gb - self.masks.nbytes / 1E9, NUM_THREADS)
         
+    def read_img(self, i):
+        if self.shards is not None:
+            return self.shards.read_img(i)
+        return cv2.imread(self.img_mask_list[i][0])
+
+    def read_mask(self, i):
+        if self.shards is not None:
+            return self.shards.read_img(i, 'mask', cv2.IMREAD_GRAYSCALE)
+        return cv2.imread(self.img_mask_list[i][1], cv2.IMREAD_GRAYSCALE)
+
     def initialize(self):
         if self.augment:
             if self.multi_size:
@@ -167,14 +180,19 @@ class LoadImageAndMask(Dataset):
         mask = self._mask_transform(mask)
         return img, mask
 
-    def augment(self, img, mask):
+    def augment(self, img, mask, img_size=None):
+        if img_size is None:
+            img_size = self.img_size
         im_h, im_w = img.shape[0], img.shape[1]
-        if im_h > im_w and random.random() < self._mini_mosaic:
+        # mosaic widens tall pages, which only pays off for square inputs
+        if im_h > im_w and not is_rect(img_size) and random.random() < self._mini_mosaic:
             # imp2, maskp2 = random.choice(self.img_mask_list)
             img, mask = mini_mosaic(self, img, mask)
 
-        img, ratio, (dw, dh) = letterbox(img, new_shape=self.img_size, auto=False)
-        mask, ratio, (dw, dh) = letterbox(mask, new_shape=self.img_size, auto=False)
+        img, ratio, (dw, dh) = letterbox(img, new_shape=img_size, auto=False)
+        mask, ratio, (dw, dh) = letterbox(mask, new_shape=img_size, auto=False)
+        if self.batch_augment:
+            return img, mask
 
         if random.random() < self._augment_hsv:
             augment_hsv(img)
@@ -194,22 +212,250 @@ class LoadImageAndMask(Dataset):
     def __len__(self):
         return len(self.img_mask_list)
 
+    def aspect_ratios(self):
+        return read_aspect_ratios([imp for imp, _ in self.img_mask_list], self.shards)
+
     def __getitem__(self, idx):
-        img, mask = load_image_mask(self, idx, self.img_size)
+        img_size = self.img_size
+        if isinstance(idx, tuple):
+            idx, img_size = idx  # (h, w) from AspectRatioBatchSampler
+        img, mask = load_image_mask(self, idx, img_size)
         if self._augment:
-            img, mask = self.augment(img, mask)
+            img, mask = self.augment(img, mask, img_size)
         else:
-            img, ratio, (dw, dh) = letterbox(img, new_shape=self.img_size, auto=False)
-            mask, ratio, (dw, dh) = letterbox(mask, new_shape=self.img_size, auto=False)
+            img, ratio, (dw, dh) = letterbox(img, new_shape=img_size, auto=False)
+            mask, ratio, (dw, dh) = letterbox(mask, new_shape=img_size, auto=False)
+        if self.batch_augment:
+            return torch.from_numpy(img), torch.from_numpy(mask)
         return self.transform(img, mask)
 
-def create_dataloader(img_dir, mask_dir, imgsz, batch_size, augment=False, aug_param=None, cache=False, workers=8, shuffle=False):
-    dataset = LoadImageAndMask(img_dir, mask_dir, imgsz, augment, aug_param, cache)
+def bgr2hsv_u8(imgs: torch.Tensor):
+    # uint8 (..., 3) bgr -> long (..., 3) hsv like cv2.COLOR_BGR2HSV: h in [0, 180), s and v in [0, 255],
+    # with opencv's fixed point division tables so the result is identical
+    hsv_shift, half = 12, 1 << 11
+    x = torch.arange(256, device=imgs.device, dtype=torch.float64).clamp(min=1)
+    sdiv_table = torch.round((255 << hsv_shift) / x).long()
+    hdiv_table = torch.round((180 << hsv_shift) / (6 * x)).long()
+    sdiv_table[0] = hdiv_table[0] = 0
+    imgs = imgs.long()
+    b, g, r = imgs.unbind(-1)
+    v, vmin = imgs.amax(-1), imgs.amin(-1)
+    diff = v - vmin
+    s = (diff * sdiv_table[v] + half) >> hsv_shift
+    h = torch.where(v == r, g - b, torch.where(v == g, b - r + 2 * diff, r - g + 4 * diff))
+    h = (h * hdiv_table[diff] + half) >> hsv_shift
+    h = torch.where(h < 0, h + 180, h)
+    return torch.stack((h, s, v), -1)
+
+def hsv2bgr_u8(hsv: torch.Tensor):
+    # long (..., 3) hsv in opencv's 8-bit ranges -> uint8 (..., 3) bgr like cv2.COLOR_HSV2BGR,
+    # truncated as its vectorized path does, off by one level for a few pixels where float32 rounding differs
+    h, s, v = (hsv.float() * hsv.new_tensor([6 / 180, 1 / 255, 1 / 255], dtype=torch.float32)).unbind(-1)
+    i = torch.floor(h)
+    f = h - i
+    i = i.long().remainder(6).unsqueeze(-1)
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    r = torch.stack((v, q, p, p, t, v), -1).gather(-1, i)
+    g = torch.stack((t, v, v, q, p, p), -1).gather(-1, i)
+    b = torch.stack((p, p, t, v, v, q), -1).gather(-1, i)
+    return (torch.cat((b, g, r), -1) * 255).clamp_(0, 255).to(torch.uint8)
+
+def augment_hsv_batch(imgs: torch.Tensor, hgain=0.5, sgain=0.5, vgain=0.5, gains=None):
+    '''
+    augment_hsv on a uint8 (B, H, W, 3) bgr batch, every image gets its own random gains (B, 3) unless given.
+    same 8-bit hsv and 256-entry tables as augment_hsv, each channel is looked up with one gather
+    '''
+    if gains is None:
+        gains = (torch.rand(imgs.shape[0], 3, device=imgs.device, dtype=torch.float64) * 2 - 1) * imgs.new_tensor([hgain, sgain, vgain], dtype=torch.float64) + 1
+    x = torch.arange(256, device=imgs.device, dtype=torch.float64)
+    lut = x * gains.to(imgs.device, torch.float64).unsqueeze(-1)    # (B, 3, 256)
+    lut = torch.stack((lut[:, 0] % 180, lut[:, 1].clamp(0, 255), lut[:, 2].clamp(0, 255)), 1).long()
+    b, h, w, _ = imgs.shape
+    hsv = bgr2hsv_u8(imgs).view(b, h * w, 3).transpose(1, 2)
+    hsv = lut.gather(2, hsv).transpose(1, 2).view(b, h, w, 3)
+    return hsv2bgr_u8(hsv)
+
+class BatchAugment:
+    '''
+    hsv/flip/negation and float conversion for whole uint8 batches from LoadImageAndMask(batch_augment=True),
+    run on device after collation so dataloader workers only decode and letterbox.
+    aug_param=None only converts, same output as LoadImageAndMask.transform
+    '''
+    def __init__(self, aug_param=None, device=DEVICE):
+        self.aug_param = aug_param
+        self.device = device
+
+    def __call__(self, imgs: torch.Tensor, masks: torch.Tensor):
+        # (B, H, W, 3) bgr, (B, H, W) uint8 -> (B, 3, H, W) rgb, (B, 1, H, W) float
+        imgs = imgs.to(self.device, non_blocking=True)
+        masks = (masks.to(self.device, non_blocking=True) > 30).float().unsqueeze(1)
+        if self.aug_param is not None:
+            b = imgs.shape[0]
+            hsv = torch.rand(b, device=self.device) < self.aug_param['hsv']
+            if hsv.any():
+                imgs[hsv] = augment_hsv_batch(imgs[hsv])
+        imgs = imgs.flip(-1).permute(0, 3, 1, 2).float().div_(255)
+        if self.aug_param is not None:
+            flip = torch.rand(b, device=self.device) < self.aug_param['flip_lr']
+            if flip.any():
+                imgs[flip] = imgs[flip].flip(-1)
+                masks[flip] = masks[flip].flip(-1)
+            neg = torch.rand(b, device=self.device) < self.aug_param['neg']
+            if neg.any():
+                imgs[neg] = 1 - imgs[neg]
+        return imgs.contiguous(), masks
+
+def is_rect(img_size):
+    return isinstance(img_size, tuple) and img_size[0] != img_size[1]
+
+def read_aspect_ratios(img_paths, shards=None):
+    # h / w of every image from its header, without decoding
+    import io
+    from PIL import Image
+    def read(i):
+        src = img_paths[i] if shards is None else io.BytesIO(shards.read(i, 'img').tobytes())
+        with Image.open(src) as im:
+            w, h = im.size
+        return h / w
+    with ThreadPool(NUM_THREADS) as pool:
+        return np.array(pool.map(read, range(len(img_paths))), dtype=np.float64)
+
+def letterbox_padding_ratio(aspect_ratios):
+    # padded share of the pixels when every image is letterboxed to a square, as without AspectRatioBatchSampler
+    return float(np.mean(1 - np.minimum(aspect_ratios, 1 / aspect_ratios))) if len(aspect_ratios) else 0.
+
+class AspectRatioBatchSampler:
+    '''
+    groups images into buckets of similar aspect ratio and yields every batch as (idx, (h, w)) pairs,
+    (h, w) being a stride-aligned rectangle whose long side is the dataset's current img_size, so tall pages aren't mostly padding.
+    the shape is computed when the batch is drawn in the main process, so multi-size changes from initialize() apply immediately.
+    padding_ratio: fraction of padded pixels in the batches drawn so far this epoch
+    '''
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.stride = dataset.stride
+        self.aspect_ratios = dataset.aspect_ratios()
+        base_size = self.size()
+        short = np.minimum(self.aspect_ratios, 1 / self.aspect_ratios)
+        num_strides = np.clip(np.ceil(short * base_size / self.stride), 1, base_size // self.stride)
+        keys = num_strides * 2 + (self.aspect_ratios > 1)
+        self.buckets = []  # (tall, short / long side ratio, indices)
+        for key in np.unique(keys):
+            indices = np.flatnonzero(keys == key)
+            self.buckets.append((bool(key % 2), num_strides[indices[0]] * self.stride / base_size, indices))
+        self.num_pixels = self.num_padding = 0
+
+    def size(self):
+        img_size = self.dataset.img_size
+        return int(img_size[0] if isinstance(img_size, tuple) else img_size)
+
+    def batch_shape(self, tall, short_ratio):
+        size = self.size()
+        short = min(size, int(np.ceil(size * short_ratio / self.stride)) * self.stride)
+        return (size, short) if tall else (short, size)
+
+    @property
+    def padding_ratio(self):
+        return self.num_padding / max(self.num_pixels, 1)
+
+    def __iter__(self):
+        batches = []
+        for tall, short_ratio, indices in self.buckets:
+            if self.shuffle:
+                indices = np.random.permutation(indices)
+            for i in range(0, len(indices), self.batch_size):
+                if self.drop_last and i + self.batch_size > len(indices):
+                    break
+                batches.append((tall, short_ratio, indices[i: i + self.batch_size]))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        self.num_pixels = self.num_padding = 0
+        for tall, short_ratio, batch in batches:
+            h, w = self.batch_shape(tall, short_ratio)
+            ar = self.aspect_ratios[batch]
+            fill = np.minimum(h / w / ar, ar * w / h)  # letterboxed content / canvas
+            self.num_pixels += h * w * len(batch)
+            self.num_padding += h * w * float(np.sum(1 - fill))
+            yield [(int(i), (h, w)) for i in batch]
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for _, _, indices in self.buckets)
+        return sum(-(-len(indices) // self.batch_size) for _, _, indices in self.buckets)
+
+class ShardBatchSampler:
+    '''
+    batch sampler for shard-backed datasets: samples are ordered shard by shard (shuffled within), cut into batches
+    and the batches split into one contiguous run per dataloader worker, differing in length by at most one batch. 
+    runs are interleaved in the round-robin order the DataLoader dispatches batches, 
+    so every worker streams through its own shards sequentially instead of seeking all over every shard
+    '''
+    def __init__(self, shard_ids, batch_size, num_workers=0, shuffle=True, drop_last=False):
+        self.shard_ids = np.asarray(shard_ids)
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.shards = np.unique(self.shard_ids)
+
+    def batches(self):
+        shards = np.random.permutation(self.shards) if self.shuffle else self.shards
+        indices = []
+        for shard in shards:
+            idx = np.flatnonzero(self.shard_ids == shard)
+            if self.shuffle:
+                np.random.shuffle(idx)
+            indices.append(idx)
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        batches = [indices[i: i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        # the first r runs get one batch more, so the last round only goes to workers 0..r-1 
+        # and the cyclic dispatch stays aligned with the runs until the end
+        q, r = divmod(len(batches), self.num_workers)
+        starts = [w * q + min(w, r) for w in range(self.num_workers)]
+        for k in range(q + (r > 0)):
+            for w in range(self.num_workers if k < q else r):
+                yield batches[starts[w] + k]
+
+    def __len__(self):
+        n = len(self.shard_ids)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+def create_dataloader(img_dir, mask_dir, imgsz, batch_size, augment=False, aug_param=None, cache=False, workers=8, shuffle=False, cache_mask_only=True, cache_gb=7, cache_dir=None, shard_dir=None, batch_augment=False, rect=False):
+    dataset = LoadImageAndMask(img_dir, mask_dir, imgsz, augment, aug_param, cache, cache_mask_only=cache_mask_only, cache_gb=cache_gb, cache_dir=cache_dir, shard_dir=shard_dir, batch_augment=batch_augment)
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // WORLD_SIZE, batch_size if batch_size > 1 else 0, workers])  # number of workers
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=nw)
+    if rect:
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size, shuffle)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, pin_memory=True, num_workers=nw)
+    elif dataset.shards is not None and shuffle:
+        batch_sampler = ShardBatchSampler(dataset.shards.shard_ids, batch_size, nw)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, pin_memory=True, num_workers=nw)
+    else:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=nw)
     return dataset, loader
 
+def pack_seg_shards(img_dir, mask_dir, out_dir, shard_mb=1024):
+    '''
+    pack image/mask pairs into shards for LoadImageAndMask(shard_dir=out_dir), files are copied as-is (no re-encoding)
+    '''
+    dataset = LoadImageAndMask(img_dir, mask_dir)
+    writer = ShardWriter(out_dir, shard_mb)
+    for imp, maskp in tqdm(dataset.img_mask_list, desc='Packing shards'):
+        with open(imp, 'rb') as f_img, open(maskp, 'rb') as f_mask:
+            writer.add((imp, maskp), img=f_img.read(), mask=f_mask.read())
+    writer.close()
+    LOGGER.info(f'Packed {len(dataset)} samples into {len(writer.shards)} shards in {out_dir}')
+
+
 if __name__ == '__main__':
     random.seed(42)
     torch.random.manual_seed(42)
@@ -0,0 +1,42 @@
+'''
+per-sample timing of MakeBorderMap with and without distance_transform, and how far both threshold maps are
+from the ones of exact point-to-segment distances:
+    python tests/bench_border_map.py --num-samples 20 --size 1024 --num-lines 40
+'''
+import argparse
+import sys
+import time
+import os.path as osp
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+import numpy as np
+
+from utils.db_utils import MakeBorderMap
+from test_db_utils import synthetic_border_sample, ExactBorderMap
+
+
+def time_border_map(make_border_map, samples):
+    outputs, times = [], []
+    for sample in samples:
+        sample = {k: np.copy(v) for k, v in sample.items()}
+        t0 = time.perf_counter()
+        outputs.append(make_border_map(sample))
+        times.append(time.perf_counter() - t0)
+    return outputs, np.array(times) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-samples', type=int, default=20)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--num-lines', type=int, default=40)
+    args = parser.parse_args()
+
+    samples = [synthetic_border_sample(seed, args.size, args.num_lines) for seed in range(args.num_samples)]
+    exact = [ExactBorderMap()({k: np.copy(v) for k, v in sample.items()}) for sample in samples]
+    for name, make_border_map in (('per-edge distances', MakeBorderMap()), ('distance transform', MakeBorderMap(distance_transform=True))):
+        outputs, ms = time_border_map(make_border_map, samples)
+        diff = np.concatenate([np.abs(o['threshold_map'] - e['threshold_map'])[e['threshold_mask'] > 0] for o, e in zip(outputs, exact)])
+        mask_equal = all(np.array_equal(o['threshold_mask'], e['threshold_mask']) for o, e in zip(outputs, exact))
+        print(f'{name}: {ms.mean():.1f} ms/sample, threshold mask exact: {mask_equal}, '
+              f'threshold map abs error: mean {diff.mean():.4f}, p99 {np.percentile(diff, 99):.4f}, max {diff.max():.4f}')
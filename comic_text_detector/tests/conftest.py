@@ -0,0 +1,5 @@
+import sys
+import os.path as osp
+
+# modules in this repo import each other from the comic_text_detector directory (`from utils.xxx import ...`)
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
@@ -0,0 +1,133 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from db_dataset import LoadImageAndAnnotations, precompute_db_maps, db_map_cache_root, pack_db_shards
+from utils.io_utils import ShardReader
+from utils.imgproc_utils import letterbox, rotation_matrix
+
+
+def write_db_samples(img_dir, n=3, seed=0):
+    # pages with a few rotated text lines and their line-<name>.txt annotations in absolute coordinates
+    rng = np.random.default_rng(seed)
+    for ii in range(n):
+        h, w = rng.integers(300, 500, 2)
+        img = np.full((h, w, 3), 255, np.uint8)
+        lines = []
+        for _ in range(4):
+            rect = ((rng.uniform(60, w - 60), rng.uniform(40, h - 40)), (rng.uniform(30, 100), rng.uniform(10, 30)), rng.uniform(-30, 30))
+            pts = cv2.boxPoints(rect)
+            cv2.fillPoly(img, [pts.astype(np.int32)], (0, 0, 0))
+            lines.append(pts.reshape(-1))
+        cv2.imwrite(str(img_dir / f'{ii}.png'), img)
+        np.savetxt(str(img_dir / f'line-{ii}.txt'), np.array(lines), fmt='%.2f')
+
+
+def test_map_cache_round_trip(tmp_path):
+    img_dir, cache_dir = tmp_path / 'imgs', str(tmp_path / 'maps')
+    img_dir.mkdir()
+    write_db_samples(img_dir)
+    reference = LoadImageAndAnnotations(str(img_dir), img_size=256)
+    cached = LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir)   # builds the cache
+    assert cached.map_cache is not None
+    for ii in range(len(reference)):
+        ref, out = reference[ii], cached[ii]
+        assert out.keys() == ref.keys()
+        np.testing.assert_array_equal(out['imgs'], ref['imgs'])
+        for key in ('shrink_map', 'shrink_mask', 'threshold_mask'):
+            np.testing.assert_array_equal(out[key], ref[key])
+        # stored as float16
+        np.testing.assert_allclose(out['threshold_map'], ref['threshold_map'], atol=2.5e-4, rtol=0)
+
+
+def test_map_cache_reused_and_rebuilt(tmp_path):
+    img_dir, cache_dir = tmp_path / 'imgs', str(tmp_path / 'maps')
+    img_dir.mkdir()
+    write_db_samples(img_dir)
+    precompute_db_maps(str(img_dir), None, 256, cache_dir)
+    dataset = LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir)
+    index_path = os.path.join(db_map_cache_root(cache_dir, dataset.img_size, dataset.img_ann_list), 'index.json')
+    built = os.path.getmtime(index_path)
+    LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir)
+    assert os.path.getmtime(index_path) == built
+
+    # an edited annotation invalidates the maps
+    ann = np.loadtxt(str(img_dir / 'line-0.txt'))
+    np.savetxt(str(img_dir / 'line-0.txt'), ann[:2], fmt='%.2f')
+    os.utime(str(img_dir / 'line-0.txt'), (built + 1e-3, built + 1e-3))   # whatever the filesystem's timestamp resolution
+    dataset = LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir)
+    assert os.path.getmtime(index_path) > built
+    idx = [imp for imp, _ in dataset.img_ann_list].index(str(img_dir / '0.png'))
+    assert len(dataset.map_cache[str(img_dir / '0.png')]['text_polys']) == 2
+    assert dataset[idx]['shrink_map'].max() == 1
+
+
+def test_border_distance_transform_option(tmp_path):
+    img_dir, cache_dir = tmp_path / 'imgs', str(tmp_path / 'maps')
+    img_dir.mkdir()
+    write_db_samples(img_dir, n=1)
+    exact = LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir)
+    fast = LoadImageAndAnnotations(str(img_dir), img_size=256, map_cache_dir=cache_dir, border_distance_transform=True)
+    assert fast.make_border_map.distance_transform and not exact.make_border_map.distance_transform
+    # separate caches, maps of one method are never served for the other
+    assert fast.map_cache.root != exact.map_cache.root
+    assert not np.array_equal(fast[0]['threshold_map'], exact[0]['threshold_map'])
+
+
+@pytest.mark.parametrize('degrees, new_shape', [(30, (256, 256)), (-75, (256, 320)), (120, (320, 192))])
+def test_rotate_into_letterbox(tmp_path, degrees, new_shape):
+    img_dir = tmp_path / 'imgs'
+    img_dir.mkdir()
+    write_db_samples(img_dir, n=1)
+    dataset = LoadImageAndAnnotations(str(img_dir), img_size=256)
+
+    im_h, im_w = 300, 420
+    img = np.full((im_h, im_w, 3), 128, np.uint8)
+    quad = np.array([[100, 80], [260, 110], [240, 190], [90, 150]], np.float32)
+    cv2.fillPoly(img, [quad.astype(np.int32)], (255, 255, 255))
+    ann = (quad / np.array([im_w, im_h]))[None]
+    rotated, rotated_ann = dataset.rotate(img, ann, degrees, new_shape)
+
+    # same size and bottom/right padding as letterboxing the expanded rotation
+    M, dsize, _ = rotation_matrix((im_h, im_w), degrees)
+    expanded = cv2.warpAffine(img, M, dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    boxed, _, (dw, dh) = letterbox(expanded, new_shape=new_shape, auto=False)
+    assert rotated.shape == boxed.shape == (*new_shape, 3)
+    assert rotation_matrix((im_h, im_w), degrees, new_shape)[2] == (dw, dh)
+    content = np.argwhere(rotated.max(axis=2) > 0)
+    assert abs(content[:, 0].max() + 1 - (new_shape[0] - dh)) <= 1
+    assert abs(content[:, 1].max() + 1 - (new_shape[1] - dw)) <= 1
+
+    # the warped quad still covers the drawn pixels
+    poly_mask = np.zeros(new_shape, np.uint8)
+    cv2.fillPoly(poly_mask, [np.round(rotated_ann[0]).astype(np.int32)], 1)
+    drawn = rotated.min(axis=2) > 200
+    assert drawn.sum() > 0.9 * poly_mask.sum()
+    assert not (drawn & (cv2.dilate(poly_mask, np.ones((5, 5), np.uint8)) == 0)).any()
+
+
+def test_pack_db_shards_round_trip(tmp_path):
+    img_dir, shard_dir = tmp_path / 'imgs', str(tmp_path / 'shards')
+    img_dir.mkdir()
+    write_db_samples(img_dir)
+    pack_db_shards(str(img_dir), None, shard_dir, shard_mb=1E-6)    # one sample per shard
+
+    reader = ShardReader(shard_dir)
+    reference = LoadImageAndAnnotations(str(img_dir), img_size=256)
+    assert len(reader.shards) == len(reference)
+    assert [reader.keys(i) for i in range(len(reader))] == reference.img_ann_list
+    for i, (imp, annp) in enumerate(reference.img_ann_list):
+        with open(imp, 'rb') as f:
+            assert reader.read(i, 'img').tobytes() == f.read()
+        np.testing.assert_array_equal(reader.read_array(i, 'ann'), np.loadtxt(annp))
+
+    packed = LoadImageAndAnnotations(str(img_dir), img_size=256, shard_dir=shard_dir)
+    for i in range(len(reference)):
+        sample, ref = packed[i], reference[i]
+        assert sample.keys() == ref.keys()
+        for k in ref:
+            np.testing.assert_array_equal(np.asarray(sample[k]), np.asarray(ref[k]))
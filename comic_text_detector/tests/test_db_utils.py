@@ -0,0 +1,189 @@
+import cv2
+import numpy as np
+
+from utils.db_utils import SegDetectorRepresenter, QuadMetric, MakeBorderMap
+
+
+def synthetic_lines_map(seed=0, size=512):
+    # blurred rotated text lines plus a ring with a line inside its hole (text in an enclosing stroke)
+    rng = np.random.default_rng(seed)
+    canvas = np.zeros((size, size), dtype=np.float32)
+    for _ in range(25):
+        rect = ((rng.uniform(30, size - 30), rng.uniform(30, size - 30)), (rng.uniform(8, 80), rng.uniform(4, 14)), rng.uniform(-90, 90))
+        cv2.fillPoly(canvas, [cv2.boxPoints(rect).astype(np.int32)], float(rng.uniform(0.5, 1)))
+    cv2.circle(canvas, (size // 2, size // 2), 60, 0.9, thickness=8)
+    cv2.rectangle(canvas, (size // 2 - 30, size // 2 - 5), (size // 2 + 30, size // 2 + 5), 0.8, thickness=-1)
+    canvas = cv2.GaussianBlur(canvas, (7, 7), 0)
+    return np.clip(canvas + rng.normal(0, 0.05, canvas.shape).astype(np.float32), 0, 1)
+
+
+def synthetic_border_sample(seed=0, size=1024, num_lines=40):
+    # rotated text line quads like the line annotations MakeBorderMap gets in db_dataset, some crossing the border
+    rng = np.random.default_rng(seed)
+    rects = [((rng.uniform(0, size), rng.uniform(0, size)), (rng.uniform(20, 300), rng.uniform(10, 60)), rng.uniform(-90, 90)) for _ in range(num_lines)]
+    text_polys = np.stack([cv2.boxPoints(rect) for rect in rects]).astype(np.float64)
+    return {'imgs': np.zeros((size, size, 3), np.uint8), 'text_polys': text_polys, 'ignore_tags': [False] * num_lines}
+
+
+def reference_boxes(rep, pred, bitmap):
+    # the per-contour path boxes_from_bitmap replaced, restricted to outer contours
+    contours, hierarchy = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    parent = hierarchy[0, :, 3]
+    boxes, scores = [], []
+    for ii, contour in enumerate(contours):
+        depth, p = 0, parent[ii]
+        while p >= 0:
+            depth, p = depth + 1, parent[p]
+        if depth % 2 == 1:
+            continue
+        contour = contour.squeeze(1)
+        points, sside = rep.get_mini_boxes(contour)
+        if sside < 2:
+            continue
+        score = rep.box_score_fast(pred, contour)
+        box, _ = rep.get_mini_boxes(rep.unclip(np.array(points), unclip_ratio=rep.unclip_ratio).reshape(-1, 1, 2))
+        box = np.array(box)
+        box[:, 0] = np.clip(np.round(box[:, 0]), 0, pred.shape[1])
+        box[:, 1] = np.clip(np.round(box[:, 1]), 0, pred.shape[0])
+        boxes.append(box)
+        scores.append(score)
+    return np.array(boxes).reshape(-1, 4, 2), np.array(scores)
+
+
+def match(boxes, ref_boxes):
+    # index of the closest reference box for every box, corners are compared as point sets
+    # since get_mini_boxes may start a box at either corner of a 45 degree edge
+    diff = np.abs(boxes[:, None, :, None].astype(np.float64) - ref_boxes[None, :, None]).max(axis=-1)
+    dist = np.maximum(diff.min(axis=3).max(axis=2), diff.min(axis=2).max(axis=2))
+    return dist.argmin(axis=1), dist.min(axis=1)
+
+
+def test_boxes_from_bitmap_matches_per_contour_path():
+    rep = SegDetectorRepresenter(thresh=0.3)
+    for seed in range(3):
+        pred = synthetic_lines_map(seed)
+        bitmap = pred > rep.thresh
+        h, w = pred.shape
+        boxes, scores = rep.boxes_from_bitmap(pred, bitmap, w, h)
+        ref_boxes, ref_scores = reference_boxes(rep, pred, bitmap)
+        assert len(boxes) == len(ref_boxes)
+        idx, dist = match(boxes, ref_boxes)
+        assert len(set(idx.tolist())) == len(idx)
+        assert dist.max() <= 2
+        np.testing.assert_allclose(scores, ref_scores[idx], atol=1e-5)
+
+
+def test_line_inside_ring_is_kept():
+    rep = SegDetectorRepresenter(thresh=0.3)
+    pred = np.zeros((200, 200), dtype=np.float32)
+    cv2.circle(pred, (100, 100), 70, 1., thickness=6)
+    cv2.rectangle(pred, (70, 95), (130, 105), 1., thickness=-1)
+    boxes, scores = rep.boxes_from_bitmap(pred, pred > rep.thresh, 200, 200)
+    assert len(boxes) == 2
+    inner = np.argmin(np.ptp(boxes[:, :, 1], axis=1))
+    assert boxes[inner, :, 0].min() >= 60 and boxes[inner, :, 0].max() <= 140
+    assert scores[inner] == 1
+    # the ring is scored over its filled contour, hole included, like box_score_fast
+    ring = cv2.findContours((pred > rep.thresh).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0][0]
+    assert abs(scores[1 - inner] - rep.box_score_fast(pred, ring.squeeze(1))) < 1e-6
+
+
+def test_filter_boxes_prunes_before_unclip():
+    pred = synthetic_lines_map(1)
+    h, w = pred.shape
+    rep = SegDetectorRepresenter(thresh=0.3, box_thresh=0.6, min_size=2)
+    rep.num_pruned = []
+    boxes, scores = rep.boxes_from_bitmap(pred, pred > rep.thresh, w, h)
+    rep.filter_boxes = True
+    filtered, filtered_scores = rep.boxes_from_bitmap(pred, pred > rep.thresh, w, h)
+    keep = scores > rep.box_thresh
+    np.testing.assert_array_equal(filtered, boxes[keep])
+    np.testing.assert_array_equal(filtered_scores, scores[keep])
+    # pruned by size in both calls, by score only in the second
+    assert np.count_nonzero(~keep) > 0
+    assert rep.num_pruned == [rep.num_pruned[0], rep.num_pruned[0] + np.count_nonzero(~keep)]
+
+
+def test_filter_boxes_inclusive_thresh():
+    pred = np.zeros((1, 1, 100, 100), dtype=np.float32)
+    pred[0, 0, 10:30, 10:80] = 0.75     # scores exactly 0.75
+    pred[0, 0, 50:70, 10:80] = 1
+    for inclusive_thresh, num_boxes in ((False, 1), (True, 2)):
+        rep = SegDetectorRepresenter(thresh=0.5, box_thresh=0.75, filter_boxes=True, inclusive_thresh=inclusive_thresh)
+        boxes, scores = rep(None, pred)
+        assert len(boxes[0]) == num_boxes
+        assert scores[0].min() >= 0.75
+
+
+def test_quad_metric_pool_matches_inline():
+    rng = np.random.default_rng(0)
+    batches = []
+    for _ in range(3):
+        gts, preds = [], []
+        for _ in range(2):
+            xy, wh = rng.integers(0, 400, (5, 2)), rng.integers(10, 80, (5, 2))
+            gt = np.stack([np.stack([o, o + [s[0], 0], o + s, o + [0, s[1]]]) for o, s in zip(xy, wh)])
+            gts.append(gt.astype(np.float32))
+            preds.append((gt + rng.integers(-5, 6, (5, 1, 2))).astype(np.float32))
+        batches.append(({'text_polys': gts, 'ignore_tags': [np.zeros(5, dtype=bool)] * 2}, (preds, [rng.random(5) for _ in gts])))
+    results = []
+    for num_workers in (0, 2):
+        with QuadMetric(num_workers=num_workers) as metric:
+            metrics = metric.gather_measure([metric.validate_measure(batch, output) for batch, output in batches])
+        assert metric.pool is None
+        results.append([metrics[k].avg for k in ('recall', 'precision', 'fmeasure')])
+    assert results[0] == results[1]
+
+
+def test_filtered_eval_post_process_keeps_metrics():
+    # train_db's eval post-processing, pruning before unclip must not change what QuadMetric counts
+    pred = np.stack([synthetic_lines_map(seed) for seed in range(3)])[:, None]
+    # a block scoring exactly 0.6 and lines with short sides of 1 and 2 pixels
+    pred[0, 0, 10:30, 10:80] = 0.6
+    pred[1, 0, 10:12, 10:80] = 1
+    pred[1, 0, 20:23, 10:80] = 1
+    rep = SegDetectorRepresenter(thresh=0.5, box_thresh=0.6, min_size=2, inclusive_thresh=True)
+    boxes, scores = rep(None, pred)
+    # ground truth from the boxes themselves, dropping some so that precision is not 1 either
+    batch = {'text_polys': [b[::2] for b in boxes], 'ignore_tags': [np.zeros(len(b[::2]), dtype=bool) for b in boxes]}
+    rep.filter_boxes = True
+    filtered_boxes, filtered_scores = rep(None, pred)
+    assert sum(map(len, filtered_boxes)) < sum(map(len, boxes))
+    assert any(np.any(s == np.float32(0.6)) for s in filtered_scores)
+    results = []
+    for output in ((boxes, scores), (filtered_boxes, filtered_scores)):
+        metric = QuadMetric()
+        metrics = metric.gather_measure([metric.validate_measure(batch, output)])
+        results.append([metrics[k].avg for k in ('recall', 'precision', 'fmeasure')])
+    assert results[0] == results[1]
+    assert results[0][1] < 1
+
+
+class ExactBorderMap(MakeBorderMap):
+    # reference threshold maps from the true point-to-segment distance
+    def distance(self, xs, ys, point_1, point_2):
+        d = np.asarray(point_2, dtype=np.float64) - point_1
+        t = np.clip(((xs - point_1[0]) * d[0] + (ys - point_1[1]) * d[1]) / max(d @ d, 1e-12), 0, 1)
+        return np.hypot(xs - point_1[0] - t * d[0], ys - point_1[1] - t * d[1])
+
+
+def test_border_map_per_edge_distance_bias():
+    # distance() falls back to the nearest endpoint whenever the angle at the pixel is acute
+    xs, ys = np.array([[1.]]), np.array([[-5.]])
+    assert abs(MakeBorderMap().distance(xs, ys, (0., 0.), (2., 0.))[0, 0] - np.sqrt(26)) < 1e-9
+    assert abs(ExactBorderMap().distance(xs, ys, (0., 0.), (2., 0.))[0, 0] - 5) < 1e-9
+
+
+def test_border_map_parity():
+    # both paths against exact distances: the outline of the distance transform is rasterized at integer coordinates,
+    # so distances are off by up to ~0.5px, a lot relative to the border width of a thin line
+    for seed in range(4):
+        sample = synthetic_border_sample(seed, size=512, num_lines=20)
+        exact = ExactBorderMap()({k: np.copy(v) for k, v in sample.items()})
+        for distance_transform, bounds in ((True, (0.01, 0.06, 0.12)), (False, (1e-3, 1e-3, 0.04))):
+            out = MakeBorderMap(distance_transform=distance_transform)({k: np.copy(v) for k, v in sample.items()})
+            np.testing.assert_array_equal(out['threshold_mask'], exact['threshold_mask'])
+            diff = np.abs(out['threshold_map'] - exact['threshold_map'])[exact['threshold_mask'] > 0]
+            assert diff.mean() < bounds[0]
+            assert np.percentile(diff, 99) < bounds[1]
+            assert diff.max() < bounds[2]
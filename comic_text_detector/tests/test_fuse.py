@@ -0,0 +1,108 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+nn = torch.nn
+
+from utils.yolov5_utils import fuse_conv_and_bn, fuse_deconv_and_bn
+
+
+def random_bn(channels):
+    bn = nn.BatchNorm2d(channels)
+    with torch.no_grad():
+        bn.weight.uniform_(0.5, 1.5)
+        bn.bias.uniform_(-0.5, 0.5)
+        bn.running_mean.uniform_(-0.5, 0.5)
+        bn.running_var.uniform_(0.5, 2)
+    return bn.eval()
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(kernel_size=3, padding=1, bias=False),
+    dict(kernel_size=3, stride=2, padding=2, dilation=2, groups=2, bias=True),
+])
+def test_fuse_conv_and_bn(kwargs):
+    torch.manual_seed(0)
+    conv, bn = nn.Conv2d(8, 16, **kwargs).eval(), random_bn(16)
+    x = torch.randn(2, 8, 17, 19)
+    with torch.no_grad():
+        torch.testing.assert_close(fuse_conv_and_bn(conv, bn)(x), bn(conv(x)), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(kernel_size=4, stride=2, padding=1, bias=False),
+    dict(kernel_size=3, stride=2, padding=1, output_padding=1, dilation=2, bias=True),
+])
+def test_fuse_deconv_and_bn(kwargs):
+    torch.manual_seed(0)
+    deconv, bn = nn.ConvTranspose2d(8, 16, **kwargs).eval(), random_bn(16)
+    x = torch.randn(2, 8, 9, 11)
+    with torch.no_grad():
+        torch.testing.assert_close(fuse_deconv_and_bn(deconv, bn)(x), bn(deconv(x)), rtol=1e-4, atol=1e-5)
+
+
+def test_fuse_keeps_dtype():
+    conv, deconv, bn = nn.Conv2d(8, 16, 3).half(), nn.ConvTranspose2d(8, 16, 2, 2).half(), random_bn(16).half()
+    assert {p.dtype for p in fuse_conv_and_bn(conv, bn).parameters()} == {torch.float16}
+    assert {p.dtype for p in fuse_deconv_and_bn(deconv, bn).parameters()} == {torch.float16}
+
+
+def test_fuse_deconv_rejects_groups():
+    with pytest.raises(AssertionError):
+        fuse_deconv_and_bn(nn.ConvTranspose2d(8, 16, 2, 2, groups=2), random_bn(16))
+
+
+YOLOV5S_CFG = dict(
+    nc=2, depth_multiple=0.33, width_multiple=0.5,
+    anchors=[[10, 13, 16, 30, 33, 23], [30, 61, 62, 45, 59, 119], [116, 90, 156, 198, 373, 326]],
+    backbone=[[-1, 1, 'Conv', [64, 6, 2, 2]], [-1, 1, 'Conv', [128, 3, 2]], [-1, 3, 'C3', [128]],
+              [-1, 1, 'Conv', [256, 3, 2]], [-1, 6, 'C3', [256]], [-1, 1, 'Conv', [512, 3, 2]],
+              [-1, 9, 'C3', [512]], [-1, 1, 'Conv', [1024, 3, 2]], [-1, 3, 'C3', [1024]], [-1, 1, 'SPPF', [1024, 5]]],
+    head=[[-1, 1, 'Conv', [512, 1, 1]], [-1, 1, 'nn.Upsample', [None, 2, 'nearest']], [[-1, 6], 1, 'Concat', [1]],
+          [-1, 3, 'C3', [512, False]], [-1, 1, 'Conv', [256, 1, 1]], [-1, 1, 'nn.Upsample', [None, 2, 'nearest']],
+          [[-1, 4], 1, 'Concat', [1]], [-1, 3, 'C3', [256, False]], [-1, 1, 'Conv', [256, 3, 2]],
+          [[-1, 14], 1, 'Concat', [1]], [-1, 3, 'C3', [512, False]], [-1, 1, 'Conv', [512, 3, 2]],
+          [[-1, 10], 1, 'Concat', [1]], [-1, 3, 'C3', [1024, False]], [[17, 20, 23], 1, 'Detect', ['nc', 'anchors']]],
+)
+
+
+@pytest.fixture(scope='module')
+def textdet_path(tmp_path_factory):
+    # untrained blk/seg/det weights with random bn statistics, in the layout get_base_det_models loads
+    from basemodel import DBHead, UnetHead
+    from models.yolov5.yolo import Model
+    torch.manual_seed(0)
+    models = {'blk_det': Model(YOLOV5S_CFG), 'text_seg': UnetHead(act='leaky'), 'text_det': DBHead(64, act='leaky')}
+    for model in models.values():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.load_state_dict(random_bn(m.num_features).state_dict())
+    path = str(tmp_path_factory.mktemp('textdet') / 'textdet.pt')
+    torch.save({'blk_det': {'cfg': YOLOV5S_CFG, 'weights': models['blk_det'].state_dict()},
+                'text_seg': models['text_seg'].state_dict(), 'text_det': models['text_det'].state_dict()}, path)
+    return path
+
+
+def assert_heads_close(outs, ref_outs):
+    for out, ref in zip(outs, ref_outs):
+        assert out.shape == ref.shape
+        torch.testing.assert_close(out.contiguous(), ref, rtol=1e-5, atol=1e-6)
+
+
+def test_fuse_textdet(textdet_path):
+    from basemodel import TextDetBase
+    x = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        ref_outs = TextDetBase(textdet_path).eval()(x)
+        model = TextDetBase(textdet_path).eval().fuse()
+        assert not any(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+        assert_heads_close(model(x), ref_outs)
+
+
+@pytest.mark.parametrize('channels_last, jit', [(False, None), (True, None), (False, 'trace'), (True, 'trace')])
+def test_textdet_inference(textdet_path, channels_last, jit):
+    from basemodel import TextDetBase, TextDetInference
+    x = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        ref_outs = TextDetBase(textdet_path).eval()(x)
+        model = TextDetInference(TextDetBase(textdet_path), channels_last=channels_last, jit=jit, input_size=(256, 256))
+        assert_heads_close(model(x), ref_outs)
@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.general import DeviceLoader
+
+
+def new_threads(before):
+    return [t for t in threading.enumerate() if t not in before]
+
+
+def make_loader(n=16):
+    dataset = torch.utils.data.TensorDataset(torch.arange(n, dtype=torch.float32))
+    return DeviceLoader(torch.utils.data.DataLoader(dataset, batch_size=1), device='cpu', prefetch=2)
+
+
+def test_device_loader_yields_every_batch():
+    before = threading.enumerate()
+    assert [batch[0].item() for batch in make_loader()] == list(range(16))
+    assert new_threads(before) == []
+
+
+def test_device_loader_stops_worker_on_early_exit():
+    before = threading.enumerate()
+    loader = make_loader()
+    for ii, _ in enumerate(loader):
+        if ii == 1:
+            break
+    assert new_threads(before) == []
+
+    with pytest.raises(RuntimeError):
+        for _ in loader:
+            raise RuntimeError
+    assert new_threads(before) == []
+
+    batches = iter(loader)
+    next(batches)
+    del batches
+    assert new_threads(before) == []
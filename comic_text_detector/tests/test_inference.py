@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnx')
+
+from inference import TextDetBaseDNN
+
+
+def export_tiny_model(path):
+    # stands in for a detector exported with dynamic=True: one output whose shape follows the input
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 2, 3, padding=1), torch.nn.ReLU()).eval()
+    torch.onnx.export(model, torch.randn(1, 3, 64, 64), path, input_names=['images'], dynamic_axes={'images': {2: 'h', 3: 'w'}}, dynamo=False)
+
+
+def test_dnn_rectangular_input_size(tmp_path):
+    model_path = str(tmp_path / 'tiny.onnx')
+    export_tiny_model(model_path)
+    net = TextDetBaseDNN((128, 192), model_path)
+    _, _, lines_map = net(np.zeros((300, 500, 3), np.uint8))
+    assert lines_map.shape == (1, 2, 128, 192)
+
+
+def test_dnn_shape_nets_built_from_model_bytes(tmp_path):
+    model_path = str(tmp_path / 'tiny.onnx')
+    export_tiny_model(model_path)
+    net = TextDetBaseDNN(128, model_path, max_cached_nets=2)
+    os.remove(model_path)   # nets for new shapes must not read the file again
+    for h, w in ((64, 128), (128, 64), (64, 64), (64, 128)):
+        _, _, lines_map = net(np.zeros((1, 3, h, w), np.float32))
+        assert lines_map.shape == (1, 2, h, w)
+    assert list(net.shape_nets) == [(64, 64), (64, 128)]
+
+
+def test_sort_head_outputs():
+    from inference import sort_head_outputs
+    blks, mask, lines_map = np.zeros((1, 10, 7)), np.zeros((1, 1, 32, 32)), np.zeros((1, 2, 32, 32))
+    for outs in ((mask, lines_map, blks), (lines_map, blks, mask), (blks, mask, lines_map)):
+        sorted_outs = sort_head_outputs(outs)
+        assert all(out is ref for out, ref in zip(sorted_outs, (blks, mask, lines_map)))
+    assert sort_head_outputs((lines_map, blks)) == (blks, None, lines_map)
+    assert sort_head_outputs((mask, )) == (None, mask, None)
+
+
+class TinyDetector(torch.nn.Module):
+    # fixed block predictions (xywh, obj conf, cls confs) at input_size 256, a mask covering the page and empty line maps
+    def __init__(self):
+        super().__init__()
+        self.blks = torch.nn.Parameter(torch.tensor([[[64., 64., 64., 48., 0.9, 0.9, 0.1], [176., 160., 48., 96., 0.9, 0.1, 0.9]]]))
+        self.seg = torch.nn.Conv2d(3, 1, 3, padding=1)
+        self.det = torch.nn.Conv2d(3, 2, 3, padding=1)
+        torch.nn.init.zeros_(self.seg.weight)
+        torch.nn.init.constant_(self.seg.bias, 4.)
+        torch.nn.init.zeros_(self.det.weight)
+        torch.nn.init.constant_(self.det.bias, -4.)
+
+    def forward(self, x):
+        blks = self.blks + 0.01 * x.mean(dim=(1, 2), keepdim=True).mean(dim=3)
+        return blks, torch.sigmoid(self.seg(x)), torch.sigmoid(self.det(x))
+
+
+def test_int8_detector(tmp_path):
+    pytest.importorskip('onnxruntime')
+    import cv2
+    from inference import TextDetector, quantized_model_path
+    from utils.export import export_onnx, quantize_int8
+
+    model_path = str(tmp_path / 'tiny')
+    export_onnx(TinyDetector().eval(), torch.zeros((1, 3, 256, 256)), model_path, opset=13, simplify=False)
+    model_path += '.onnx'
+
+    page_dir = tmp_path / 'pages'
+    page_dir.mkdir()
+    rng = np.random.default_rng(0)
+    pages = []
+    for ii in range(3):
+        page = np.full((384, 256, 3), 255, np.uint8)
+        for _ in range(8):
+            x, y = rng.integers(0, 224), rng.integers(0, 352)
+            cv2.rectangle(page, (int(x), int(y)), (int(x) + 24, int(y) + 8), 0, -1)
+        cv2.imwrite(str(page_dir / f'{ii}.png'), page)
+        pages.append(page)
+    quantize_int8(model_path, quantized_model_path(model_path, 'int8'), str(page_dir), input_size=256)
+
+    detector = TextDetector(model_path, input_size=256, precision='int8')
+    assert detector.backend == 'onnxruntime'
+    blk_list, page_mask = detector.detect(pages[0])
+    assert len(blk_list) == 2
+    assert page_mask.mask.shape == pages[0].shape[:2]
@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+import os.path as osp
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+HEAVY_MODULES = ('torch', 'shapely', 'pyclipper', 'tqdm')
+IMPORT_BUDGET = 2.0     # seconds, importing inference takes ~0.15s (mostly numpy and cv2) on a dev machine
+
+COLD_START = f'''
+import json, sys, time
+t0 = time.perf_counter()
+import inference
+t = time.perf_counter() - t0
+print(json.dumps({{'time': t, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+'''
+
+
+def test_inference_cold_start():
+    # a fresh interpreter, so nothing imported by other tests leaks in
+    out = subprocess.run([sys.executable, '-c', COLD_START], cwd=ROOT, capture_output=True, text=True, check=True)
+    rst = json.loads(out.stdout.strip().splitlines()[-1])
+    assert rst['loaded'] == []
+    assert rst['time'] < IMPORT_BUDGET, f'importing inference took {rst["time"]:.2f}s'
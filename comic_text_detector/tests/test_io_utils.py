@@ -0,0 +1,40 @@
+import numpy as np
+
+from utils.io_utils import MmapImageCache
+
+
+def make_images():
+    # 1000, 3000 and 500 byte images, plus a grayscale one
+    return [np.full((10, 100), 1, np.uint8), np.full((10, 100, 3), 2, np.uint8), np.full((10, 50), 3, np.uint8), np.full((5, 5, 3), 4, np.uint8)]
+
+
+def test_mmap_image_cache_budget(tmp_path):
+    images = make_images()
+    # 1600 bytes: the second image does not fit, the third and fourth still do
+    cache = MmapImageCache.build(str(tmp_path / 'cache'), [str(i) for i in range(4)], lambda i: images[i], budget_gb=1600 / 1E9)
+    assert cache[1] is None
+    for i in (0, 2, 3):
+        np.testing.assert_array_equal(cache[i], images[i])
+    cache[0][:] = 0     # copies, the file stays read-only
+    np.testing.assert_array_equal(cache[0], images[0])
+
+
+def test_mmap_image_cache_open_or_build(tmp_path):
+    images = make_images()
+    calls = []
+    def load(i):
+        calls.append(i)
+        return images[i]
+    prefix = str(tmp_path / 'cache')
+    keys = [f'img{i}.png' for i in range(4)]
+    cache = MmapImageCache.open_or_build(prefix, keys, load)
+    assert calls == [0, 1, 2, 3]
+    # same keys and budget: reused without loading anything
+    reused = MmapImageCache.open_or_build(prefix, keys, load)
+    assert calls == [0, 1, 2, 3] and reused.cache_path == cache.cache_path
+    np.testing.assert_array_equal(reused[1], images[1])
+    # another budget rebuilds the same file, other keys get their own file
+    MmapImageCache.open_or_build(prefix, keys, load, budget_gb=1E-6)
+    assert len(calls) == 8
+    other = MmapImageCache.open_or_build(prefix, keys[:2], load)
+    assert len(calls) == 10 and other.cache_path != cache.cache_path and len(other) == 2
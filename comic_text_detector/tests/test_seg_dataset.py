@@ -0,0 +1,142 @@
+import cv2
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from seg_dataset import AspectRatioBatchSampler, LoadImageAndMask, ShardBatchSampler, augment_hsv, augment_hsv_batch, bgr2hsv_u8, letterbox_padding_ratio, pack_seg_shards
+from utils.io_utils import ShardReader
+from utils.imgproc_utils import letterbox, resize_keepasp
+
+
+def random_pages(n=3, h=96, w=128, seed=0):
+    # flat regions and gradients like screentone pages, plus noise so every hue/saturation shows up
+    rng = np.random.default_rng(seed)
+    pages = rng.integers(0, 256, (n, h, w, 3), dtype=np.uint8)
+    pages[:, : h // 2] = np.linspace(0, 255, w, dtype=np.uint8)[None, None, :, None]
+    return pages
+
+
+def test_bgr2hsv_u8_matches_opencv():
+    pages = random_pages()
+    ref = np.stack([cv2.cvtColor(page, cv2.COLOR_BGR2HSV) for page in pages])
+    np.testing.assert_array_equal(bgr2hsv_u8(torch.from_numpy(pages)).numpy(), ref)
+
+
+def test_augment_hsv_batch_matches_augment_hsv():
+    pages = random_pages()
+    gains, refs = [], []
+    for seed, page in enumerate(pages):
+        np.random.seed(seed)
+        gains.append(np.random.uniform(-1, 1, 3) * [0.5, 0.5, 0.5] + 1)
+        np.random.seed(seed)
+        refs.append(page.copy())
+        augment_hsv(refs[-1])
+    out = augment_hsv_batch(torch.from_numpy(pages), gains=torch.tensor(np.array(gains))).numpy()
+    diff = np.abs(out.astype(np.int64) - np.stack(refs))
+    # hsv -> bgr is done in float32, a few pixels can land one level away from opencv's
+    assert diff.max() <= 1
+    assert np.count_nonzero(diff) / diff.size < 1e-3
+
+
+def test_letterbox_padding_ratio():
+    shapes = [(600, 300), (300, 600), (400, 400), (1000, 250)]
+    padded = []
+    for h, w in shapes:
+        img = resize_keepasp(np.full((h, w, 3), 255, np.uint8), 512)
+        img = letterbox(img, new_shape=(512, 512), auto=False, color=(0, 0, 0))[0]
+        padded.append(np.mean(img[..., 0] == 0))
+    ratio = letterbox_padding_ratio(np.array([h / w for h, w in shapes]))
+    assert abs(ratio - np.mean(padded)) < 0.01
+
+
+class PageShapes:
+    # the part of LoadImageAndMask AspectRatioBatchSampler reads
+    def __init__(self, shapes, img_size=512, stride=64):
+        self.shapes = shapes
+        self.img_size = (img_size, img_size)
+        self.stride = stride
+
+    def aspect_ratios(self):
+        return np.array([h / w for h, w in self.shapes])
+
+
+@pytest.mark.parametrize('shuffle, drop_last', [(True, False), (False, False), (True, True)])
+def test_aspect_ratio_batch_sampler(shuffle, drop_last):
+    rng = np.random.default_rng(0)
+    shapes = [(int(h), int(w)) for h, w in rng.integers(200, 1200, (37, 2))]
+    dataset = PageShapes(shapes)
+    sampler = AspectRatioBatchSampler(dataset, 4, shuffle=shuffle, drop_last=drop_last)
+    for epoch in range(2):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        indices = [i for batch in batches for i, _ in batch]
+        assert len(indices) == len(set(indices))
+        if not drop_last:
+            assert sorted(indices) == list(range(len(shapes)))
+
+        padded = pixels = 0
+        for batch in batches:
+            assert len({shape for _, shape in batch}) == 1
+            h, w = batch[0][1]
+            assert h % dataset.stride == 0 and w % dataset.stride == 0 and max(h, w) == 512
+            for i, _ in batch:
+                img = letterbox(np.full((*shapes[i], 3), 255, np.uint8), new_shape=(h, w), auto=False)[0]
+                padded += np.sum(img[..., 0] == 0)
+                pixels += h * w
+        assert abs(sampler.padding_ratio - padded / pixels) < 0.01
+        assert sampler.padding_ratio < letterbox_padding_ratio(dataset.aspect_ratios())
+
+    dataset.img_size = 384   # multi-size training picks a new size between batches
+    assert max(next(iter(sampler))[0][1]) == 384
+
+
+@pytest.mark.parametrize('num_workers', [0, 1, 2, 3, 5])
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_shard_batch_sampler(num_workers, drop_last):
+    shard_ids = np.repeat(np.arange(6), [7, 3, 9, 1, 6, 5])
+    sampler = ShardBatchSampler(shard_ids, 4, num_workers=num_workers, drop_last=drop_last)
+    np.random.seed(0)
+    batches = sampler.batches()
+    np.random.seed(0)
+    yielded = list(sampler)
+    assert len(yielded) == len(batches) == len(sampler)
+    assert sorted(map(tuple, yielded)) == sorted(map(tuple, batches))
+    indices = [i for batch in yielded for i in batch]
+    assert len(indices) == len(set(indices))
+    if not drop_last:
+        assert sorted(indices) == list(range(len(shard_ids)))
+
+    # the dataloader hands batch k to worker k % num_workers, each worker gets a contiguous run of batches
+    # and the runs cover the epoch in order
+    nw = max(1, num_workers)
+    runs = [yielded[w::nw] for w in range(nw)]
+    assert [batch for run in runs for batch in run] == batches
+    assert max(map(len, runs)) - min(map(len, runs)) <= 1
+    for run in runs:
+        ids = shard_ids[[i for batch in run for i in batch]]
+        # shards are read one after the other, never revisited
+        assert len(np.unique(ids)) == 1 + np.count_nonzero(np.diff(ids))
+
+
+def test_pack_seg_shards_round_trip(tmp_path):
+    img_dir, shard_dir = tmp_path / 'imgs', str(tmp_path / 'shards')
+    img_dir.mkdir()
+    for ii, page in enumerate(random_pages(n=4)):
+        cv2.imwrite(str(img_dir / f'{ii}.jpg'), page)
+        cv2.imwrite(str(img_dir / f'mask-{ii}.png'), (page[..., 0] > 127).astype(np.uint8) * 255)
+    pack_seg_shards(str(img_dir), None, shard_dir, shard_mb=20E3 / 1024 ** 2)  # ~20kB, several shards
+
+    reader = ShardReader(shard_dir)
+    reference = LoadImageAndMask(str(img_dir), img_size=128)
+    assert len(reader.shards) > 1
+    assert [reader.keys(i) for i in range(len(reader))] == reference.img_mask_list
+    for i, (imp, maskp) in enumerate(reference.img_mask_list):
+        for field, path in (('img', imp), ('mask', maskp)):
+            with open(path, 'rb') as f:
+                assert reader.read(i, field).tobytes() == f.read()
+
+    packed = LoadImageAndMask(str(img_dir), img_size=128, shard_dir=shard_dir)
+    for i in range(len(reference)):
+        for out, ref in zip(packed[i], reference[i]):
+            assert torch.equal(out, ref)
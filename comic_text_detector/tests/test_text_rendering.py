@@ -0,0 +1,57 @@
+import os
+import os.path as osp
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+trdg = pytest.importorskip('trdg')
+pytest.importorskip('pandas')
+
+from text_rendering import render_comictext_shards, ALIGN_LEFT, ALIGN_CENTER
+from db_dataset import LoadImageAndAnnotations
+from utils.io_utils import imwrite
+
+
+def sampler_dict(tmp_path):
+    font_dir = osp.join(osp.dirname(trdg.__file__), 'fonts', 'latin')
+    font_statics = tmp_path / 'font_statics.csv'
+    font_statics.write_text('font\n' + '\n'.join(sorted(os.listdir(font_dir))[:4]) + '\n')
+    return {
+        'num_txtblk': 6,
+        'font': {
+            'font_dir': font_dir,
+            'font_statics': str(font_statics),
+            'num': 4,
+            'size': {'value': [0.03, 0.05], 'prob': [1, 0.5]},
+            'stroke_width': {'value': [0, 0.1], 'prob': [1, 0.5]},
+            'color': {'value': ['black', 'random'], 'prob': [1, 0.4]},
+        },
+        'text': {
+            'lang': 'en',
+            'orientation': {'value': [1, 0], 'prob': [0, 1]},
+            'rotation': {'value': [0, 30], 'prob': [1, 0.3]},
+            'num_lines': {'value': [0.15], 'prob': [1]},
+            'length': {'value': [1], 'prob': [1]},
+            'min_num_lines': 1,
+            'min_length': 3,
+            'alignment': {'value': [ALIGN_LEFT, ALIGN_CENTER], 'prob': [0.3, 1]}
+        }
+    }
+
+
+def test_rendered_shards_load_as_db_samples(tmp_path):
+    img_dir, shard_dir = tmp_path / 'bg', tmp_path / 'shards'
+    img_dir.mkdir()
+    imwrite(str(img_dir / 'page.jpg'), np.full((600, 420, 3), 230, np.uint8), ext='.jpg')
+    render_comictext_shards([sampler_dict(tmp_path)], (420, 600), str(img_dir), str(shard_dir), render_num=2, num_workers=1)
+
+    dataset = LoadImageAndAnnotations(str(shard_dir), img_size=256, with_ann=True, shard_dir=str(shard_dir))
+    assert len(dataset) == 2
+    for i in range(len(dataset)):
+        ann = dataset.read_ann(i)
+        assert ann.dtype == np.float64 and ann.shape[1] == 8 and len(ann) > 0
+        sample = dataset[i]
+        assert sample['imgs'].shape == (3, 256, 256)
+        assert sample['text_polys'].shape == (len(ann), 4, 2)
+        assert sample['shrink_map'].max() == 1
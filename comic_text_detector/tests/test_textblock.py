@@ -0,0 +1,88 @@
+import numpy as np
+
+from utils.textblock import TextBlock, dump_textblocks, load_textblocks
+from utils.textmask import merge_mask_list
+
+
+def test_lines_array_is_a_copy():
+    lines = np.array([[[10, 10], [40, 10], [40, 20], [10, 20]]], dtype=np.int64)
+    blk = TextBlock([10, 10, 40, 20], lines=lines)
+    blk.lines_array(dtype=np.int64)[..., 0] -= 10
+    np.testing.assert_array_equal(blk.lines, [[[10, 10], [40, 10], [40, 20], [10, 20]]])
+
+
+def test_merge_mask_list_keeps_block_lines():
+    lines = np.array([[[10, 10], [40, 10], [40, 20], [10, 20]]], dtype=np.int64)
+    blk = TextBlock([10, 10, 40, 20], lines=lines.copy())
+    pred = np.zeros((40, 60), np.uint8)
+    pred[12:18, 12:38] = 255
+    merge_mask_list([[pred.copy(), 0]], pred, blk=blk, text_window=[5, 5, 65, 45], filter_with_lines=True)
+    np.testing.assert_array_equal(blk.lines, lines)
+
+
+def assert_same_value(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        np.testing.assert_array_equal(a, b)
+        return
+    if isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same_value(x, y)
+        return
+    assert a == b
+    assert isinstance(a, (bool, np.bool_)) == isinstance(b, (bool, np.bool_))
+    assert isinstance(a, (int, np.integer)) == isinstance(b, (int, np.integer)), (a, b)
+
+
+def test_textblock_records_round_trip():
+    blk = TextBlock([10, 20, 110, 60], lines=[[[10, 20], [110, 20], [110, 40], [10, 40]], [[10, 40], [110, 40], [110, 60], [10, 60]]],
+                    language='ja', vertical=True, font_size=20, distance=[0.5, 20.5], angle=-3, vec=[100., 2.], norm=100.02,
+                    text=['abc', 'de'], translation='x', alignment=1, target_lang='eng', prob=0.9, _bounding_rect=[1, 2, 3, 4])
+    blk.set_font_colors((255, 0, 10), (0, 0, 0))
+    merged = TextBlock([0, 0, 5, 5], font_size=12.5, line_spacing=1.2, alpha=128.5, accumulate_color=False)
+    empty = TextBlock([0, 0, 1, 1])
+    blk_list = [blk, merged, empty]
+    loaded = load_textblocks(dump_textblocks(blk_list))
+    assert len(loaded) == len(blk_list)
+    for src, dst in zip(blk_list, loaded):
+        src_dict, dst_dict = src.to_dict(), dst.to_dict()
+        assert list(src_dict) == list(dst_dict)
+        for key in src_dict:
+            assert_same_value(src_dict[key], dst_dict[key])
+    assert loaded[0].font_size == 20 and isinstance(loaded[0].font_size, int)
+    assert loaded[1].font_size == 12.5
+    assert load_textblocks(dump_textblocks([])) == []
+
+
+def test_textblock_from_to_dict():
+    blk = TextBlock([0, 0, 10, 10], alignment=2, target_lang='eng', prob=0.5)
+    copied = TextBlock(**blk.to_dict())
+    assert (copied._alignment, copied._target_lang, copied.prob) == (2, 'eng', 0.5)
+
+
+def test_mask_score_at_network_resolution():
+    # group_output scores boxes on the mask at network resolution,
+    # it should agree with the score on the mask resized to the page around the 0.1 threshold
+    import cv2
+    from utils.textblock import mask_score
+    rng = np.random.default_rng(0)
+    mask_score_thresh, tol = 0.1, 0.03
+    near_thresh = 0
+    for im_w, im_h in ((1000, 1400), (640, 1800), (1123, 877)):
+        mask_small = np.zeros((256, 192), np.uint8)
+        for _ in range(150):
+            x, y = rng.integers(0, 188), rng.integers(0, 252)
+            cv2.rectangle(mask_small, (int(x), int(y)), (int(x + rng.integers(1, 4)), int(y + rng.integers(1, 6))), 255, -1)
+        mask = cv2.resize(mask_small, (im_w, im_h), interpolation=cv2.INTER_LINEAR)
+        ratio = (im_w / mask_small.shape[1], im_h / mask_small.shape[0])
+        for _ in range(300):
+            bw, bh = rng.integers(20, 200), rng.integers(20, 200)
+            x1, y1 = rng.integers(0, im_w - bw), rng.integers(0, im_h - bh)
+            xyxy = [x1, y1, x1 + bw, y1 + bh]
+            score, score_small = mask_score(mask, xyxy), mask_score(mask_small, xyxy, ratio)
+            assert abs(score_small - score) < tol
+            if abs(score - mask_score_thresh) < 0.05:
+                near_thresh += 1
+                if abs(score - mask_score_thresh) > tol:
+                    assert (score_small < mask_score_thresh) == (score < mask_score_thresh)
+    assert near_thresh > 50
@@ -10,6 +10,8 @@ import os.path as osp
 import os
 from PIL import Image, ImageColor, ImageFont, ImageDraw, ImageFilter, ImageOps
 import random
+import io
+from functools import lru_cache
 
 from numpy.random import rand
 from trdg.utils import load_dict, load_fonts
@@ -17,7 +19,7 @@ from tqdm import tqdm
 import pandas as pd
 import sys
 sys.path.append(os.getcwd())
-from utils.io_utils import find_all_imgs, imread, imwrite
+from utils.io_utils import find_all_imgs, imread, imwrite, ShardWriter
 from utils.imgproc_utils import *
 import copy
 
@@ -52,15 +54,15 @@ def draw_text_polygons(img, text_polygons, color=None):
         cv2.polylines(img,[poly.reshape((-1, 1, 2))],True,randcolor, thickness=2)
     return img
 
-def draw_textblk(textlines, font, 
-                     fill='black',
-                     stroke_width=0,
-                     stroke_fill='grey',
-                     spacing=0,
-                     rotation=0,
-                     orientation=ORIENTATION_HOR,
-                     alignment=ALIGN_LEFT):
-
+def layout_textblk(textlines, font,
+                   stroke_width=0,
+                   spacing=0,
+                   orientation=ORIENTATION_HOR,
+                   alignment=ALIGN_LEFT):
+    '''
+    glyph layout of a text block, independent of its colors and rotation.
+    returns the fill mask, the block mask (fill + stroke) and line polygons, cropped to the text, or None, None, None
+    '''
     text_size = np.array([font.getsize(line) for line in textlines])
     if orientation == ORIENTATION_HOR:
         line_widths, line_heights = text_size[:, 0], text_size[:, 1]
@@ -73,9 +75,11 @@ def draw_textblk(textlines, font,
     if orientation == ORIENTATION_VER:
         textblk_h += font.size * 3  # some fonts are not correctly aligned
     
-    txtblk_img = Image.new("RGBA", (textblk_w, textblk_h), (255, 255, 255, 255))
-    txtblk_draw = ImageDraw.Draw(txtblk_img)
-    txtblk_draw.fontmode = '1'      # disable anti-aliasing
+    # ImageDraw.text draws the stroke and then the fill at the same origin, 
+    # so drawing them into two masks lets colorize_textblk recolor a block without drawing it again
+    fill_mask = Image.new("L", (textblk_w, textblk_h), (0))
+    fill_draw = ImageDraw.Draw(fill_mask)
+    fill_draw.fontmode = '1'      # disable anti-aliasing
     txtblk_mask = Image.new("L", (textblk_w, textblk_h), (0))
     tmp_msk = txtblk_mask.copy()
     tmp_msk_draw = ImageDraw.Draw(tmp_msk)
@@ -86,7 +90,7 @@ def draw_textblk(textlines, font,
         for ii, line in enumerate(textlines):
             x_offset = sum(line_widths[:ii]) + stroke_width
             for jj, char in enumerate(line):
-                txtblk_draw.text((x_offset, jj*font.size), char, font=font, fill=fill, stroke_width=stroke_width, stroke_fill=stroke_fill)
+                fill_draw.text((x_offset, jj*font.size), char, font=font, fill='white')
                 tmp_msk_draw.text((x_offset, jj*font.size), char, font=font, fill='white', stroke_width=stroke_width, stroke_fill='white')
             valid_bbox = tmp_msk.getbbox()
             if valid_bbox is None:
@@ -100,7 +104,7 @@ def draw_textblk(textlines, font,
             y_offset = sum(line_heights[0:ii]) + stroke_width
             if alignment == ALIGN_CENTER:
                 x_offset += (textblk_w - line_widths[ii]) / 2
-            txtblk_draw.text((x_offset, y_offset), line, font=font, fill=fill, stroke_width=stroke_width, stroke_fill=stroke_fill)
+            fill_draw.text((x_offset, y_offset), line, font=font, fill='white')
             tmp_msk_draw.text((x_offset, y_offset), line, font=font, fill='white', stroke_width=stroke_width, stroke_fill='white')
             valid_bbox = tmp_msk.getbbox()
             if valid_bbox is None:
@@ -113,18 +117,42 @@ def draw_textblk(textlines, font,
         return None, None, None
     textpolygons = np.array(textpolygons)
     textpolygons = xywh2xyxypoly(textpolygons)
-    txtblk_img, txtblk_mask = txtblk_img.crop(bbox), txtblk_mask.crop(bbox)
+    fill_mask, txtblk_mask = fill_mask.crop(bbox), txtblk_mask.crop(bbox)
     textpolygons[:, ::2] = np.clip(textpolygons[:, ::2] - bbox[0], 0, txtblk_mask.width-1)
     textpolygons[:, 1::2] = np.clip(textpolygons[:, 1::2] - bbox[1], 0, txtblk_mask.height-1)
+    return fill_mask, txtblk_mask, textpolygons
+
+def rotate_textblk(txtblk_mask, textpolygons, rotation=0):
+    if rotation == 0:
+        return txtblk_mask, textpolygons
+    center = (txtblk_mask.width/2, txtblk_mask.height/2)
+    txtblk_mask = txtblk_mask.rotate(rotation, Image.BICUBIC, expand=1)
+    new_center = (txtblk_mask.width / 2, txtblk_mask.height / 2)
+    textpolygons = rotate_polygons(center, textpolygons, rotation, new_center)
+    return txtblk_mask, textpolygons
+
+def colorize_textblk(fill_mask, txtblk_mask, fill='black', stroke_fill='grey', rotation=0):
+    # masks from layout_textblk (unrotated) -> RGBA text block image
+    txtblk_img = Image.new("RGBA", txtblk_mask.size, (255, 255, 255, 255))
+    txtblk_img.paste(stroke_fill, mask=txtblk_mask)
+    txtblk_img.paste(fill, mask=fill_mask)
     if rotation != 0:
-        center = (txtblk_img.width/2, txtblk_img.height/2)
         txtblk_img = txtblk_img.rotate(rotation, Image.BICUBIC, expand=1)
-        txtblk_mask = txtblk_mask.rotate(rotation, Image.BICUBIC, expand=1)
-        new_center = (txtblk_img.width / 2, txtblk_img.height / 2)
-        textpolygons = rotate_polygons(center, textpolygons, rotation, new_center)
-    # txtblk_img, txtblk_mask = txtblk_img.crop(bbox), txtblk_mask.crop(bbox)
-    # textpolygons[:, ::2] = np.clip(textpolygons[:, ::2] - bbox[0], 0, txtblk_mask.width-1)
-    # textpolygons[:, 1::2] = np.clip(textpolygons[:, 1::2] - bbox[1], 0, txtblk_mask.height-1)
+    return txtblk_img
+
+def draw_textblk(textlines, font, 
+                     fill='black',
+                     stroke_width=0,
+                     stroke_fill='grey',
+                     spacing=0,
+                     rotation=0,
+                     orientation=ORIENTATION_HOR,
+                     alignment=ALIGN_LEFT):
+    fill_mask, txtblk_mask, textpolygons = layout_textblk(textlines, font, stroke_width=stroke_width, spacing=spacing, orientation=orientation, alignment=alignment)
+    if txtblk_mask is None:
+        return None, None, None
+    txtblk_img = colorize_textblk(fill_mask, txtblk_mask, fill=fill, stroke_fill=stroke_fill, rotation=rotation)
+    txtblk_mask, textpolygons = rotate_textblk(txtblk_mask, textpolygons, rotation)
     return txtblk_img, txtblk_mask, textpolygons
 
 def create_random_sampler(value, prob):
@@ -199,6 +227,11 @@ class TextLinesSampler:
             textlines.append(line[:length])
         return textlines, orientation, self.alignment_sampler(), rotation
 
+@lru_cache(maxsize=4096)
+def load_font(font_path, fontsize):
+    # parsing a font file is far slower than drawing with it, samplers draw from a few hundred fonts at a few sizes
+    return ImageFont.truetype(font_path, fontsize)
+
 class FontSampler:
     def __init__(self, font_dict, page_size) -> None:
         font_statics = font_dict['font_statics']
@@ -243,7 +276,7 @@ class FontSampler:
         #         break
         self.font_idx = random.randrange(0, self.sampler_range) % len(self.font_list)
         font_path = osp.join(self.font_dir, self.font_list[self.font_idx])
-        font = ImageFont.truetype(font_path, fontsize)
+        font = load_font(font_path, fontsize)
         
         return font, color, stroke_width, sw_color
 
@@ -345,13 +378,14 @@ class ComicTextSampler:
         for ii in range(self.num_txtblk):
             font, color, stroke_width, sw_color = self.font_sampler(page_size=self.page_size)
             textlines, orientation, alignment, rotation = self.textlines_sampler(font_size=font.size)
-            txtblk_img, txtblk_mask, textpolygons = draw_textblk(textlines, font, fill=color, stroke_width=stroke_width, stroke_fill=sw_color, orientation=orientation, alignment=alignment, rotation=rotation)
-            if txtblk_mask is None:
+            # glyphs are laid out once, colors are applied after the background under the block is known
+            fill_mask, stroke_mask, textpolygons = layout_textblk(textlines, font, stroke_width=stroke_width, orientation=orientation, alignment=alignment)
+            if stroke_mask is None:
                 continue
-            bbox = self.textblk_sampler(txtblk_img.width, txtblk_img.height, font.size*1.2, page_size=(page_w, page_h))
+            txtblk_mask, textpolygons = rotate_textblk(stroke_mask, textpolygons, rotation)
+            bbox = self.textblk_sampler(txtblk_mask.width, txtblk_mask.height, font.size*1.2, page_size=(page_w, page_h))
             if bbox is not None:
                 x1, y1, x2, y2 = bbox[0], bbox[1], bbox[0] + txtblk_mask.width, bbox[1] + txtblk_mask.height
-                re_draw = False
                 if im_in is not None:
                     mean_bgcolor = np.mean(im_in[y1: y2, x1: x2], axis=(0, 1))
                     max_var_color = get_max_var_color(mean_bgcolor)
@@ -370,16 +404,10 @@ class ComicTextSampler:
                             color = max_var_color
 
                             sw_color = get_max_var_color(np.array(color))
-                            re_draw = True
                     else:
                         color = max_var_color
                         sw_color = get_max_var_color(np.array(color))
-                        re_draw = True
-                if stroke_width != 0 and im_in is not None:
-                    # sw_color = get_max_var_color(color)
-                    re_draw = True
-                if re_draw:
-                    txtblk_img, txtblk_mask, textpolygons = draw_textblk(textlines, font, fill=color, stroke_width=stroke_width, stroke_fill=sw_color, orientation=orientation, alignment=alignment, rotation=rotation)
+                txtblk_img = colorize_textblk(fill_mask, stroke_mask, fill=color, stroke_fill=sw_color, rotation=rotation)
                 blk_dict = {
                     'lang': self.lang, 
                     'lang_cls': lang2cls(self.lang),
@@ -402,54 +430,52 @@ class ComicTextSampler:
             yolo_labels = np.concatenate((cls, yolo_labels), axis=1)
         return rst, rst_msk, block_dicts, yolo_labels, np.array(textpolylines)
 
-def render_comictext(comic_sampler_list, img_dir, label_dir=None, render_num=700, save_dir=None, save_prefix=None, show=False):
+def list_backgrounds(img_dir):
     if osp.exists(osp.join(img_dir, 'statistics.csv')):
         statistics = pd.read_csv(osp.join(img_dir, 'statistics.csv'))
-    else:
-        statistics = None
-        imglist = find_all_imgs(img_dir)
-        # render_num = min(render_num, len(imglist))
+        return list(statistics['name'])
+    return find_all_imgs(img_dir)
+
+def load_yolo_labels(label_dir, imgname):
+    # -> (labels or None, bboxlist) of the background page
+    if label_dir is None:
+        return None, []
+    labelname = imgname.replace(pathlib.Path(imgname).suffix, '.txt')
+    labels = np.loadtxt(osp.join(label_dir, labelname))
+    if len(labels) == 0:
+        return None, []
+    if len(labels.shape) == 1:
+        labels = np.array([labels])
+    return labels, np.copy(labels[:, 1:])
+
+def yolo_label_content(labels, yolo_labels):
+    if yolo_labels is None:
+        yolo_labels = labels
+    elif labels is not None:
+        yolo_labels = np.concatenate((labels, yolo_labels))
+    if yolo_labels is None:
+        return ''
+    return get_yololabel_strings(yolo_labels[:, 0], yolo_labels[:, 1:])
+
+def syn_save_name(ii, imgname, save_prefix=None):
+    if save_prefix is not None:
+        return save_prefix + '{0:09d}'.format(ii) + '.jpg'
+    return 'syn-' + imgname
+
+def render_comictext(comic_sampler_list, img_dir, label_dir=None, render_num=700, save_dir=None, save_prefix=None, show=False):
+    imglist = list_backgrounds(img_dir)
     num_im = len(imglist)
     for ii in tqdm(range(render_num)):
-        im_idx = ii % num_im
-        if statistics is not None:
-            imgname = statistics.loc[im_idx]['name']
-        else:
-            imgname = imglist[im_idx]
+        imgname = imglist[ii % num_im]
         img = imread(osp.join(img_dir, imgname))
         cs_idx = ii % len(comic_sampler_list)
-        bboxlist = []
-        labels = None
-        if label_dir is not None:
-            labelname = imgname.replace(pathlib.Path(imgname).suffix, '.txt')
-            label_path = osp.join(label_dir, labelname)
-            labels = np.loadtxt(label_path)
-            if len(labels) != 0:
-                if len(labels.shape) == 1:
-                    labels = np.array([labels])
-                clslist, bboxlist = labels[:, 0], np.copy(labels[:, 1:])
-            else:
-                labels = None
-                bboxlist = []
+        labels, bboxlist = load_yolo_labels(label_dir, imgname)
         rst, rst_msk, block_dicts, yolo_labels, textpolylines = comic_sampler_list[cs_idx].drawtext_one_page(im_in=img, bboxlist=bboxlist, adaptive_color=True)
         if save_dir is not None:
-            if save_prefix is not None:
-                save_name = save_prefix + '{0:09d}'.format(ii) + '.jpg'
-            else:
-                save_name = 'syn-' + imgname
+            save_name = syn_save_name(ii, imgname, save_prefix)
             yolo_save_path = osp.join(save_dir, save_name.replace(pathlib.Path(save_name).suffix, '.txt'))
-            content = ''
-            if yolo_labels is not None:
-                if labels is None:
-                    content = get_yololabel_strings(yolo_labels[:, 0], yolo_labels[:, 1:])
-                else:
-                    yolo_labels = np.concatenate((labels, yolo_labels))
-                    content = get_yololabel_strings(yolo_labels[:, 0], yolo_labels[:, 1:])
-            if content == '' and label_dir is not None:
-                shutil.copy(label_path, yolo_save_path)
-            else:
-                with open(yolo_save_path, 'w', encoding='utf8') as f:
-                    f.write(content)
+            with open(yolo_save_path, 'w', encoding='utf8') as f:
+                f.write(yolo_label_content(labels, yolo_labels))
                 
             linepoly_save_path = osp.join(save_dir, 'line-'+osp.basename(yolo_save_path))
             np.savetxt(linepoly_save_path, textpolylines, fmt='%d')
@@ -463,6 +489,75 @@ def render_comictext(comic_sampler_list, img_dir, label_dir=None, render_num=700
             cv2.waitKey(0)
 
 
+_worker_samplers = None
+
+def _init_render_worker(page_size, sampler_dicts):
+    # every worker builds its own samplers once (language dicts, font lists), fonts are cached per process by load_font
+    global _worker_samplers
+    cv2.setNumThreads(0)
+    _worker_samplers = [ComicTextSampler(page_size, sampler_dict) for sampler_dict in sampler_dicts]
+
+def _render_pages(task):
+    img_dir, label_dir, imgname, page_ids, seed, save_prefix = task
+    img = imread(osp.join(img_dir, imgname))     # decoded once for all pages sharing this background
+    labels, bboxlist = load_yolo_labels(label_dir, imgname)
+    pages = []
+    for ii in page_ids:
+        # seeded per page rather than per worker, so the output does not depend on the number of workers
+        page_seed = np.random.SeedSequence([seed, ii]).generate_state(1)[0]
+        random.seed(int(page_seed))
+        np.random.seed(page_seed)
+        sampler = _worker_samplers[ii % len(_worker_samplers)]
+        # yolo_xywh2xyxy scales the boxes in place
+        rst, rst_msk, _, yolo_labels, textpolylines = sampler.drawtext_one_page(im_in=img, bboxlist=np.copy(bboxlist), adaptive_color=True)
+        ann = io.BytesIO()
+        # float like the np.loadtxt annotations pack_db_shards stores, load_image_annotations normalizes them in place
+        np.save(ann, textpolylines.astype(np.float64))
+        pages.append({
+            'save_name': syn_save_name(ii, imgname, save_prefix), 
+            'img': cv2.imencode('.jpg', rst)[1].tobytes(), 
+            'mask': cv2.imencode('.png', rst_msk)[1].tobytes(), 
+            'ann': ann.getvalue(), 
+            'yolo': yolo_label_content(labels, yolo_labels).encode('utf8'),
+            'textpolylines': textpolylines
+        })
+    return pages
+
+def render_comictext_shards(sampler_dicts, page_size, img_dir, out_dir, label_dir=None, render_num=700, save_dir=None, save_prefix=None, seed=0, num_workers=8, pages_per_task=8, shard_mb=1024):
+    '''
+    parallel render_comictext writing pages straight into a training shard (see utils.io_utils.ShardWriter), 
+    readable by LoadImageAndMask / LoadImageAndAnnotations(shard_dir=out_dir). 
+    pages rendered on the same background are grouped into one task, a page is rendered from (seed, page index) only.
+    '''
+    from multiprocessing import Pool
+
+    imglist = list_backgrounds(img_dir)
+    num_im = len(imglist)
+    tasks = []
+    for im_idx in range(min(num_im, render_num)):
+        page_ids = list(range(im_idx, render_num, num_im))
+        for jj in range(0, len(page_ids), pages_per_task):
+            tasks.append((img_dir, label_dir, imglist[im_idx], page_ids[jj: jj + pages_per_task], seed, save_prefix))
+
+    writer = ShardWriter(out_dir, shard_mb)
+    with Pool(num_workers, initializer=_init_render_worker, initargs=(page_size, sampler_dicts)) as pool:
+        pbar = tqdm(total=render_num, desc='Rendering shards')
+        for pages in pool.imap(_render_pages, tasks):
+            for page in pages:
+                save_name = page['save_name']
+                writer.add((save_name, 'mask-' + save_name), img=page['img'], mask=page['mask'], ann=page['ann'], yolo=page['yolo'])
+                if save_dir is not None:
+                    with open(osp.join(save_dir, save_name.replace(pathlib.Path(save_name).suffix, '.txt')), 'wb') as f:
+                        f.write(page['yolo'])
+                    np.savetxt(osp.join(save_dir, 'line-' + pathlib.Path(save_name).stem + '.txt'), page['textpolylines'], fmt='%d')
+                    with open(osp.join(save_dir, pathlib.Path(save_name).stem + '.jpg'), 'wb') as f:
+                        f.write(page['img'])
+                    with open(osp.join(save_dir, 'mask-' + pathlib.Path(save_name).stem + '.png'), 'wb') as f:
+                        f.write(page['mask'])
+            pbar.update(len(pages))
+        pbar.close()
+    writer.close()
+
 if __name__ == '__main__':
 
     eng_sampler_dict = {
@@ -20,7 +20,8 @@ import shutil
 os.environ['NUMEXPR_MAX_THREADS'] = str(numexpr.detect_number_of_cores())
 
 from db_dataset import create_dataloader
-from utils.general import LOGGER, Loggers, CUDA, DEVICE
+from seg_dataset import letterbox_padding_ratio
+from utils.general import LOGGER, Loggers, CUDA, DEVICE, epoch_stats, DeviceLoader
 import time
 import random
 
@@ -36,6 +37,7 @@ def eval_model(model: nn.Module, val_loader, post_process, metric_cls):
     raw_metrics = []
     total_frame = 0.0
     total_time = 0.0
+    num_pruned = 0
     model.eval()
     for i, batch in tqdm(enumerate(val_loader), total=len(val_loader), desc='test model'):
         with torch.no_grad():
@@ -48,12 +50,14 @@ def eval_model(model: nn.Module, val_loader, post_process, metric_cls):
             with amp.autocast():
                 preds = model(batch['imgs'])
             boxes, scores = post_process(batch, preds,is_output_polygon=False)
+            num_pruned += sum(post_process.num_pruned)
             total_frame += batch['imgs'].size()[0]
             total_time += time.time() - start
             raw_metric = metric_cls.validate_measure(batch, (boxes, scores))
             raw_metrics.append(raw_metric)
     metrics = metric_cls.gather_measure(raw_metrics)
     LOGGER.info('FPS:{}'.format(total_frame / total_time))
+    LOGGER.info(f'contours pruned before unclip: {num_pruned} ({num_pruned / max(total_frame, 1):.1f} per image)')
     return metrics['recall'].avg, metrics['precision'].avg, metrics['fmeasure'].avg
 
 def train(hyp):
@@ -68,134 +72,144 @@ def train(hyp):
     if hyp_train['loss'] == 'bce':
         use_bce = True
     shrink_with_sigmoid = not use_bce
-
-    model = TextDetector(hyp_model['weights'], map_location='cpu', act=hyp_model['act'])
-    model.initialize_db(hyp_model['unet_weights'])
-    model.dbnet.shrink_with_sigmoid = shrink_with_sigmoid
-    model.train_db()
-    model.to(DEVICE)
-
-    if hyp_model['db_weights'] != '':
-        model.dbnet.load_state_dict(torch.load(hyp_model['db_weights'])['weights'])
-    if hyp_train['optimizer'] == 'adam': 
-        optimizer = Adam(model.dbnet.parameters(), lr=hyp_train['lr0'], betas=(0.937, 0.999), weight_decay=0.00002)  # adjust beta1 to momentum
-    else:
-        optimizer = SGD(model.dbnet.parameters(), lr=hyp_train['lr0'], momentum=hyp_train['momentum'], nesterov=True, weight_decay=hyp_train['weight_decay'])
+    # spawn the eval workers before the model goes to the gpu and the loaders start their threads
+    with QuadMetric(num_workers=hyp_train.get('eval_workers', 0)) as metric_cls:
+        model = TextDetector(hyp_model['weights'], map_location='cpu', act=hyp_model['act'])
+        model.initialize_db(hyp_model['unet_weights'])
+        model.dbnet.shrink_with_sigmoid = shrink_with_sigmoid
+        model.train_db()
+        model.to(DEVICE)
+
+        if hyp_model['db_weights'] != '':
+            model.dbnet.load_state_dict(torch.load(hyp_model['db_weights'])['weights'])
+        if hyp_train['optimizer'] == 'adam': 
+            optimizer = Adam(model.dbnet.parameters(), lr=hyp_train['lr0'], betas=(0.937, 0.999), weight_decay=0.00002)  # adjust beta1 to momentum
+        else:
+            optimizer = SGD(model.dbnet.parameters(), lr=hyp_train['lr0'], momentum=hyp_train['momentum'], nesterov=True, weight_decay=hyp_train['weight_decay'])
     
-    if hyp_train['linear_lr']:
-        lf = lambda x: (1 - x / (epochs - 1)) * (1.0 - hyp_train['lrf']) + hyp_train['lrf']  # linear
-    else:
-        lf = one_cycle(1, hyp_train['lrf'], epochs)  # cosine 1->hyp['lrf']
-
-    if hyp_train['linear_lr']:
-        lf = lambda x: (1 - x / (epochs - 1)) * (1.0 - hyp_train['lrf']) + hyp_train['lrf']  # linear
-    else:
-        lf = one_cycle(1, hyp_train['lrf'], epochs)  # cosine 1->hyp['lrf']
-    scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)  # plot_lr_scheduler(optimizer, scheduler, epochs)
+        if hyp_train['linear_lr']:
+            lf = lambda x: (1 - x / (epochs - 1)) * (1.0 - hyp_train['lrf']) + hyp_train['lrf']  # linear
+        else:
+            lf = one_cycle(1, hyp_train['lrf'], epochs)  # cosine 1->hyp['lrf']
+
+        if hyp_train['linear_lr']:
+            lf = lambda x: (1 - x / (epochs - 1)) * (1.0 - hyp_train['lrf']) + hyp_train['lrf']  # linear
+        else:
+            lf = one_cycle(1, hyp_train['lrf'], epochs)  # cosine 1->hyp['lrf']
+        scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)  # plot_lr_scheduler(optimizer, scheduler, epochs)
     
-    logger = None
-    if hyp_resume['resume_training']:
-        LOGGER.info(f'resume traning ... ')
-        ckpt = torch.load(hyp_resume['ckpt'], map_location=DEVICE)
-        model.dbnet.load_state_dict(ckpt['weights'])
-        optimizer.load_state_dict(ckpt['optimizer'])
-        scheduler.load_state_dict(ckpt['scheduler'])
-        scheduler.step()
-        start_epoch = ckpt['epoch'] + 1
-        hyp_logger['run_id'] = ckpt['run_id']
-        logger = Loggers(hyp)
-
-    else:
-        # if hyp_logger['type'] == 'wandb':
-        logger = Loggers(hyp)
-
-    train_img_dir, train_mask_dir, imgsz, augment, aug_param = hyp_data['train_img_dir'], hyp_data['train_mask_dir'], hyp_data['imgsz'], hyp_data['augment'], hyp_data['aug_param']
-    val_img_dir, val_mask_dir = hyp_data['val_img_dir'], hyp_data['val_mask_dir']
-    train_dataset, train_loader = create_dataloader(train_img_dir, train_mask_dir, imgsz, batch_size, augment, aug_param, shuffle=True, workers=hyp_data['num_workers'], cache=hyp_data['cache'])
-    val_dataset, val_loader = create_dataloader(val_img_dir, val_mask_dir, imgsz, batch_size, augment=False, shuffle=False, workers=hyp_data['num_workers'], cache=hyp_data['cache'], with_ann=True)
-    nb = len(train_loader)
-    nw = max(round(3 * nb), 700)
-
-    LOGGER.info(f'num training imgs: {len(train_dataset)}, num val imgs: {len(val_dataset)}')
-
-    eval_interval = hyp_train['eval_interval']
-    best_f1 = best_epoch = -1
-    best_val_loss = np.inf
-
-    accumulation_steps = hyp_train['accumulation_steps']
-    summary(model, (3, 640, 640), device=DEVICE)
-    metric_cls = QuadMetric()
-    post_process = SegDetectorRepresenter(thresh=0.5)
-    best_f1 = -1
-    for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
-        model.train_db()
-        pbar = enumerate(train_loader)
-        pbar = tqdm(pbar, total=nb, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
-        m_loss = 0
-        m_loss_s = 0
-        m_loss_t = 0
-        m_loss_b = 0
-        for i, batchs in pbar:
-            if (i+2) % 256 == 0:
-                train_dataset.initialize()
-                pbar.set_description(f' training size: {train_dataset.img_size}')
-            # warm up
-            if hyp_train['warm_up']:
-                ni = i + nb * epoch
-                if ni <= nw:
-                    xi = [0, nw]  # x interp
-                    for j, x in enumerate(optimizer.param_groups):
-                        x['lr'] = np.interp(ni, xi, [hyp_train['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
-                        if 'momentum' in x:
-                            x['momentum'] = np.interp(ni, xi, [hyp_train['warmup_momentum'], hyp_train['momentum']])
-
-            with amp.autocast():
-                for key in batchs.keys():
-                    batchs[key] = batchs[key].cuda()
-                preds = model(batchs['imgs'])
-                metric = criterion(preds, batchs, use_bce)
-            loss = metric['loss'] / accumulation_steps
-            scaler.scale(loss).backward()
-            if (i+1) % accumulation_steps == 0:
-                scaler.step(optimizer)
-                scaler.update()
-                optimizer.zero_grad()
-            m_loss = (m_loss * i + metric['loss'].detach()) / (i + 1)
-            m_loss_s = (m_loss_s * i + metric['loss_shrink_maps'].detach()) / (i + 1)
-            m_loss_t = (m_loss_t * i + metric['loss_threshold_maps'].detach()) / (i + 1)
-            m_loss_b = (m_loss_b * i + metric['loss_binary_maps'].detach()) / (i + 1)
-
-        if i % eval_interval == 0:
-            recall, precision, fmeasure = eval_model(model,  val_loader, post_process, metric_cls)
+        logger = None
+        if hyp_resume['resume_training']:
+            LOGGER.info(f'resume traning ... ')
+            ckpt = torch.load(hyp_resume['ckpt'], map_location=DEVICE)
+            model.dbnet.load_state_dict(ckpt['weights'])
+            optimizer.load_state_dict(ckpt['optimizer'])
+            scheduler.load_state_dict(ckpt['scheduler'])
+            scheduler.step()
+            start_epoch = ckpt['epoch'] + 1
+            hyp_logger['run_id'] = ckpt['run_id']
+            logger = Loggers(hyp)
+
+        else:
+            # if hyp_logger['type'] == 'wandb':
+            logger = Loggers(hyp)
+
+        train_img_dir, train_mask_dir, imgsz, augment, aug_param = hyp_data['train_img_dir'], hyp_data['train_mask_dir'], hyp_data['imgsz'], hyp_data['augment'], hyp_data['aug_param']
+        val_img_dir, val_mask_dir = hyp_data['val_img_dir'], hyp_data['val_mask_dir']
+        map_cache_dir = hyp_data.get('map_cache_dir')   # maps of non-augmented sets, built by the dataset if missing or stale
+        train_dataset, train_loader = create_dataloader(train_img_dir, train_mask_dir, imgsz, batch_size, augment, aug_param, shuffle=True, workers=hyp_data['num_workers'], cache=hyp_data['cache'], map_cache_dir=map_cache_dir, cache_gb=hyp_data.get('cache_gb', 7), cache_dir=hyp_data.get('cache_dir'), shard_dir=hyp_data.get('train_shard_dir'), rect=hyp_data.get('rect', False), border_distance_transform=hyp_data.get('border_distance_transform', False))
+        val_dataset, val_loader = create_dataloader(val_img_dir, val_mask_dir, imgsz, batch_size, augment=False, shuffle=False, workers=hyp_data['num_workers'], cache=hyp_data['cache'], with_ann=True, map_cache_dir=map_cache_dir, cache_gb=hyp_data.get('cache_gb', 7), cache_dir=hyp_data.get('cache_dir'), shard_dir=hyp_data.get('val_shard_dir'), border_distance_transform=hyp_data.get('border_distance_transform', False))
+        train_loader = DeviceLoader(train_loader)   # pinned, asynchronous copies of the next batch while this one trains
+        # AspectRatioBatchSampler measures its own padding, square letterboxing pads the same share every epoch
+        square_padding_ratio = None if hyp_data.get('rect', False) else letterbox_padding_ratio(train_dataset.aspect_ratios())
+        nb = len(train_loader)
+        nw = max(round(3 * nb), 700)
+
+        LOGGER.info(f'num training imgs: {len(train_dataset)}, num val imgs: {len(val_dataset)}')
+
+        eval_interval = hyp_train['eval_interval']
+        best_f1 = best_epoch = -1
+        best_val_loss = np.inf
+
+        accumulation_steps = hyp_train['accumulation_steps']
+        if hyp_train.get('summary', False):
+            summary(model, (3, 640, 640), device=DEVICE)
+        # QuadMetric only counts boxes scoring >= 0.6 and the unfiltered path keeps short sides >= 2, so dropping the rest
+        # before unclip leaves the metrics unchanged
+        post_process = SegDetectorRepresenter(thresh=0.5, box_thresh=0.6, min_size=2, filter_boxes=True, inclusive_thresh=True)
+        best_f1 = -1
+        for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
+            model.train_db()
+            pbar = enumerate(train_loader)
+            pbar = tqdm(pbar, total=nb, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
+            m_loss = 0
+            m_loss_s = 0
+            m_loss_t = 0
+            m_loss_b = 0
+            t0, num_imgs = time.time(), 0
+            for i, batchs in pbar:
+                num_imgs += batchs['imgs'].shape[0]
+                if (i+2) % 256 == 0:
+                    train_dataset.initialize()
+                    pbar.set_description(f' training size: {train_dataset.img_size}')
+                # warm up
+                if hyp_train['warm_up']:
+                    ni = i + nb * epoch
+                    if ni <= nw:
+                        xi = [0, nw]  # x interp
+                        for j, x in enumerate(optimizer.param_groups):
+                            x['lr'] = np.interp(ni, xi, [hyp_train['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
+                            if 'momentum' in x:
+                                x['momentum'] = np.interp(ni, xi, [hyp_train['warmup_momentum'], hyp_train['momentum']])
+
+                with amp.autocast():
+                    preds = model(batchs['imgs'])
+                    metric = criterion(preds, batchs, use_bce)
+                loss = metric['loss'] / accumulation_steps
+                scaler.scale(loss).backward()
+                if (i+1) % accumulation_steps == 0:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
+                m_loss = (m_loss * i + metric['loss'].detach()) / (i + 1)
+                m_loss_s = (m_loss_s * i + metric['loss_shrink_maps'].detach()) / (i + 1)
+                m_loss_t = (m_loss_t * i + metric['loss_threshold_maps'].detach()) / (i + 1)
+                m_loss_b = (m_loss_b * i + metric['loss_binary_maps'].detach()) / (i + 1)
+            throughput, padding_ratio = epoch_stats(train_loader, num_imgs, t0, square_padding_ratio)
             log_dict = {}
             log_dict['train/lr'] = optimizer.param_groups[0]['lr']
             log_dict['train/loss'] = m_loss
             log_dict['train/loss_shrink'] = m_loss_s
             log_dict['train/loss_threshold'] = m_loss_t
             log_dict['train/loss_binary_maps'] = m_loss_b
-            log_dict['eval/recall'] = recall
-            log_dict['eval/precision'] = precision
-            log_dict['eval/f1'] = fmeasure
+            log_dict['train/imgs_per_sec'] = throughput
+            log_dict['train/padding_ratio'] = padding_ratio
+
+            if i % eval_interval == 0:
+                recall, precision, fmeasure = eval_model(model,  val_loader, post_process, metric_cls)
+                log_dict['eval/recall'] = recall
+                log_dict['eval/precision'] = precision
+                log_dict['eval/f1'] = fmeasure
             
-            save_best = best_f1 < fmeasure
-            if save_best:
-                best_f1 = fmeasure
-            last_ckpt = {'epoch': epoch,
-                        'best_f1': best_f1,
-                        'weights': model.dbnet.state_dict(),
-                        'best_val_loss': best_val_loss,
-                        'optimizer': optimizer.state_dict(),
-                        'scheduler': scheduler.state_dict(),
-                        'run_id': logger.wandb.id if logger.wandb is not None else None,
-                        'date': datetime.now().isoformat(),
-                        'hyp': hyp}
-            torch.save(last_ckpt, 'data/db_last.ckpt')
-            if save_best:
-                shutil.copy('data/db_last.ckpt', 'data/db_best.ckpt')
+                save_best = best_f1 < fmeasure
+                if save_best:
+                    best_f1 = fmeasure
+                last_ckpt = {'epoch': epoch,
+                            'best_f1': best_f1,
+                            'weights': model.dbnet.state_dict(),
+                            'best_val_loss': best_val_loss,
+                            'optimizer': optimizer.state_dict(),
+                            'scheduler': scheduler.state_dict(),
+                            'run_id': logger.wandb.id if logger.wandb is not None else None,
+                            'date': datetime.now().isoformat(),
+                            'hyp': hyp}
+                torch.save(last_ckpt, 'data/db_last.ckpt')
+                if save_best:
+                    shutil.copy('data/db_last.ckpt', 'data/db_best.ckpt')
             if logger is not None:
                 logger.on_train_epoch_end(epoch, log_dict)
-        scheduler.step()
-        pbar.close()
+            scheduler.step()
+            pbar.close()
 
 if __name__ == '__main__':
     hyp_p = r'data/train_db_hyp.yaml'
@@ -14,10 +14,11 @@ from torchsummary import summary
 import numexpr
 import os
 import shutil
+import time
 os.environ['NUMEXPR_MAX_THREADS'] = str(numexpr.detect_number_of_cores())
 
-from seg_dataset import create_dataloader
-from utils.general import LOGGER, Loggers, CUDA, DEVICE
+from seg_dataset import create_dataloader, BatchAugment, letterbox_padding_ratio
+from utils.general import LOGGER, Loggers, CUDA, DEVICE, epoch_stats, DeviceLoader
 import random
 
 torch.random.manual_seed(0)
@@ -105,8 +106,12 @@ def train(hyp):
     num_workers = 8
     train_img_dir, train_mask_dir, imgsz, augment, aug_param = hyp_data['train_img_dir'], hyp_data['train_mask_dir'], hyp_data['imgsz'], hyp_data['augment'], hyp_data['aug_param']
     val_img_dir, val_mask_dir = hyp_data['val_img_dir'], hyp_data['val_mask_dir']
-    train_dataset, train_loader = create_dataloader(train_img_dir, train_mask_dir, imgsz, batch_size, augment, aug_param, shuffle=True, workers=num_workers, cache=hyp_data['cache'])
-    val_dataset, val_loader = create_dataloader(val_img_dir, val_mask_dir, imgsz, 4, augment=False, shuffle=False, workers=num_workers, cache=hyp_data['cache'])
+    train_dataset, train_loader = create_dataloader(train_img_dir, train_mask_dir, imgsz, batch_size, augment, aug_param, shuffle=True, workers=num_workers, cache=hyp_data['cache'], cache_gb=hyp_data.get('cache_gb', 7), cache_dir=hyp_data.get('cache_dir'), shard_dir=hyp_data.get('train_shard_dir'), rect=hyp_data.get('rect', False), batch_augment=hyp_data.get('batch_augment', False))
+    val_dataset, val_loader = create_dataloader(val_img_dir, val_mask_dir, imgsz, 4, augment=False, shuffle=False, workers=num_workers, cache=hyp_data['cache'], cache_gb=hyp_data.get('cache_gb', 7), cache_dir=hyp_data.get('cache_dir'), shard_dir=hyp_data.get('val_shard_dir'))
+    batch_augment = BatchAugment(aug_param if augment else None) if train_dataset.batch_augment else None
+    train_loader = DeviceLoader(train_loader)   # pinned, asynchronous copies of the next batch while this one trains
+    # AspectRatioBatchSampler measures its own padding, square letterboxing pads the same share every epoch
+    square_padding_ratio = None if hyp_data.get('rect', False) else letterbox_padding_ratio(train_dataset.aspect_ratios())
     nb = len(train_loader)
     nw = max(round(3 * nb), 700)
 
@@ -116,7 +121,8 @@ def train(hyp):
     best_f1 = -1
     best_val_loss = np.inf
     accumulation_steps = hyp_train['accumulation_steps']
-    summary(model, (3, 640, 640), device=DEVICE)
+    if hyp_train.get('summary', False):
+        summary(model, (3, 640, 640), device=DEVICE)
     for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
         
         model.train_mask()
@@ -125,7 +131,9 @@ def train(hyp):
         pbar = tqdm(pbar, total=nb, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
         
         m_loss = 0
+        t0, num_imgs = time.time(), 0
         for i, (imgs, masks) in pbar:
+            num_imgs += imgs.shape[0]
             
             pbar.set_description(f' training size: {train_dataset.img_size}')
             # warm up
@@ -137,7 +145,10 @@ def train(hyp):
                     if 'momentum' in x:
                         x['momentum'] = np.interp(ni, xi, [hyp_train['warmup_momentum'], hyp_train['momentum']])
 
-            imgs, masks = imgs.to(DEVICE), masks.to(DEVICE)
+            if batch_augment is not None:
+                imgs, masks = batch_augment(imgs, masks)
+            else:
+                imgs, masks = imgs.to(DEVICE), masks.to(DEVICE)
             with amp.autocast():
                 preds = model(imgs)
                 imgs.detach_()
@@ -151,6 +162,12 @@ def train(hyp):
                 scaler.update()
                 optimizer.zero_grad()
             m_loss = (m_loss * i + loss.detach()) / (i + 1)
+        throughput, padding_ratio = epoch_stats(train_loader, num_imgs, t0, square_padding_ratio)
+        log_dict = {}
+        log_dict['train/lr'] = optimizer.param_groups[0]['lr']
+        log_dict['train/loss'] = m_loss
+        log_dict['train/imgs_per_sec'] = throughput
+        log_dict['train/padding_ratio'] = padding_ratio
         
         if (epoch + 1) % eval_interval == 0:
             recall, precision, eval_m_loss = eval_model(model, val_loader)
@@ -170,15 +187,12 @@ def train(hyp):
                 LOGGER.info(f'saving model at epoch {epoch}, best val f1: {best_f1}')
                 shutil.copy2('data/unet_last.ckpt', 'data/unet_best.ckpt')
             LOGGER.info(f'epoch {epoch}/{epochs-1} loss: {m_loss} precision: {precision} recall: {recall}')
-            if logger is not None:
-                log_dict = {}
-                log_dict['train/lr'] = optimizer.param_groups[0]['lr']
-                log_dict['train/loss'] = m_loss
-                log_dict['eval/recall'] = recall
-                log_dict['eval/precision'] = precision
-                log_dict['eval/f1'] = f1
-                log_dict['eval/eval_m_loss'] = eval_m_loss
-                logger.on_train_epoch_end(epoch, log_dict)
+            log_dict['eval/recall'] = recall
+            log_dict['eval/precision'] = precision
+            log_dict['eval/f1'] = f1
+            log_dict['eval/eval_m_loss'] = eval_m_loss
+        if logger is not None:
+            logger.on_train_epoch_end(epoch, log_dict)
         scheduler.step()
         pbar.close()
 
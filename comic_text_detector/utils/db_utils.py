@@ -1,16 +1,16 @@
 import cv2
 import numpy as np
-import pyclipper
-from shapely.geometry import Polygon
 from collections import namedtuple
-import torch
 import warnings
 warnings.filterwarnings('ignore')
 
 
-def iou_rotate(box_a, box_b, method='union'):
-    rect_a = cv2.minAreaRect(box_a)
-    rect_b = cv2.minAreaRect(box_b)
+def iou_rotate(box_a, box_b, method='union', rect_a=None, rect_b=None):
+    # rect_a/rect_b: precomputed cv2.minAreaRect of the boxes
+    if rect_a is None:
+        rect_a = cv2.minAreaRect(box_a)
+    if rect_b is None:
+        rect_b = cv2.minAreaRect(box_b)
     r1 = cv2.rotatedRectangleIntersection(rect_a, rect_b)
     if r1[0] == 0:
         return 0
@@ -29,13 +29,39 @@ def iou_rotate(box_a, box_b, method='union'):
             raise NotImplementedError
         return iou
 
+def aabb_overlaps(boxes_a, boxes_b):
+    # (A, 4), (B, 4) xyxy -> (A, B) bool, True where the boxes overlap or touch
+    return (boxes_a[:, None, 0] <= boxes_b[None, :, 2]) & (boxes_b[None, :, 0] <= boxes_a[:, None, 2]) & \
+        (boxes_a[:, None, 1] <= boxes_b[None, :, 3]) & (boxes_b[None, :, 1] <= boxes_a[:, None, 3])
+
+def polygons_aabb(polygons):
+    return np.array([np.concatenate([np.min(p, axis=0), np.max(p, axis=0)]) for p in polygons], dtype=np.float64).reshape(-1, 4)
+
+def contour_depth(parent):
+    # nesting depth of every contour from the parent column of a cv2.RETR_TREE hierarchy
+    depth = np.zeros(len(parent), dtype=np.int64)
+    p = parent.copy()
+    while (p >= 0).any():
+        depth += p >= 0
+        p = np.where(p >= 0, parent[p], -1)
+    return depth
+
 class SegDetectorRepresenter():
-    def __init__(self, thresh=0.3, box_thresh=0.7, max_candidates=1000, unclip_ratio=1.5):
-        self.min_size = 3
+    def __init__(self, thresh=0.3, box_thresh=0.7, max_candidates=1000, unclip_ratio=1.5, min_size=3, filter_boxes=False, inclusive_thresh=False):
+        '''
+        filter_boxes: drop boxes scoring below box_thresh or with a short side below min_size
+            in boxes_from_bitmap, before any unclip/rescaling is done for them
+        inclusive_thresh: filter_boxes keeps scores >= box_thresh instead of > box_thresh, 
+            like QuadMetric counts them
+        '''
+        self.min_size = min_size
         self.thresh = thresh
         self.box_thresh = box_thresh
+        self.inclusive_thresh = inclusive_thresh
         self.max_candidates = max_candidates
         self.unclip_ratio = unclip_ratio
+        self.filter_boxes = filter_boxes
+        self.num_pruned = []    # number of contours dropped by boxes_from_bitmap for each page of the last batch
 
     def __call__(self, batch, pred, is_output_polygon=False):
         '''
@@ -55,8 +81,9 @@ class SegDetectorRepresenter():
         segmentation = self.binarize(pred)
         boxes_batch = []
         scores_batch = []
+        self.num_pruned = []
         # print(pred.size())
-        batch_size = pred.size(0) if isinstance(pred, torch.Tensor) else pred.shape[0]
+        batch_size = pred.shape[0]
         for batch_index in range(batch_size):
             # height, width = batch['shape'][batch_index]
             height, width = pred.shape[1], pred.shape[2]
@@ -127,45 +154,104 @@ class SegDetectorRepresenter():
         '''
 
         assert len(_bitmap.shape) == 2
-        if isinstance(pred, torch.Tensor):
+        if not isinstance(pred, np.ndarray):
             bitmap = _bitmap.cpu().numpy()  # The first channel
             pred = pred.cpu().detach().numpy()
         else:
             bitmap = _bitmap
         height, width = bitmap.shape
-        contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        num_contours = min(len(contours), self.max_candidates)
-        boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
-        scores = np.zeros((num_contours,), dtype=np.float32)
-
-        for index in range(num_contours):
-            contour = contours[index].squeeze(1)
-            points, sside = self.get_mini_boxes(contour)
-            # if sside < self.min_size:
-            #     continue
-            if sside < 2:
-                continue
-            points = np.array(points)
-            score = self.box_score_fast(pred, contour)
-            # if self.box_thresh > score:
-            #     continue
-
-            box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            # if sside < 5:
-            #     continue
-            box = np.array(box)
-            if not isinstance(dest_width, int):
-                dest_width = dest_width.item()
-                dest_height = dest_height.item()
-
-            box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes[index, :, :] = box.astype(np.int16)
-            scores[index] = score
-        return boxes, scores
+        bitmap = (bitmap * 255).astype(np.uint8)
+        contours, hierarchy = cv2.findContours(bitmap, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            self.num_pruned.append(0)
+            return np.zeros((0, 4, 2), dtype=np.int16), np.zeros((0,), dtype=np.float32)
+        # outer borders sit at even depths of the tree, odd depths are holes (which may hold more components)
+        parent = hierarchy[0, :, 3]
+        depth = contour_depth(parent)
+        outer = np.where(depth % 2 == 0)[0][:self.max_candidates]
+        num_contours = len(outer)
+        scores = self.contour_fill_scores(pred, contours, parent, depth, outer)
+        contours = [contours[ii] for ii in outer]
+        min_size = 2
+        if self.filter_boxes:
+            keep = np.where(scores >= self.box_thresh if self.inclusive_thresh else scores > self.box_thresh)[0]
+            contours, scores = [contours[ii] for ii in keep], scores[keep]
+            min_size = self.min_size
+
+        rects = np.array([(*center, *size, angle) for center, size, angle in map(cv2.minAreaRect, contours)], dtype=np.float64).reshape(-1, 5)
+        valid = rects[:, 2:4].min(axis=1) >= min_size
+        rects, scores = rects[valid], scores[valid]
+        self.num_pruned.append(num_contours - len(rects))
+
+        boxes = self.order_box_points(self.rect_points(self.unclip_rects(rects, unclip_ratio=self.unclip_ratio)))
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+        boxes[..., 0] = np.clip(np.round(boxes[..., 0] / width * dest_width), 0, dest_width)
+        boxes[..., 1] = np.clip(np.round(boxes[..., 1] / height * dest_height), 0, dest_height)
+        return boxes.astype(np.int16), scores
+
+    def contour_fill_scores(self, pred, contours, parent, depth, outer):
+        '''
+        box_score_fast of every outer contour, i.e. the mean of pred over the filled contour (holes included),
+        from one bincount: contours are filled parents first so a nested component keeps its own pixels,
+        then sums are added up the tree to the enclosing contours
+        '''
+        order = outer[np.argsort(depth[outer], kind='stable')]
+        slot = np.full(len(parent), -1, dtype=np.int64)
+        slot[order] = np.arange(len(order))
+        fill = np.zeros(pred.shape[:2], dtype=np.int32)
+        for ii, ci in enumerate(order):
+            cv2.fillPoly(fill, [contours[ci]], ii + 1)
+        inside = np.flatnonzero(fill)
+        fill = fill.ravel()[inside] - 1
+        fill_sum = np.bincount(fill, weights=pred.ravel()[inside], minlength=len(order))
+        fill_area = np.bincount(fill, minlength=len(order)).astype(np.float64)
+        for ii in range(len(order) - 1, -1, -1):
+            if depth[order[ii]] > 0:
+                enclosing = slot[parent[parent[order[ii]]]]
+                if enclosing >= 0:
+                    fill_sum[enclosing] += fill_sum[ii]
+                    fill_area[enclosing] += fill_area[ii]
+        return (fill_sum / np.maximum(fill_area, 1))[slot[outer]].astype(np.float32)
+
+    def unclip_rects(self, rects, unclip_ratio=1.5):
+        '''
+        rects: (N, 5) rotated rectangles (cx, cy, w, h, angle) as returned by cv2.minAreaRect,
+            offsetting a rectangle by area * unclip_ratio / perimeter just grows both sides,
+            which is what unclip + get_mini_boxes end up with
+        '''
+        w, h = rects[:, 2], rects[:, 3]
+        distance = w * h * unclip_ratio / (2 * (w + h))
+        rects = rects.copy()
+        rects[:, 2] += 2 * distance
+        rects[:, 3] += 2 * distance
+        return rects
+
+    def rect_points(self, rects):
+        # vectorized cv2.boxPoints
+        angle = np.deg2rad(rects[:, 4])
+        b, a = np.cos(angle) * 0.5, np.sin(angle) * 0.5
+        cx, cy, w, h = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+        p0 = np.stack((cx - a * h - b * w, cy + b * h - a * w), axis=1)
+        p1 = np.stack((cx + a * h - b * w, cy - b * h - a * w), axis=1)
+        center = rects[:, :2]
+        return np.stack((p0, p1, 2 * center - p0, 2 * center - p1), axis=1)
+
+    def order_box_points(self, points):
+        # vectorized ordering of get_mini_boxes: top-left, top-right, bottom-right, bottom-left
+        idx = np.argsort(points[..., 0], axis=1, kind='stable')
+        points = np.take_along_axis(points, idx[..., None], axis=1)
+        left_swap = ~(points[:, 1, 1] > points[:, 0, 1])
+        right_swap = ~(points[:, 3, 1] > points[:, 2, 1])
+        ordered = points[:, [0, 2, 3, 1]]
+        ordered[left_swap, 0], ordered[left_swap, 3] = points[left_swap, 1], points[left_swap, 0]
+        ordered[right_swap, 1], ordered[right_swap, 2] = points[right_swap, 3], points[right_swap, 2]
+        return ordered
 
     def unclip(self, box, unclip_ratio=1.5):
+        from shapely.geometry import Polygon
+        import pyclipper
         poly = Polygon(box)
         distance = poly.area * unclip_ratio / poly.length
         offset = pyclipper.PyclipperOffset()
@@ -237,6 +323,7 @@ class DetectionIoUEvaluator(object):
         self.area_precision_constraint = area_precision_constraint
 
     def evaluate_image(self, gt, pred):
+        from shapely.geometry import Polygon
 
         def get_union(pD, pG):
             return Polygon(pD).union(Polygon(pG)).area
@@ -332,8 +419,11 @@ class DetectionIoUEvaluator(object):
             detPols.append(detPol)
             detPolPoints.append(points)
             if len(gtDontCarePolsNum) > 0:
+                detBox = polygons_aabb([detPol])
                 for dontCarePol in gtDontCarePolsNum:
                     dontCarePol = gtPols[dontCarePol]
+                    if not aabb_overlaps(polygons_aabb([dontCarePol]), detBox)[0, 0]:
+                        continue
                     intersected_area = get_intersection(dontCarePol, detPol)
                     pdDimensions = Polygon(detPol).area
                     precision = 0 if pdDimensions == 0 else intersected_area / pdDimensions
@@ -351,31 +441,32 @@ class DetectionIoUEvaluator(object):
             gtRectMat = np.zeros(len(gtPols), np.int8)
             detRectMat = np.zeros(len(detPols), np.int8)
             if self.is_output_polygon:
-                for gtNum in range(len(gtPols)):
-                    for detNum in range(len(detPols)):
-                        pG = gtPols[gtNum]
-                        pD = detPols[detNum]
-                        iouMat[gtNum, detNum] = get_intersection_over_union(pD, pG)
+                # only pairs whose bounding boxes overlap can have a nonzero iou
+                candidates = aabb_overlaps(polygons_aabb(gtPols), polygons_aabb(detPols))
+                iouMat[:] = 0
+                for gtNum, detNum in zip(*np.nonzero(candidates)):
+                    iouMat[gtNum, detNum] = get_intersection_over_union(detPols[detNum], gtPols[gtNum])
             else:
-                # gtPols = np.float32(gtPols)
-                # detPols = np.float32(detPols)
-                for gtNum in range(len(gtPols)):
-                    for detNum in range(len(detPols)):
-                        pG = np.float32(gtPols[gtNum])
-                        pD = np.float32(detPols[detNum])
-                        iouMat[gtNum, detNum] = iou_rotate(pD, pG)
-            for gtNum in range(len(gtPols)):
-                for detNum in range(len(detPols)):
-                    if gtRectMat[gtNum] == 0 and detRectMat[
-                        detNum] == 0 and gtNum not in gtDontCarePolsNum and detNum not in detDontCarePolsNum:
-                        if iouMat[gtNum, detNum] > self.iou_constraint:
-                            gtRectMat[gtNum] = 1
-                            detRectMat[detNum] = 1
-                            detMatched += 1
-                            pairs.append({'gt': gtNum, 'det': detNum})
-                            detMatchedNums.append(detNum)
-                            evaluationLog += "Match GT #" + \
-                                             str(gtNum) + " with Det #" + str(detNum) + "\n"
+                # iou_rotate compares min area rects, so prefilter on their bounding boxes
+                gtBoxes, detBoxes = [np.float32(p) for p in gtPols], [np.float32(p) for p in detPols]
+                gtRects, detRects = [cv2.minAreaRect(p) for p in gtBoxes], [cv2.minAreaRect(p) for p in detBoxes]
+                candidates = aabb_overlaps(polygons_aabb([cv2.boxPoints(r) for r in gtRects]), polygons_aabb([cv2.boxPoints(r) for r in detRects]))
+                iouMat[:] = 0
+                for gtNum, detNum in zip(*np.nonzero(candidates)):
+                    iouMat[gtNum, detNum] = iou_rotate(detBoxes[detNum], gtBoxes[gtNum], rect_a=detRects[detNum], rect_b=gtRects[gtNum])
+            # greedy matching in gt/det order, same as looping over every pair
+            gtDontCareSet, detDontCareSet = set(gtDontCarePolsNum), set(detDontCarePolsNum)
+            for gtNum, detNum in zip(*np.nonzero(iouMat > self.iou_constraint)):
+                gtNum, detNum = int(gtNum), int(detNum)
+                if gtRectMat[gtNum] == 0 and detRectMat[
+                    detNum] == 0 and gtNum not in gtDontCareSet and detNum not in detDontCareSet:
+                    gtRectMat[gtNum] = 1
+                    detRectMat[detNum] = 1
+                    detMatched += 1
+                    pairs.append({'gt': gtNum, 'det': detNum})
+                    detMatchedNums.append(detNum)
+                    evaluationLog += "Match GT #" + \
+                                     str(gtNum) + " with Det #" + str(detNum) + "\n"
 
         numGtCare = (len(gtPols) - len(gtDontCarePolsNum))
         numDetCare = (len(detPols) - len(detDontCarePolsNum))
@@ -435,9 +526,32 @@ class DetectionIoUEvaluator(object):
         return methodMetrics
 
 class QuadMetric():
-    def __init__(self, is_output_polygon=False):
+    def __init__(self, is_output_polygon=False, num_workers=0):
+        '''
+        num_workers: evaluate images in a process pool, measure() then returns pending results
+            which gather_measure collects, so evaluation overlaps with inference of the next batches.
+            the pool is spawned here rather than forked mid training (cuda and loader threads are
+            running by then), create the metric early and close() it when done
+        '''
         self.is_output_polygon = is_output_polygon
         self.evaluator = DetectionIoUEvaluator(is_output_polygon=is_output_polygon)
+        self.num_workers = num_workers
+        self.pool = None
+        if num_workers > 0:
+            import multiprocessing
+            self.pool = multiprocessing.get_context('spawn').Pool(num_workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def measure(self, batch, output, box_thresh=0.6):
         '''
@@ -450,12 +564,16 @@ class QuadMetric():
             filename: the original filenames of images.
         output: (polygons, ...)
         '''
-        results = []
+        samples = []
         gt_polyons_batch = batch['text_polys']
         ignore_tags_batch = batch['ignore_tags']
-        pred_polygons_batch = np.array(output[0])
-        pred_scores_batch = np.array(output[1])
+        # per image, pages have different numbers of boxes
+        pred_polygons_batch = output[0]
+        pred_scores_batch = output[1]
         for polygons, pred_polygons, pred_scores, ignore_tags in zip(gt_polyons_batch, pred_polygons_batch, pred_scores_batch, ignore_tags_batch):
+            # plain arrays rather than (per element) tensors, cheaper to index and to send to the pool
+            polygons, ignore_tags = np.asarray(polygons), np.asarray(ignore_tags)
+            pred_polygons, pred_scores = np.asarray(pred_polygons), np.asarray(pred_scores)
             gt = [dict(points=np.int64(polygons[i]), ignore=ignore_tags[i]) for i in range(len(polygons))]
             if self.is_output_polygon:
                 pred = [dict(points=pred_polygons[i]) for i in range(len(pred_polygons))]
@@ -467,8 +585,10 @@ class QuadMetric():
                         # print(pred_polygons[i,:,:].tolist())
                         pred.append(dict(points=pred_polygons[i, :, :].astype(np.int64)))
                 # pred = [dict(points=pred_polygons[i,:,:].tolist()) if pred_scores[i] >= box_thresh for i in range(pred_polygons.shape[0])]
-            results.append(self.evaluator.evaluate_image(gt, pred))
-        return results
+            samples.append((gt, pred))
+        if self.pool is not None:
+            return self.pool.starmap_async(self.evaluator.evaluate_image, samples)
+        return [self.evaluator.evaluate_image(gt, pred) for gt, pred in samples]
 
     def validate_measure(self, batch, output, box_thresh=0.6):
         return self.measure(batch, output, box_thresh)
@@ -477,9 +597,10 @@ class QuadMetric():
         return self.measure(batch, output), np.linspace(0, batch['image'].shape[0]).tolist()
 
     def gather_measure(self, raw_metrics):
+        from multiprocessing.pool import AsyncResult
         raw_metrics = [image_metrics
                        for batch_metrics in raw_metrics
-                       for image_metrics in batch_metrics]
+                       for image_metrics in (batch_metrics.get() if isinstance(batch_metrics, AsyncResult) else batch_metrics)]
 
         result = self.evaluator.combine_results(raw_metrics)
 
@@ -593,10 +714,18 @@ class MakeShrinkMap():
 
 
 class MakeBorderMap():
-    def __init__(self, shrink_ratio=0.4, thresh_min=0.3, thresh_max=0.7):
+    def __init__(self, shrink_ratio=0.4, thresh_min=0.3, thresh_max=0.7, distance_transform=False):
+        '''
+        distance_transform: distances to the polygon from one cv2.distanceTransform over its rasterized outline,
+            instead of a dense point-to-edge distance per edge. ~4x faster, neither is exact: the outline is drawn at 
+            integer coordinates (up to ~0.5px off, ~0.1 in the threshold map of thin lines), while distance() takes 
+            the nearest endpoint wherever the angle at the pixel is acute (overestimates near short edges, up to ~0.03).
+            see tests/bench_border_map.py
+        '''
         self.shrink_ratio = shrink_ratio
         self.thresh_min = thresh_min
         self.thresh_max = thresh_max
+        self.distance_transform = distance_transform
 
     def __call__(self, data: dict) -> dict:
         """
@@ -626,6 +755,8 @@ class MakeBorderMap():
         assert polygon.ndim == 2
         assert polygon.shape[1] == 2
 
+        from shapely.geometry import Polygon
+        import pyclipper
         polygon_shape = Polygon(polygon)
         if polygon_shape.area <= 0:
             return
@@ -648,18 +779,24 @@ class MakeBorderMap():
         polygon[:, 0] = polygon[:, 0] - xmin
         polygon[:, 1] = polygon[:, 1] - ymin
 
-        xs = np.broadcast_to(
-            np.linspace(0, width - 1, num=width).reshape(1, width), (height, width))
-        ys = np.broadcast_to(
-            np.linspace(0, height - 1, num=height).reshape(height, 1), (height, width))
-
-        distance_map = np.zeros(
-            (polygon.shape[0], height, width), dtype=np.float32)
-        for i in range(polygon.shape[0]):
-            j = (i + 1) % polygon.shape[0]
-            absolute_distance = self.distance(xs, ys, polygon[i], polygon[j])
-            distance_map[i] = np.clip(absolute_distance / distance, 0, 1)
-        distance_map = distance_map.min(axis=0)
+        if self.distance_transform:
+            outline = np.full((height, width), 255, dtype=np.uint8)
+            cv2.polylines(outline, [np.round(polygon).astype(np.int32)], True, 0, 1)
+            absolute_distance = cv2.distanceTransform(outline, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            distance_map = np.clip(absolute_distance / distance, 0, 1)
+        else:
+            xs = np.broadcast_to(
+                np.linspace(0, width - 1, num=width).reshape(1, width), (height, width))
+            ys = np.broadcast_to(
+                np.linspace(0, height - 1, num=height).reshape(height, 1), (height, width))
+
+            distance_map = np.zeros(
+                (polygon.shape[0], height, width), dtype=np.float32)
+            for i in range(polygon.shape[0]):
+                j = (i + 1) % polygon.shape[0]
+                absolute_distance = self.distance(xs, ys, polygon[i], polygon[j])
+                distance_map[i] = np.clip(absolute_distance / distance, 0, 1)
+            distance_map = distance_map.min(axis=0)
 
         xmin_valid = min(max(0, xmin), canvas.shape[1] - 1)
         xmax_valid = min(max(0, xmax), canvas.shape[1] - 1)
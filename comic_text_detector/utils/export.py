@@ -1,18 +1,16 @@
 
-from cv2 import imshow
-from matplotlib import lines
 import numpy as np
-import onnxruntime
 import cv2
+import time
 import torch
 import onnx
 from basemodel import TextDetBase
-import onnxsim
 from models.yolov5.common import Conv
 from models.yolov5.yolo import Detect
 import torch.nn as nn
-import time
-from seg_dataset import letterbox
+from utils.imgproc_utils import letterbox, letterbox_blob
+from utils.io_utils import find_all_imgs, imread
+from utils.general import LOGGER
 from utils.yolov5_utils import fuse_conv_and_bn
 
 class SiLU(nn.Module):  # export-friendly version of nn.SiLU()
@@ -27,32 +25,147 @@ def concate_models(blk_weights, seg_weights, det_weights, save_path):
     textdetector_dict['text_det'] = torch.load(det_weights, map_location='cpu')['weights']
     torch.save(textdetector_dict, save_path)
 
-def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=False, inplace=False):
+def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=False, inplace=False, output_names=('blk', 'seg', 'det')):
     # YOLOv5 ONNX export
+    # output_names: heads kept in the graph, wrap the model with basemodel.TextDetHeads to export a subset
     f = file + '.onnx'
+    output_names = list(output_names)
     for k, m in model.named_modules():
         if isinstance(m, Conv):  # assign export-friendly activations
             if isinstance(m.act, nn.SiLU):
                 m.act = SiLU()
         elif isinstance(m, Detect):
             m.inplace = inplace
-            m.onnx_dynamic = False
+            m.onnx_dynamic = dynamic   # recompute anchor grids from the input shape
     torch.onnx.export(model, im, f, verbose=False, opset_version=opset,
                         training=torch.onnx.TrainingMode.TRAINING if train else torch.onnx.TrainingMode.EVAL,
                         do_constant_folding=not train,
                         input_names=['images'],
-                        output_names=['blk', 'seg', 'det'],
+                        output_names=output_names,
                         dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # shape(1,3,640,640)
-                                    'output': {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
+                                    **{name: axes for name, axes in (('blk', {0: 'batch', 1: 'anchors'}),  # shape(1,25200,85)
+                                                                     ('seg', {0: 'batch', 2: 'height', 3: 'width'}),
+                                                                     ('det', {0: 'batch', 2: 'height', 3: 'width'})) if name in output_names}
                                     } if dynamic else None)
 
     # Checks
     model_onnx = onnx.load(f)  # load onnx model
     onnx.checker.check_model(model_onnx)  # check onnx model
 
-    model_onnx, check = onnxsim.simplify(
-        model_onnx,
-        dynamic_input_shape=dynamic,
-        input_shapes={'images': list(im.shape)} if dynamic else None)
-    assert check, 'assert check failed'
-    onnx.save(model_onnx, f)
\ No newline at end of file
+    if simplify:
+        import onnxsim
+        model_onnx, check = onnxsim.simplify(
+            model_onnx,
+            dynamic_input_shape=dynamic,
+            input_shapes={'images': list(im.shape)} if dynamic else None)
+        assert check, 'assert check failed'
+    onnx.save(model_onnx, f)
+
+def export_heads(model_path, file, heads=('blk', 'det'), input_size=1024, opset=11, dynamic=False, act='leaky'):
+    '''
+    export a graph with only the given heads, e.g. blocks + lines without the unet mask decoder
+    '''
+    from basemodel import TextDetHeads
+    model = TextDetHeads(TextDetBase(model_path, device='cpu', act=act, heads=heads)).eval()
+    im = torch.zeros((1, 3, input_size, input_size))
+    export_onnx(model, im, file, opset, dynamic=dynamic, output_names=[name for name in ('blk', 'seg', 'det') if name in heads])
+
+def export_fp16(onnx_path, save_path):
+    # fp16 weights, inputs and outputs stay fp32 so the detector feeds it like the fp32 model
+    from onnxconverter_common import float16
+    model_onnx = float16.convert_float_to_float16(onnx.load(onnx_path), keep_io_types=True)
+    onnx.save(model_onnx, save_path)
+
+class PageCalibrationReader:
+    '''
+    feeds preprocessed pages to onnxruntime's static quantization calibrator
+    '''
+    def __init__(self, img_dir, input_size=1024, num_imgs=64, input_name='images'):
+        self.imglist = sorted(find_all_imgs(img_dir, abs_path=True))[:num_imgs]
+        self.input_size = input_size
+        self.input_name = input_name
+        self.index = 0
+
+    def get_next(self):
+        if self.index >= len(self.imglist):
+            return None
+        img = imread(self.imglist[self.index])
+        self.index += 1
+        blob, _, _ = letterbox_blob(img, new_shape=self.input_size, swap_rb=True)
+        return {self.input_name: blob}
+
+    def rewind(self):
+        self.index = 0
+
+def quantize_int8(onnx_path, save_path, calib_img_dir, input_size=1024, num_calib_imgs=64, per_channel=True):
+    '''
+    static int8 quantization (QDQ), activations are calibrated on pages from calib_img_dir
+    '''
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType, CalibrationMethod
+    reader = PageCalibrationReader(calib_img_dir, input_size=input_size, num_imgs=num_calib_imgs)
+    quantize_static(onnx_path, save_path, reader,
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=per_channel,
+                    calibrate_method=CalibrationMethod.MinMax)
+
+def time_detector(detector, imgs):
+    '''
+    block quads of every page and mean detection latency (ms), after one warmup page
+    '''
+    detector.detect(imgs[0])
+    blk_lists, latency = [], []
+    for img in imgs:
+        t0 = time.perf_counter()
+        blk_list, _ = detector.detect(img)
+        latency.append(time.perf_counter() - t0)
+        blk_lists.append([[[x1, y1], [x2, y1], [x2, y2], [x1, y2]] for x1, y1, x2, y2 in (blk.xyxy for blk in blk_list)])
+    return blk_lists, np.mean(latency) * 1000
+
+def detector_report(detectors: dict, img_dir, num_imgs=None):
+    '''
+    latency of each detector and its block recall/precision against the first one
+    '''
+    from utils.db_utils import DetectionIoUEvaluator
+    imglist = sorted(find_all_imgs(img_dir, abs_path=True))[:num_imgs]
+    imgs = [imread(p) for p in imglist]
+    evaluator = DetectionIoUEvaluator()
+
+    report, ref_blks = {}, None
+    for name, detector in detectors.items():
+        blk_lists, latency = time_detector(detector, imgs)
+        if ref_blks is None:
+            ref_blks = blk_lists
+            report[name] = {'latency': latency, 'recall': 1., 'precision': 1., 'hmean': 1.}
+            continue
+        results = [evaluator.evaluate_image([dict(points=p, ignore=False) for p in gt], [dict(points=p) for p in pred]) 
+                   for gt, pred in zip(ref_blks, blk_lists)]
+        report[name] = dict(latency=latency, **evaluator.combine_results(results))
+    for name, metrics in report.items():
+        LOGGER.info(f"{name}: {metrics['latency']:.1f}ms/page, block recall {metrics['recall']:.4f}, precision {metrics['precision']:.4f}, hmean {metrics['hmean']:.4f}")
+    return report
+
+def quantization_report(model_path, img_dir, precisions=('fp16', 'int8'), input_size=1024, num_imgs=None):
+    '''
+    latency of each precision and its block recall/precision against the fp32 model's blocks,
+    the quantized models are expected next to model_path (see inference.quantized_model_path)
+    '''
+    from inference import TextDetector
+    detectors = {precision: TextDetector(model_path, input_size=input_size, precision=precision) for precision in ('fp32', ) + tuple(precisions)}
+    return detector_report(detectors, img_dir, num_imgs)
+
+def torch_backend_report(torch_model_path, onnx_model_path, img_dir, input_size=1024, num_imgs=None):
+    '''
+    cpu latency of the torch backend with and without the inference optimizations against the onnx (opencv) backend, 
+    on the same pages, accuracy is measured against the plain torch model
+    '''
+    from inference import TextDetector
+    detectors = {
+        'torch': TextDetector(torch_model_path, input_size=input_size),
+        'torch fused': TextDetector(torch_model_path, input_size=input_size, fuse=True),
+        'torch fused channels-last': TextDetector(torch_model_path, input_size=input_size, fuse=True, channels_last=True),
+        'torch fused torchscript': TextDetector(torch_model_path, input_size=input_size, fuse=True, jit='trace'),
+        'onnx': TextDetector(onnx_model_path, input_size=input_size),
+    }
+    return detector_report(detectors, img_dir, num_imgs)
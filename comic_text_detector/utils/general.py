@@ -19,6 +19,133 @@ LOGGERS = ('csv', 'tb', 'wandb')
 CUDA = True if torch.cuda.is_available() else False
 DEVICE = 'cuda' if CUDA else 'cpu'
 
+def to_device(batch, device=DEVICE, non_blocking=True):
+    # move (nested dicts/lists of) tensors to device, pinning them first so the copy can be asynchronous
+    if isinstance(batch, torch.Tensor):
+        if device != 'cpu' and batch.device.type == 'cpu' and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: to_device(val, device, non_blocking) for key, val in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(val, device, non_blocking) for val in batch)
+    return batch
+
+class DeviceLoader:
+    '''
+    wraps a DataLoader and yields batches already on device: on cuda the next batch is pinned and copied on a side stream
+    while the current one trains, on cpu a background thread keeps collating the next batches ahead.
+    data_time / compute_time: seconds of the last epoch spent waiting for batches / in the loop body
+    '''
+    def __init__(self, loader, device=DEVICE, prefetch=2):
+        self.loader = loader
+        self.device = device
+        self.prefetch = prefetch
+        self.data_time = self.compute_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # dataset, batch_sampler etc. of the wrapped loader
+        return getattr(self.__dict__['loader'], name)
+
+    def __iter__(self):
+        import time
+        self.data_time = self.compute_time = 0.
+        batches = self.cuda_batches() if self.device != 'cpu' and CUDA else self.thread_batches()
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    return
+                t1 = time.time()
+                yield batch
+                self.data_time += t1 - t0
+                self.compute_time += time.time() - t1
+        finally:
+            # the consumer may stop early (break, exception), release the loader iterator and its workers now
+            batches.close()
+
+    def cuda_batches(self):
+        stream = torch.cuda.Stream()
+        def preload(it):
+            batch = next(it, None)
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    batch = to_device(batch, self.device)
+            return batch
+        it = iter(self.loader)
+        next_batch = preload(it)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            batch = next_batch
+            record_stream(batch, torch.cuda.current_stream())
+            next_batch = preload(it)
+            yield batch
+
+    def thread_batches(self):
+        from queue import Queue, Full
+        from threading import Thread, Event
+        queue, end, stop = Queue(maxsize=self.prefetch), object(), Event()
+        def put(item):
+            # gives up once the consumer is gone instead of blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(to_device(batch, self.device)):
+                        return
+            except Exception as e:
+                put(e)
+            put(end)
+        thread = Thread(target=worker, name='DeviceLoader', daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+def record_stream(batch, stream):
+    # tensors copied on a side stream must not be freed before the consuming stream is done with them
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for val in batch.values():
+            record_stream(val, stream)
+    elif isinstance(batch, (list, tuple)):
+        for val in batch:
+            record_stream(val, stream)
+
+def epoch_stats(train_loader, num_imgs, t0, padding_ratio=None):
+    # training throughput and the padding share of the input pixels, measured by AspectRatioBatchSampler if batches
+    # come from it, padding_ratio otherwise (see seg_dataset.letterbox_padding_ratio)
+    import time
+    throughput = num_imgs / max(time.time() - t0, 1e-6)
+    padding_ratio = getattr(train_loader.batch_sampler, 'padding_ratio', padding_ratio)
+    msg = f'throughput: {throughput:.1f} imgs/s'
+    if isinstance(train_loader, DeviceLoader):
+        msg += f', data wait: {train_loader.data_time:.1f}s, compute: {train_loader.compute_time:.1f}s'
+    if padding_ratio is not None:
+        msg += f', padding: {padding_ratio * 100:.1f}%'
+    LOGGER.info(msg)
+    return throughput, padding_ratio
+
 LOGGER_WANDB = 'wandb'
 LOGGER_TENSORBOARD = 'tb'
 
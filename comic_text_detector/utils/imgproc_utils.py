@@ -37,7 +37,7 @@ def xywh2xyxypoly(xywh, to_int=True):
     return xyxypoly
 
 def xyxy2yolo(xyxy, w: int, h: int):
-    if xyxy == [] or len(xyxy) == 0:
+    if len(xyxy) == 0:
         return None
     if isinstance(xyxy, list):
         xyxy = np.array(xyxy)
@@ -83,6 +83,92 @@ def rotate_polygons(center, polygons, rotation, new_center=None, to_int=True):
         return rotated.astype(np.int64)
     return rotated
 
+def rotation_matrix(shape, degrees, new_shape=None):
+    '''
+    2x3 affine rotating an image of shape (h, w) counter-clockwise around its center, expanded to hold
+    the whole rotated image like PIL rotate(expand=1). if new_shape (h, w) is given, the rotated image is
+    letterboxed into it (scaled to fit, padded at bottom/right) by the same matrix.
+    returns M, (w, h) of the warp output, (dw, dh) padding
+    '''
+    h, w = shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), degrees, 1.0)
+    cos, sin = abs(M[0, 0]), abs(M[0, 1])
+    rot_w, rot_h = w * cos + h * sin, w * sin + h * cos
+    M[0, 2] += (rot_w - w) / 2
+    M[1, 2] += (rot_h - h) / 2
+    if new_shape is None:
+        return M, (int(np.ceil(rot_w)), int(np.ceil(rot_h))), (0, 0)
+    if not isinstance(new_shape, tuple):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / rot_h, new_shape[1] / rot_w)
+    M *= r
+    new_unpad = int(round(rot_w * r)), int(round(rot_h * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]
+    return M, (new_shape[1], new_shape[0]), (dw, dh)
+
+def affine_points(pts: np.ndarray, M: np.ndarray) -> np.ndarray:
+    # apply a 2x3 affine to (..., 2) points
+    return pts @ M[:, :2].T + M[:, 2]
+
+def xywh2xyxy_np(x: np.ndarray) -> np.ndarray:
+    # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
+    y = np.copy(x)
+    y[:, 0] = x[:, 0] - x[:, 2] / 2
+    y[:, 1] = x[:, 1] - x[:, 3] / 2
+    y[:, 2] = x[:, 0] + x[:, 2] / 2
+    y[:, 3] = x[:, 1] + x[:, 3] / 2
+    return y
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_thres: float) -> np.ndarray:
+    # greedy NMS over xyxy boxes, same as torchvision.ops.nms: indices of kept boxes sorted by decreasing score
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        i, order = order[0], order[1:]
+        keep.append(i)
+        inter_w = np.clip(np.minimum(x2[i], x2[order]) - np.maximum(x1[i], x1[order]), 0, None)
+        inter_h = np.clip(np.minimum(y2[i], y2[order]) - np.maximum(y1[i], y1[order]), 0, None)
+        inter = inter_w * inter_h
+        iou = inter / (areas[i] + areas[order] - inter)
+        order = order[iou <= iou_thres]
+    return np.array(keep, dtype=np.int64)
+
+def non_max_suppression_np(prediction: np.ndarray, conf_thres=0.25, iou_thres=0.45, agnostic=False, max_det=300):
+    """NumPy counterpart of yolov5_utils.non_max_suppression (best class only), keeps torch out of the onnx path
+
+    Returns:
+         list of detections, on (n,6) array per image [xyxy, conf, cls]
+    """
+    assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
+    assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes into nms()
+
+    xc = prediction[..., 4] > conf_thres  # candidates
+    output = [np.zeros((0, 6), dtype=prediction.dtype)] * prediction.shape[0]
+    for xi, x in enumerate(prediction):
+        x = x[xc[xi]]
+        if not x.shape[0]:
+            continue
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        box = xywh2xyxy_np(x[:, :4])
+        j = x[:, 5:].argmax(axis=1)
+        conf = x[np.arange(len(x)), j + 5]
+        x = np.concatenate((box, conf[:, None], j[:, None].astype(x.dtype)), axis=1)[conf > conf_thres]
+
+        n = x.shape[0]
+        if not n:
+            continue
+        elif n > max_nms:
+            x = x[np.argsort(-x[:, 4], kind='stable')[:max_nms]]
+
+        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        i = nms(x[:, :4] + c, x[:, 4], iou_thres)[:max_det]
+        output[xi] = x[i]
+    return output
+
 def letterbox(im, new_shape=(640, 640), color=(0, 0, 0), auto=False, scaleFill=False, scaleup=True, stride=128):
     # Resize and pad image while meeting stride-multiple constraints
     shape = im.shape[:2]  # current shape [height, width]
@@ -116,6 +202,32 @@ def letterbox(im, new_shape=(640, 640), color=(0, 0, 0), auto=False, scaleFill=F
     im = cv2.copyMakeBorder(im, 0, dh, 0, dw, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
+def letterbox_blob(im, new_shape=(640, 640), swap_rb=False, out=None):
+    '''
+    letterbox (auto=False, padded at bottom/right) straight into a 1x3xHxW float32 blob in [0, 1],
+    fuses the resize, channel swap, HWC to CHW transpose and normalization into one pass over the input.
+    out: preallocated blob of the target shape, reused across calls
+    '''
+    shape = im.shape[:2]  # current shape [height, width]
+    if not isinstance(new_shape, tuple):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
+    if shape[::-1] != new_unpad:  # resize
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
+
+    w, h = new_unpad
+    if out is None:
+        out = np.zeros((1, 3, new_shape[0], new_shape[1]), dtype=np.float32)
+    else:   # clear the padding left by the last image
+        out[..., h:, :] = 0
+        out[..., :h, w:] = 0
+    for c in range(3):
+        src = 2 - c if swap_rb else c
+        np.divide(im[..., src], 255, out=out[0, c, :h, :w], dtype=np.float32)
+    return out, (r, r), (dw, dh)
+
 def resize_keepasp(im, new_shape=640, scaleup=True, interpolation=cv2.INTER_LINEAR, stride=None):
     shape = im.shape[:2]  # current shape [height, width]
 
@@ -50,4 +50,163 @@ def imwrite(img_path, img, ext='.png'):
         img_path = img_path.replace(suffix, ext)
     else:
         img_path += ext
-    cv2.imencode(ext, img)[1].tofile(img_path)
\ No newline at end of file
+    cv2.imencode(ext, img)[1].tofile(img_path)
+
+
+class MmapImageCache:
+    '''
+    decoded uint8 images packed into one file plus an offset table (<cache_path>.bin/.npz),
+    memory-mapped read-only so every dataloader worker shares the same pages instead of its own copy.
+    cache[i] returns a writable copy of image i, or None if it didn't fit in the budget
+    '''
+    def __init__(self, cache_path):
+        index = np.load(cache_path + '.npz')
+        self.cache_path = cache_path
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.keys = index['keys'].tolist()
+        self.budget_gb = float(index['budget_gb'])
+        self.nbytes = osp.getsize(cache_path + '.bin')
+        self._data = None
+
+    @property
+    def data(self) -> np.memmap:
+        # opened lazily, so spawned workers map the file instead of unpickling a copy
+        if self._data is None and self.nbytes > 0:
+            self._data = np.memmap(self.cache_path + '.bin', dtype=np.uint8, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if self.offsets[i] < 0:
+            return None
+        shape = self.shapes[i]
+        shape = tuple(shape) if shape[2] > 0 else tuple(shape[:2])
+        size = int(np.prod(shape))
+        return np.array(self.data[self.offsets[i]: self.offsets[i] + size]).reshape(shape)
+
+    @staticmethod
+    def build(cache_path, keys, load_func, budget_gb=7, num_threads=1):
+        '''
+        keys: one str per image identifying its source (path + resize settings), to tell whether an existing cache is stale
+        load_func: i -> decoded uint8 image, images that don't fit in what is left of budget_gb are left uncached
+        '''
+        from multiprocessing.pool import ThreadPool
+        from tqdm import tqdm
+        n = len(keys)
+        offsets = np.full(n, -1, dtype=np.int64)
+        shapes = np.zeros((n, 3), dtype=np.int64)
+        nbytes = 0
+        with open(cache_path + '.bin', 'wb') as f, ThreadPool(num_threads) as pool:
+            pbar = tqdm(enumerate(pool.imap(load_func, range(n))), total=n)
+            for i, im in pbar:
+                if im is None:
+                    continue
+                if (nbytes + im.nbytes) / 1E9 > budget_gb:
+                    continue    # smaller images further down may still fit
+                offsets[i] = nbytes
+                shapes[i, :im.ndim] = im.shape
+                f.write(np.ascontiguousarray(im, dtype=np.uint8).tobytes())
+                nbytes += im.nbytes
+                pbar.desc = f'Caching images ({nbytes / 1E9:.1f}GB)'
+            pbar.close()
+        np.savez(cache_path + '.npz', offsets=offsets, shapes=shapes, keys=np.array(keys), budget_gb=budget_gb)
+        return MmapImageCache(cache_path)
+
+    @staticmethod
+    def open_or_build(cache_prefix, keys, load_func, budget_gb=7, num_threads=1):
+        '''
+        reuse <cache_prefix>_<hash of keys> if it was built from the same keys and budget, otherwise (re)build it,
+        so train/val sets sharing a cache_dir get separate files
+        '''
+        import hashlib
+        keys = list(keys)
+        cache_path = cache_prefix + '_' + hashlib.md5('\n'.join(keys).encode('utf8')).hexdigest()[:8]
+        if osp.exists(cache_path + '.npz') and osp.exists(cache_path + '.bin'):
+            cache = MmapImageCache(cache_path)
+            if cache.keys == keys and cache.budget_gb == budget_gb:
+                return cache
+        return MmapImageCache.build(cache_path, keys, load_func, budget_gb, num_threads)
+
+
+class ShardWriter:
+    '''
+    packs samples into large sequential files <out_dir>/shard-xxxxx.bin, fields are stored as raw (still encoded) bytes,
+    index.json maps every sample to its shard and the (offset, length) of each field
+    '''
+    def __init__(self, out_dir, shard_mb=1024):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.shard_bytes = shard_mb * 1024 ** 2
+        self.shards, self.samples = [], []
+        self.f, self.pos = None, 0
+
+    def add(self, keys, **fields):
+        if self.f is None or self.pos >= self.shard_bytes:
+            self.next_shard()
+        sample = {'keys': list(keys), 'shard': len(self.shards) - 1}
+        for name, buf in fields.items():
+            self.f.write(buf)
+            sample[name] = [self.pos, len(buf)]
+            self.pos += len(buf)
+        self.samples.append(sample)
+
+    def next_shard(self):
+        if self.f is not None:
+            self.f.close()
+        self.shards.append(f'shard-{len(self.shards):05d}.bin')
+        self.f, self.pos = open(osp.join(self.out_dir, self.shards[-1]), 'wb'), 0
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        with open(osp.join(self.out_dir, 'index.json'), 'w', encoding='utf8') as f:
+            json.dump({'shards': self.shards, 'samples': self.samples}, f)
+
+
+class ShardReader:
+    '''
+    random access into shards written by ShardWriter, shard files are memory-mapped lazily (per dataloader worker)
+    '''
+    def __init__(self, shard_dir):
+        with open(osp.join(shard_dir, 'index.json'), 'r', encoding='utf8') as f:
+            index = json.load(f)
+        self.shard_dir = shard_dir
+        self.shards = index['shards']
+        self.samples = index['samples']
+        self.shard_ids = np.array([s['shard'] for s in self.samples], dtype=np.int64)
+        self._data = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def keys(self, i):
+        return tuple(self.samples[i]['keys'])
+
+    def read(self, i, field) -> np.ndarray:
+        sample = self.samples[i]
+        shard = sample['shard']
+        if shard not in self._data:
+            self._data[shard] = np.memmap(osp.join(self.shard_dir, self.shards[shard]), dtype=np.uint8, mode='r')
+        offset, length = sample[field]
+        return self._data[shard][offset: offset + length]
+
+    def read_img(self, i, field='img', flags=cv2.IMREAD_COLOR):
+        return cv2.imdecode(self.read(i, field), flags)
+
+    def read_array(self, i, field):
+        import io
+        return np.load(io.BytesIO(self.read(i, field).tobytes()))
@@ -1,15 +1,26 @@
-from typing import List
+from typing import List, Dict
+from functools import lru_cache
+import io
+import json
 import numpy as np
-from shapely.geometry import Polygon
 import math
 import copy
 from utils.imgproc_utils import union_area, xywh2xyxypoly, rotate_polygons
+from utils.io_utils import NumpyEncoder
 import cv2
 
 LANG_LIST = ['eng', 'ja', 'unknown']
 LANGCLS2IDX = {'eng': 0, 'ja': 1, 'unknown': 2}
 
 class TextBlock(object):
+    # slots keep per-block memory and attribute access cheap when holding many blocks,
+    # listed in the order they're set in __init__ so to_dict keeps its key order
+    __slots__ = ('xyxy', 'lines', 'vertical', 'language', 'font_size', 'distance', 'angle',
+                 'vec', 'norm', 'merged', 'weight', 'text', 'prob', 'translation',
+                 'fg_r', 'fg_g', 'fg_b', 'bg_r', 'bg_g', 'bg_b',
+                 'font_family', 'bold', 'underline', 'italic', 'alpha', 'rich_text', 'line_spacing',
+                 '_alignment', '_target_lang', '_bounding_rect', 'default_stroke_width', 'accumulate_color')
+
     def __init__(self, xyxy: List, 
                        lines: List = None, 
                        language: str = 'unknown',
@@ -41,7 +52,13 @@ class TextBlock(object):
                        accumulate_color = True,
                        default_stroke_width = 0.2,
                        target_lang: str = "",
+                       prob: float = 1,
+                       _alignment: int = None,
+                       _target_lang: str = None,
                        **kwargs) -> None:
+        '''
+        _alignment, _target_lang: the keys to_dict writes alignment and target_lang as, they take precedence
+        '''
         self.xyxy = [int(num) for num in xyxy]                    # boundingbox of textblock
         self.lines = [] if lines is None else lines     # polygons of textlines
         self.vertical = vertical            # orientation of textlines
@@ -56,7 +73,7 @@ class TextBlock(object):
         self.weight = weight
 
         self.text = text if text is not None else []
-        self.prob = 1
+        self.prob = prob
 
         self.translation = translation
 
@@ -77,8 +94,8 @@ class TextBlock(object):
         self.rich_text = rich_text
         self.line_spacing = line_spacing
         # self.alignment = alignment
-        self._alignment = alignment
-        self._target_lang = target_lang
+        self._alignment = alignment if _alignment is None else _alignment
+        self._target_lang = target_lang if _target_lang is None else _target_lang
 
         self._bounding_rect = _bounding_rect
         self.default_stroke_width = default_stroke_width
@@ -105,6 +122,7 @@ class TextBlock(object):
             self.lines = lines[idx].tolist()
 
     def lines_array(self, dtype=np.float64):
+        # always a copy, callers shift the result in place (e.g. textmask.merge_mask_list)
         return np.array(self.lines, dtype=dtype)
 
     def aspect_ratio(self) -> float:
@@ -143,11 +161,9 @@ class TextBlock(object):
             return [x, y, w, h]
         return self._bounding_rect
 
-    def __getattribute__(self, name: str):
-        if name == 'pts':
-            return self.lines_array()
-        # else:
-        return object.__getattribute__(self, name)
+    @property
+    def pts(self):
+        return self.lines_array()
 
     def __len__(self):
         return len(self.lines)
@@ -156,7 +172,18 @@ class TextBlock(object):
         return self.lines[idx]
 
     def to_dict(self):
-        blk_dict = copy.deepcopy(vars(self))
+        blk_dict = {name: getattr(self, name) for name in self.__slots__}
+        # only copy the mutable fields, deepcopy over the whole dict is slow
+        blk_dict['xyxy'] = list(self.xyxy)
+        blk_dict['lines'] = [[list(pnt) for pnt in line] for line in self.lines]
+        if isinstance(self.text, list):
+            blk_dict['text'] = list(self.text)
+        if self.distance is not None:
+            blk_dict['distance'] = self.distance.copy()
+        if self.vec is not None:
+            blk_dict['vec'] = self.vec.copy()
+        if self._bounding_rect is not None:
+            blk_dict['_bounding_rect'] = list(self._bounding_rect)
         return blk_dict
 
     def get_transformed_region(self, img, idx, textheight) -> np.ndarray :
@@ -264,6 +291,92 @@ class TextBlock(object):
             return self.default_stroke_width
         return 0
 
+# numeric fields of a TextBlock, packed column-wise into one record per block.
+# lines (int64 quads) and distance are concatenated into flat arrays sized by num_lines/num_distance,
+# string and list fields go into a single json document per page.
+TEXTBLOCK_RECORD_FIELDS = [
+    ('xyxy', np.int64, (4,)), ('vertical', np.bool_), ('font_size', np.float64), ('angle', np.int64),
+    ('norm', np.float64), ('merged', np.bool_), ('weight', np.float64), ('prob', np.float64),
+    ('fg_r', np.float64), ('fg_g', np.float64), ('fg_b', np.float64),
+    ('bg_r', np.float64), ('bg_g', np.float64), ('bg_b', np.float64),
+    ('bold', np.bool_), ('underline', np.bool_), ('italic', np.bool_), ('alpha', np.float64),
+    ('line_spacing', np.float64), ('_alignment', np.int64), ('default_stroke_width', np.float64),
+    ('accumulate_color', np.bool_)
+]
+# float columns which often hold ints (font_size, colors, defaults like -1 or 255), 
+# int_fields keeps a bit per column so they are loaded back as ints
+TEXTBLOCK_FLOAT_FIELDS = [field[0] for field in TEXTBLOCK_RECORD_FIELDS if field[1] == np.float64]
+TEXTBLOCK_RECORD_DTYPE = np.dtype(TEXTBLOCK_RECORD_FIELDS + [
+    ('vec', np.float64, (2,)), ('has_vec', np.bool_), ('num_lines', np.int64), ('num_distance', np.int64), ('int_fields', np.uint32)
+])
+TEXTBLOCK_META_FIELDS = ('language', 'text', 'translation', 'font_family', 'rich_text', '_target_lang', '_bounding_rect')
+
+def textblocks_to_records(blk_list: List[TextBlock]) -> Dict[str, np.ndarray]:
+    '''
+    pack blk_list into numpy arrays: records, lines, distance and meta
+    '''
+    records = np.zeros(len(blk_list), dtype=TEXTBLOCK_RECORD_DTYPE)
+    if len(blk_list) == 0:
+        return {'records': records, 'lines': np.zeros((0, 4, 2), np.int64),
+                'distance': np.zeros(0, np.float64), 'meta': np.array('[]')}
+    for field in TEXTBLOCK_RECORD_FIELDS:
+        name = field[0]
+        records[name] = [getattr(blk, name) for blk in blk_list]
+    records['vec'] = [(0, 0) if blk.vec is None else blk.vec for blk in blk_list]
+    records['has_vec'] = [blk.vec is not None for blk in blk_list]
+    records['num_lines'] = [len(blk.lines) for blk in blk_list]
+    records['num_distance'] = [-1 if blk.distance is None else len(blk.distance) for blk in blk_list]
+    for bit, name in enumerate(TEXTBLOCK_FLOAT_FIELDS):
+        is_int = [isinstance(getattr(blk, name), (int, np.integer)) for blk in blk_list]
+        records['int_fields'] |= np.array(is_int, dtype=np.uint32) << bit
+
+    lines = [blk.lines_array(dtype=np.int64).reshape(-1, 4, 2) for blk in blk_list]
+    distance = [blk.distance for blk in blk_list if blk.distance is not None]
+    distance = np.concatenate(distance) if len(distance) > 0 else np.zeros(0, np.float64)
+    meta = [[getattr(blk, name) for name in TEXTBLOCK_META_FIELDS] for blk in blk_list]
+    meta = np.array(json.dumps(meta, ensure_ascii=False, cls=NumpyEncoder))
+    return {'records': records, 'lines': np.concatenate(lines), 'distance': distance, 'meta': meta}
+
+def textblocks_from_records(records: Dict[str, np.ndarray]) -> List[TextBlock]:
+    '''
+    inverse of textblocks_to_records, blocks are rebuilt via TextBlock(**blk_dict)
+    '''
+    recs = records['records']
+    columns = [(field[0], recs[field[0]].tolist()) for field in TEXTBLOCK_RECORD_FIELDS]
+    meta = json.loads(str(records['meta']))
+    lines = records['lines'].tolist()
+    distance = records['distance']
+    vec, has_vec = recs['vec'].tolist(), recs['has_vec'].tolist()
+    num_lines, num_distance = recs['num_lines'].tolist(), recs['num_distance'].tolist()
+    int_fields = recs['int_fields'].tolist()
+
+    blk_list = []
+    line_start = dist_start = 0
+    for ii in range(len(recs)):
+        blk_dict = {name: column[ii] for name, column in columns}
+        for bit, name in enumerate(TEXTBLOCK_FLOAT_FIELDS):
+            if int_fields[ii] >> bit & 1:
+                blk_dict[name] = int(blk_dict[name])
+        blk_dict.update(zip(TEXTBLOCK_META_FIELDS, meta[ii]))
+        blk_dict['lines'] = lines[line_start: line_start + num_lines[ii]]
+        line_start += num_lines[ii]
+        if num_distance[ii] >= 0:
+            blk_dict['distance'] = distance[dist_start: dist_start + num_distance[ii]]
+            dist_start += num_distance[ii]
+        if has_vec[ii]:
+            blk_dict['vec'] = vec[ii]
+        blk_list.append(TextBlock(**blk_dict))
+    return blk_list
+
+def dump_textblocks(blk_list: List[TextBlock]) -> bytes:
+    buf = io.BytesIO()
+    np.savez(buf, **textblocks_to_records(blk_list))
+    return buf.getvalue()
+
+def load_textblocks(buf: bytes) -> List[TextBlock]:
+    with np.load(io.BytesIO(buf), allow_pickle=False) as records:
+        return textblocks_from_records(records)
+
 def sort_textblk_list(blk_list: List[TextBlock], im_w: int, im_h: int) -> List[TextBlock]:
     if len(blk_list) == 0:
         return blk_list
@@ -352,8 +465,7 @@ def try_merge_textline(blk: TextBlock, blk2: TextBlock, fntsize_tol=1.3, distanc
     cos_vec = vec_prod / blk.norm / blk2.norm
     distance = blk2.distance[-1] - blk.distance[-1]
     distance_p1 = np.linalg.norm(np.array(blk2.lines[-1][0]) - np.array(blk.lines[-1][0]))
-    l1, l2 = Polygon(blk.lines[-1]), Polygon(blk2.lines[-1])
-    if not l1.intersects(l2):
+    if not lines_intersect(blk.lines[-1], blk2.lines[-1]):
         if fntsize_div > fntsize_tol or 1 / fntsize_div > fntsize_tol:
             return False
         if abs(cos_vec) < 0.866:   # cos30
@@ -372,16 +484,62 @@ def try_merge_textline(blk: TextBlock, blk2: TextBlock, fntsize_tol=1.3, distanc
     blk2.merged = True
     return True
 
+@lru_cache(maxsize=1)
+def shapely_polygon():
+    # shapely is imported on first use only, it stays off the inference import path
+    from shapely.geometry import Polygon
+    return Polygon
+
+def lines_intersect(line1, line2) -> bool:
+    # reject by bounding box first, shapely is only needed for lines close to each other
+    line1, line2 = np.asarray(line1), np.asarray(line2)
+    if line1[:, 0].max() < line2[:, 0].min() or line2[:, 0].max() < line1[:, 0].min():
+        return False
+    if line1[:, 1].max() < line2[:, 1].min() or line2[:, 1].max() < line1[:, 1].min():
+        return False
+    Polygon = shapely_polygon()
+    return Polygon(line1).intersects(Polygon(line2))
+
+def merge_candidates(blk: TextBlock, line_xyxy: np.ndarray, line_p1: np.ndarray, font_sizes: np.ndarray, num_lines: np.ndarray) -> np.ndarray:
+    # indices of lines which could pass try_merge_textline, either their bboxes overlap
+    # or the first points are close enough given the averaged font size
+    line = np.array(blk.lines[-1], dtype=np.float64)
+    x1, y1 = line.min(axis=0)
+    x2, y2 = line.max(axis=0)
+    overlap = (line_xyxy[:, 0] <= x2) & (line_xyxy[:, 2] >= x1) & (line_xyxy[:, 1] <= y2) & (line_xyxy[:, 3] >= y1)
+    num_l1 = len(blk)
+    fntsz_avg = (blk.font_size * num_l1 + font_sizes * num_lines) / (num_l1 + num_lines)
+    distance_p1 = np.linalg.norm(line_p1 - line[0], axis=1)
+    near = distance_p1 <= fntsz_avg * 2.5 + 1e-6
+    return np.where(overlap | near)[0]
+
 def merge_textlines(blk_list: List[TextBlock]) -> List[TextBlock]:
     if len(blk_list) < 2:
         return blk_list
     blk_list.sort(key=lambda blk: blk.distance[0])
+
+    # geometry of the lines try_merge_textline compares against, computed once for the whole list
+    lines = np.array([blk.lines[-1] for blk in blk_list], dtype=np.float64)
+    line_xyxy = np.concatenate((lines.min(axis=1), lines.max(axis=1)), axis=1)
+    line_p1 = lines[:, 0]
+    font_sizes = np.array([blk.font_size for blk in blk_list], dtype=np.float64)
+    num_lines = np.array([len(blk) for blk in blk_list], dtype=np.float64)
+
+    num_blks = len(blk_list)
     merged_list = []
     for ii, current_blk in enumerate(blk_list):
         if current_blk.merged:
             continue
-        for jj, blk in enumerate(blk_list[ii+1:]):
-            try_merge_textline(current_blk, blk)
+        start = ii + 1
+        while start < num_blks:
+            # candidates only change once current_blk absorbs a line
+            candidates = merge_candidates(current_blk, line_xyxy[start:], line_p1[start:], font_sizes[start:], num_lines[start:]) + start
+            for jj in candidates:
+                if try_merge_textline(current_blk, blk_list[jj]):
+                    start = jj + 1
+                    break
+            else:
+                break
         merged_list.append(current_blk)
     for blk in merged_list:
         blk.adjust_bbox(with_bbox=False)
@@ -397,9 +555,8 @@ def split_textblk(blk: TextBlock):
     sub_blk_list = [current_blk]
     textblock_splitted = False
     for jj, line in enumerate(lines[1:]):
-        l1, l2 = Polygon(lines[jj]), Polygon(line)
         split = False
-        if not l1.intersects(l2):
+        if not lines_intersect(lines[jj], line):
             line_disance = abs(distance[jj+1] - distance[jj])
             if line_disance > distance_tol:
                 split = True
@@ -418,7 +575,21 @@ def split_textblk(blk: TextBlock):
             current_blk.adjust_bbox(with_bbox=False)
     return textblock_splitted, sub_blk_list
 
-def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> List[TextBlock]:
+def mask_score(mask: np.ndarray, xyxy, mask_ratio=None) -> float:
+    '''
+    mean mask value in xyxy, mask_ratio: (x, y) scale from mask to image coordinates if the mask is not at image resolution.
+    the box is rounded to the nearest mask pixels, which keeps the score within ~0.02 of the score 
+    on the mask resized to image resolution (bilinear)
+    '''
+    x1, y1, x2, y2 = xyxy
+    if mask_ratio is not None:
+        x1, x2 = round(x1 / mask_ratio[0]), round(x2 / mask_ratio[0])
+        y1, y2 = round(y1 / mask_ratio[1]), round(y2 / mask_ratio[1])
+        x1, y1 = min(x1, mask.shape[1] - 1), min(y1, mask.shape[0] - 1)
+        x2, y2 = max(x2, x1 + 1), max(y2, y1 + 1)
+    return mask[y1: y2, x1: x2].mean() / 255
+
+def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True, mask_ratio=None) -> List[TextBlock]:
     blk_list: List[TextBlock] = []
     scattered_lines = {'ver': [], 'hor': []}
     for bbox, cls, conf in zip(*blks):
@@ -442,8 +613,7 @@ def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> List[
             blk_list[bbox_idx].lines.append(line)
         else:   # if no textblock was assigned, check whether there is "enough" textmask
             if mask is not None:
-                mask_score = mask[by1: by2, bx1: bx2].mean() / 255
-                if mask_score < mask_score_thresh:
+                if mask_score(mask, [bx1, by1, bx2, by2], mask_ratio) < mask_score_thresh:
                     continue
             blk = TextBlock([bx1, by1, bx2, by2], [line])
             examine_textblk(blk, im_w, im_h, sort=False)
@@ -459,8 +629,7 @@ def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> List[
         if len(blk.lines) == 0:
             bx1, by1, bx2, by2 = blk.xyxy
             if mask is not None:
-                mask_score = mask[by1: by2, bx1: bx2].mean() / 255
-                if mask_score < mask_score_thresh:
+                if mask_score(mask, blk.xyxy, mask_ratio) < mask_score_thresh:
                     continue
             xywh = np.array([[bx1, by1, bx2-bx1, by2-by1]])
             blk.lines = xywh2xyxypoly(xywh).reshape(-1, 4, 2).tolist()
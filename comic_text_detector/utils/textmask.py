@@ -1,5 +1,8 @@
+import os
 from os import stat
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import cv2
 import numpy as np
 from .textblock import TextBlock
@@ -13,6 +16,23 @@ LANG_JPN = 1
 REFINEMASK_INPAINT = 0
 REFINEMASK_ANNOTATION = 1
 
+NUM_THREADS = min(8, max(1, (os.cpu_count() or 1) - 1))  # number of threads refining textblock windows
+THREAD_POOLS = {}
+
+def get_thread_pool(num_threads: int) -> ThreadPoolExecutor:
+    # pools are shared across pages, opencv releases the GIL so windows are refined concurrently
+    if num_threads not in THREAD_POOLS:
+        THREAD_POOLS[num_threads] = ThreadPoolExecutor(num_threads, thread_name_prefix='refine_mask')
+    return THREAD_POOLS[num_threads]
+
+def close_thread_pools():
+    # also run at exit, call it directly to release the threads earlier
+    while THREAD_POOLS:
+        _, pool = THREAD_POOLS.popitem()
+        pool.shutdown(wait=True)
+
+atexit.register(close_thread_pools)
+
 def get_topk_color(color_list, bins, k=3, color_var=10, bin_tol=0.001):
     idx = np.argsort(bins * -1)
     color_list, bins = color_list[idx], bins[idx]
@@ -91,21 +111,9 @@ def merge_mask_list(mask_list, pred_mask, blk: TextBlock = None, pred_thresh=30,
     mask_merged = np.zeros_like(pred_mask)
     for ii, (candidate_mask, xor_sum) in enumerate(mask_list):
         num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(candidate_mask, connectivity, cv2.CV_16U)
-        for label_index, stat, centroid in zip(range(num_labels), stats, centroids):
-            if label_index != 0: # skip background label
-                x, y, w, h, area = stat
-                if w * h < 3:
-                    continue
-                x1, y1, x2, y2 = x, y, x+w, y+h
-                label_local = labels[y1: y2, x1: x2]
-                label_coordinates = np.where(label_local==label_index)
-                tmp_merged = np.zeros_like(label_local, np.uint8)
-                tmp_merged[label_coordinates] = 255
-                tmp_merged = cv2.bitwise_or(mask_merged[y1: y2, x1: x2], tmp_merged)
-                xor_merged = cv2.bitwise_xor(tmp_merged, pred_mask[y1: y2, x1: x2]).sum()
-                xor_origin = cv2.bitwise_xor(mask_merged[y1: y2, x1: x2], pred_mask[y1: y2, x1: x2]).sum()
-                if xor_merged < xor_origin:
-                    mask_merged[y1: y2, x1: x2] = tmp_merged
+        candidates = stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT] >= 3
+        candidates[0] = False   # skip background label
+        merge_components(mask_merged, pred_mask, labels, candidates)
 
     if refine_mode == REFINEMASK_INPAINT:
         mask_merged = cv2.dilate(mask_merged, np.ones((3, 3), np.uint8), iterations=1)
@@ -116,21 +124,32 @@ def merge_mask_list(mask_list, pred_mask, blk: TextBlock = None, pred_thresh=30,
         area_thresh = sorted_area[-2]
     else:
         area_thresh = sorted_area[-1]
-    for label_index, stat, centroid in zip(range(num_labels), stats, centroids):
-        x, y, w, h, area = stat
-        if area < area_thresh:
-            x1, y1, x2, y2 = x, y, x+w, y+h
-            label_local = labels[y1: y2, x1: x2]
-            label_coordinates = np.where(label_local==label_index)
-            tmp_merged = np.zeros_like(label_local, np.uint8)
-            tmp_merged[label_coordinates] = 255
-            tmp_merged = cv2.bitwise_or(mask_merged[y1: y2, x1: x2], tmp_merged)
-            xor_merged = cv2.bitwise_xor(tmp_merged, pred_mask[y1: y2, x1: x2]).sum()
-            xor_origin = cv2.bitwise_xor(mask_merged[y1: y2, x1: x2], pred_mask[y1: y2, x1: x2]).sum()
-            if xor_merged < xor_origin:
-                mask_merged[y1: y2, x1: x2] = tmp_merged
+    candidates = stats[:, cv2.CC_STAT_AREA] < area_thresh
+    candidates[0] = False   # label 0 is mask_merged itself
+    # holes never overlap mask_merged, every pixel of them is uncovered
+    merge_components(mask_merged, pred_mask, labels, candidates, num_uncovered=stats[:, cv2.CC_STAT_AREA])
     return mask_merged
 
+def merge_components(mask_merged: np.ndarray, pred_mask: np.ndarray, labels: np.ndarray, candidates: np.ndarray, num_uncovered: np.ndarray = None):
+    '''
+    add each candidate component of labels to mask_merged if it lowers the xor sum against pred_mask.
+    mask_merged is 0/255, so adding a component only flips its uncovered pixels U to 255,
+    changing the xor sum by 255 * |U| - 2 * sum(pred_mask[U]). Components are disjoint,
+    so all of them are decided at once from per-label counts instead of per-component xors.
+    num_uncovered: |U| of every label if already known, e.g. areas from the label stats
+    '''
+    num_labels = len(candidates)
+    if num_uncovered is None:
+        uncovered = mask_merged == 0
+        uncovered_labels = labels[uncovered]
+        num_uncovered = np.bincount(uncovered_labels, minlength=num_labels)
+        pred_sum = np.bincount(uncovered_labels, weights=pred_mask[uncovered], minlength=num_labels)
+    else:
+        pred_sum = np.bincount(labels.ravel(), weights=pred_mask.ravel(), minlength=num_labels)
+    merge = candidates & (255 * num_uncovered.astype(np.float64) < 2 * pred_sum)
+    if merge.any():
+        mask_merged[merge[labels]] = 255
+
 
 def refine_undetected_mask(img: np.ndarray, mask_pred: np.ndarray, mask_refined: np.ndarray, blk_list: List[TextBlock], refine_mode=REFINEMASK_INPAINT):
     mask_pred[np.where(mask_refined > 30)] = 0
@@ -156,15 +175,24 @@ def refine_undetected_mask(img: np.ndarray, mask_pred: np.ndarray, mask_refined:
     return mask_refined
 
 
-def refine_mask(img: np.ndarray, pred_mask: np.ndarray, blk_list: List[TextBlock], refine_mode: int = REFINEMASK_INPAINT) -> np.ndarray:
+def refine_textwindow(img: np.ndarray, pred_mask: np.ndarray, blk: TextBlock, refine_mode: int = REFINEMASK_INPAINT):
+    bx1, by1, bx2, by2 = expand_textwindow(img.shape, blk.xyxy, expand_r=16)
+    im = np.ascontiguousarray(img[by1: by2, bx1: bx2])
+    msk = np.ascontiguousarray(pred_mask[by1: by2, bx1: bx2])
+    mask_list = get_topk_masklist(im, msk)
+    mask_list += get_otsuthresh_masklist(im, msk, per_channel=False)
+    mask_merged = merge_mask_list(mask_list, msk, blk=blk, text_window=[bx1, by1, bx2, by2], refine_mode=refine_mode)
+    return [bx1, by1, bx2, by2], mask_merged
+
+def refine_mask(img: np.ndarray, pred_mask: np.ndarray, blk_list: List[TextBlock], refine_mode: int = REFINEMASK_INPAINT, num_threads: int = NUM_THREADS) -> np.ndarray:
     mask_refined = np.zeros_like(pred_mask)
-    for blk in blk_list:
-        bx1, by1, bx2, by2 = expand_textwindow(img.shape, blk.xyxy, expand_r=16)
-        im = np.ascontiguousarray(img[by1: by2, bx1: bx2])
-        msk = np.ascontiguousarray(pred_mask[by1: by2, bx1: bx2])
-        mask_list = get_topk_masklist(im, msk)
-        mask_list += get_otsuthresh_masklist(im, msk, per_channel=False)
-        mask_merged = merge_mask_list(mask_list, msk, blk=blk, text_window=[bx1, by1, bx2, by2], refine_mode=refine_mode)
+    refine_func = lambda blk: refine_textwindow(img, pred_mask, blk, refine_mode)
+    if num_threads > 1 and len(blk_list) > 1:
+        results = get_thread_pool(num_threads).map(refine_func, blk_list)
+    else:
+        results = map(refine_func, blk_list)
+    # windows may overlap, so they are or-ed into the page mask here rather than in the workers
+    for (bx1, by1, bx2, by2), mask_merged in results:
         mask_refined[by1: by2, bx1: bx2] = cv2.bitwise_or(mask_refined[by1: by2, bx1: bx2], mask_merged)
     return mask_refined
 
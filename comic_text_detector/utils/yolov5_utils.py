@@ -22,26 +22,50 @@ def scale_img(img, ratio=1.0, same_shape=False, gs=32):  # img(16,3,256,416)
 
 def fuse_conv_and_bn(conv, bn):
     # Fuse convolution and batchnorm layers https://tehnokv.com/posts/fusing-batchnorm-and-conv/
+    # the fused layer keeps the dtype/device of conv (e.g. half), folding is done in fp32
     fusedconv = nn.Conv2d(conv.in_channels,
                           conv.out_channels,
                           kernel_size=conv.kernel_size,
                           stride=conv.stride,
                           padding=conv.padding,
+                          dilation=conv.dilation,
                           groups=conv.groups,
-                          bias=True).requires_grad_(False).to(conv.weight.device)
+                          bias=True,
+                          padding_mode=conv.padding_mode).requires_grad_(False).to(device=conv.weight.device, dtype=conv.weight.dtype)
 
     # prepare filters
-    w_conv = conv.weight.clone().view(conv.out_channels, -1)
-    w_bn = torch.diag(bn.weight.div(torch.sqrt(bn.eps + bn.running_var)))
+    w_conv = conv.weight.clone().float().view(conv.out_channels, -1)
+    w_bn = torch.diag(bn.weight.float().div(torch.sqrt(bn.eps + bn.running_var.float())))
     fusedconv.weight.copy_(torch.mm(w_bn, w_conv).view(fusedconv.weight.shape))
 
     # prepare spatial bias
-    b_conv = torch.zeros(conv.weight.size(0), device=conv.weight.device) if conv.bias is None else conv.bias
-    b_bn = bn.bias - bn.weight.mul(bn.running_mean).div(torch.sqrt(bn.running_var + bn.eps))
+    b_conv = torch.zeros(conv.weight.size(0), device=conv.weight.device) if conv.bias is None else conv.bias.float()
+    b_bn = bn.bias.float() - bn.weight.float().mul(bn.running_mean.float()).div(torch.sqrt(bn.running_var.float() + bn.eps))
     fusedconv.bias.copy_(torch.mm(w_bn, b_conv.reshape(-1, 1)).reshape(-1) + b_bn)
 
     return fusedconv
 
+def fuse_deconv_and_bn(deconv, bn):
+    # Fuse transposed convolution and batchnorm layers, weights are (in, out, kh, kw) so bn scales dim 1
+    assert deconv.groups == 1, 'grouped transposed convs are not supported'
+    fuseddeconv = nn.ConvTranspose2d(deconv.in_channels,
+                                     deconv.out_channels,
+                                     kernel_size=deconv.kernel_size,
+                                     stride=deconv.stride,
+                                     padding=deconv.padding,
+                                     output_padding=deconv.output_padding,
+                                     groups=deconv.groups,
+                                     bias=True,
+                                     dilation=deconv.dilation,
+                                     padding_mode=deconv.padding_mode).requires_grad_(False).to(device=deconv.weight.device, dtype=deconv.weight.dtype)
+
+    scale = bn.weight.float().div(torch.sqrt(bn.running_var.float() + bn.eps))
+    fuseddeconv.weight.copy_(deconv.weight.float() * scale.view(1, -1, 1, 1))
+    b_deconv = torch.zeros(deconv.out_channels, device=deconv.weight.device) if deconv.bias is None else deconv.bias.float()
+    fuseddeconv.bias.copy_((b_deconv - bn.running_mean.float()) * scale + bn.bias.float())
+
+    return fuseddeconv
+
 def check_anchor_order(m):
     # Check anchor order against stride order for YOLOv5 Detect() module m, and correct if necessary
     a = m.anchors.prod(-1).view(-1)  # anchor area